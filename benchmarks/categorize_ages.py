@@ -0,0 +1,41 @@
+"""
+Benchmark the vectorized age bucketing against bucketing one age at a time.
+
+Needs no database: ages are drawn at random, with some missing.
+
+Usage: python benchmarks/categorize_ages.py
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from panel_api.api_utils import categorize_age, categorize_ages
+
+AGE_COUNTS = [1_000, 10_000, 100_000]
+
+
+def random_ages(count: int) -> pd.Series:
+    """Draw ages between 18 and 100, with one in seven missing."""
+    ages = pd.Series(np.random.default_rng(0).uniform(18, 100, count).round())
+    ages[::7] = np.nan
+    return ages
+
+
+def main():
+    """Print bucketing times of both implementations, for every number of ages."""
+    print(f"{'ages':>10} {'per row':>10} {'vectorized':>12}")
+    for count in AGE_COUNTS:
+        ages = random_ages(count)
+        start = time.perf_counter()
+        expected = ages.apply(categorize_age)
+        per_row_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        results = categorize_ages(ages)
+        vectorized_seconds = time.perf_counter() - start
+        assert list(results) == list(expected)
+        print(f"{count:>10} {per_row_seconds:>10.3f} {vectorized_seconds:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark the strategies for looking voters up by Twitter user ID.
+
+Runs against the PostgreSQL database configured for the application (through
+`API_CONFIG`, as for the server), so the "voters" table must exist. Lookups are
+made of IDs sampled from the table, topped up with IDs that match no voter.
+
+Usage: API_CONFIG=/path/to/config.json python benchmarks/collect_voters.py
+"""
+import random
+import time
+
+from panel_api import create_app
+from panel_api.connections import postgresql_connection
+from panel_api.sql_utils import LookupStrategy, collect_voters
+
+ID_COUNTS = [1_000, 100_000, 1_000_000]
+BATCH_SIZES = [1_000, 10_000, 100_000]
+
+
+def sample_ids(count: int) -> list[str]:
+    """
+    Sample Twitter user IDs from the voters table, and pad them with missing IDs.
+    """
+    with postgresql_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT userid FROM voters LIMIT %s", (count,))
+        ids = [row[0] for row in cur.fetchall()]
+    ids.extend(f"-{i}" for i in range(count - len(ids)))
+    random.shuffle(ids)
+    return ids
+
+
+def time_lookup(ids: list[str], strategy: LookupStrategy, batch_size: int) -> float:
+    """Time one lookup of a list of IDs, in seconds."""
+    start = time.perf_counter()
+    collect_voters(ids, strategy=strategy, batch_size=batch_size)
+    return time.perf_counter() - start
+
+
+def main():
+    """Print lookup times of every strategy, for every number of IDs."""
+    with create_app().app_context():
+        print(f"{'ids':>10} {'strategy':>10} {'batch size':>12} {'seconds':>10}")
+        for count in ID_COUNTS:
+            ids = sample_ids(count)
+            runs = [(LookupStrategy.COPY, len(ids))] + [
+                (LookupStrategy.ANY, batch_size) for batch_size in BATCH_SIZES
+            ]
+            for strategy, batch_size in runs:
+                seconds = time_lookup(ids, strategy, batch_size)
+                print(f"{count:>10} {strategy.value:>10} {batch_size:>12}", end="")
+                print(f" {seconds:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+"""Run the command line interface with `python -m panel_api`."""
+from .cli import cli
+
+cli()
@@ -0,0 +1,34 @@
+"""
+Module for selecting the implementation that computes aggregations.
+"""
+from enum import Enum
+
+from panel_api.aggregation.numpy_engine import NumpyTimeSlicedUserDemographicAggregation
+from panel_api.aggregation.pushdown import PostgresTimeSlicedUserDemographicAggregation
+from panel_api.aggregation.user_demographics import TimeSlicedUserDemographicAggregation
+
+
+class AggregationEngine(str, Enum):
+    """
+    Implementations of the user demographics aggregation, with identical output.
+    """
+
+    PANDAS = "pandas"  # One pandas groupby per table
+    NUMPY = "numpy"  # One deduplication, then np.bincount per table
+    POSTGRES = "postgres"  # One GROUPING SETS query, joined with voters in PostgreSQL
+
+
+def aggregation_class(
+    engine: AggregationEngine,
+) -> type[TimeSlicedUserDemographicAggregation]:
+    """
+    Get the aggregation class implementing an aggregation engine.
+    """
+    if engine == AggregationEngine.PANDAS:
+        return TimeSlicedUserDemographicAggregation
+    elif engine == AggregationEngine.NUMPY:
+        return NumpyTimeSlicedUserDemographicAggregation
+    elif engine == AggregationEngine.POSTGRES:
+        return PostgresTimeSlicedUserDemographicAggregation
+    else:
+        raise NotImplementedError(f"Aggregation engine '{engine}' is not implemented")
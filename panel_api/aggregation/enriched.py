@@ -0,0 +1,135 @@
+"""
+Module defining a user demographics aggregation computed by the tweet source, from
+demographics enriched onto the tweets.
+"""
+from __future__ import annotations
+
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+from panel_api.aggregation.user_demographics import (
+    TimeSlicedUserDemographicAggregation,
+    count_labels,
+    dense_counts,
+)
+from panel_api.api_values import Demographic, TimeAggregation
+
+
+class EnrichedTimeSlicedUserDemographicAggregation(
+    TimeSlicedUserDemographicAggregation
+):
+    """
+    Time-sliced aggregation of user demographics, read from the aggregations of a
+    tweet source whose tweets carry their users' demographics (see
+    `es_utils.elastic_aggregate_demographics`), instead of joining tweets and
+    demographics. No user-level data is available, so it cannot be rolled up.
+    Distinct user counts come from Elasticsearch cardinality aggregations, which
+    are estimates (close to exact below `es_utils.CARDINALITY_PRECISION_THRESHOLD`
+    users).
+    """
+
+    def __init__(
+        self,
+        slice_buckets: list[dict[str, Any]],
+        time_aggregation: TimeAggregation,
+        cross_sections: Optional[list[Demographic]] = None,
+        time_slice_column: str = "ts",
+        relative_error: Optional[float] = None,
+    ):
+        """
+        Create this data aggregation.
+
+        Parameters:
+        slice_buckets: date_histogram buckets, as returned by
+            `es_utils.elastic_aggregate_demographics`
+        time_aggregation (TimeAggregation): size of time slices
+        cross_sections (list[Demographic]): Optional. Demographics of the
+            cross-sectional distribution per time slice in the buckets
+        time_slice_column (str): Optional. Name of the time-slice field to create
+        relative_error (float): Optional. Relative standard error of the distinct
+            user counts of the buckets, if they are estimates
+        """
+        self.time_slice_column: str = time_slice_column
+        self.time_aggregation = TimeAggregation(time_aggregation)
+        self.relative_error = relative_error
+        if cross_sections is None or len(cross_sections) == 0:
+            self.cross_sections: Optional[list[Demographic]] = None
+        else:
+            self.cross_sections = [Demographic(dem) for dem in cross_sections]
+        self.user_slices: Optional[pd.DataFrame] = None
+        self.user_demographics: Optional[pd.DataFrame] = None
+
+        time_slices = pd.DatetimeIndex(
+            pd.to_datetime([bucket["key"] for bucket in slice_buckets], unit="ms"),
+            name=time_slice_column,
+        )
+        self.counts = pd.DataFrame(
+            {
+                "n_tweets": np.array(
+                    [bucket["doc_count"] for bucket in slice_buckets], dtype=np.int64
+                ),
+                "n_tweeters": np.array(
+                    [bucket["users"]["value"] for bucket in slice_buckets],
+                    dtype=np.int64,
+                ),
+            },
+            index=time_slices,
+        )
+
+        self.demographic_labels = {}
+        self.demographic_arrays = {}
+        for dem in Demographic:
+            table = self._bucket_counts(slice_buckets, [str(dem)], [dem])
+            labels = count_labels(dem, table)
+            self.demographic_labels[dem] = labels
+            self.demographic_arrays[dem] = dense_counts(table, time_slices, [labels])
+
+        self.cross_section_labels = []
+        self.cross_sections_array = None
+        if self.cross_sections is not None:
+            table = self._bucket_counts(
+                slice_buckets,
+                ["cross_section"] * len(self.cross_sections),
+                self.cross_sections,
+            )
+            self.cross_section_labels = [
+                count_labels(dem, table) for dem in self.cross_sections
+            ]
+            self.cross_sections_array = dense_counts(
+                table, time_slices, self.cross_section_labels
+            )
+
+    def _bucket_counts(
+        self,
+        slice_buckets: list[dict[str, Any]],
+        names: list[str],
+        demographics: list[Demographic],
+    ) -> pd.Series:
+        """
+        Flatten nested terms aggregations of the time slice buckets into a count
+        table, indexed by time slice and demographic values.
+
+        Parameters:
+        slice_buckets: date_histogram buckets
+        names: Name of the terms aggregation of each nesting level
+        demographics: Demographic of each nesting level
+        """
+        rows: list[tuple] = []
+
+        def walk(bucket: dict[str, Any], key: tuple, depth: int) -> None:
+            if depth == len(names):
+                rows.append((*key, bucket["users"]["value"]))
+                return
+            for sub_bucket in bucket[names[depth]]["buckets"]:
+                walk(sub_bucket, (*key, sub_bucket["key"]), depth + 1)
+
+        for slice_bucket in slice_buckets:
+            walk(slice_bucket, (pd.Timestamp(slice_bucket["key"], unit="ms"),), 0)
+        index_names = [self.time_slice_column, *demographics]
+        return (
+            pd.DataFrame(rows, columns=[*index_names, "count"])
+            .set_index(index_names)
+            .loc[:, "count"]
+        )
@@ -0,0 +1,153 @@
+"""
+Module defining a NumPy implementation of the user demographics aggregation.
+"""
+from __future__ import annotations
+
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from panel_api.aggregation.user_demographics import (
+    TimeSlicedUserDemographicAggregation,
+    time_slice_starts,
+)
+from panel_api.api_values import Demographic, TimeAggregation
+
+
+class NumpyTimeSlicedUserDemographicAggregation(TimeSlicedUserDemographicAggregation):
+    """
+    Time-sliced aggregation of user demographics, with output identical to
+    TimeSlicedUserDemographicAggregation. Instead of grouping the data once per
+    table, (time slice, user) pairs are deduplicated once, and every table is
+    counted from the deduplicated pairs with `np.bincount` over integer codes.
+    """
+
+    def _aggregate(
+        self,
+        user_post_times: pd.DataFrame,
+        user_demographics: pd.DataFrame,
+        time_aggregation: TimeAggregation,
+    ) -> None:
+        found, post_users, user_order = join_users(user_post_times, user_demographics)
+        tweet_counts = user_post_times["tweet_count"].to_numpy()[found]
+        time_slices, post_slices = code_time_slices(
+            user_post_times["created_at"][found], time_aggregation
+        )
+        n_slices = len(time_slices)
+
+        # Deduplicate (time slice, user) pairs
+        n_users = max(len(user_order), 1)
+        pairs, pair_inverse = np.unique(
+            post_slices.astype(np.int64) * n_users + post_users, return_inverse=True
+        )
+        pair_slices = pairs // n_users
+        pair_users = user_order[pairs % n_users]
+        pair_tweets = np.bincount(pair_inverse, weights=tweet_counts)
+        if self._keep_user_slices:
+            self.user_slices = pd.DataFrame(
+                {
+                    "created_at": time_slices[pair_slices],
+                    "userid": user_demographics["userid"].to_numpy()[pair_users],
+                    "tweet_count": pair_tweets.astype(np.int64),
+                }
+            )
+            self.user_demographics = user_demographics.iloc[np.unique(pair_users)]
+
+        self.counts = pd.DataFrame(
+            {
+                "n_tweets": np.bincount(
+                    pair_slices, weights=pair_tweets, minlength=n_slices
+                ).astype(np.int64),
+                "n_tweeters": np.bincount(pair_slices, minlength=n_slices),
+            },
+            index=pd.DatetimeIndex(time_slices, name=self.time_slice_column),
+        )
+
+        user_codes = {
+            dem: user_demographics[dem].cat.codes.to_numpy()[pair_users]
+            for dem in Demographic
+        }
+        self.demographic_labels = {
+            dem: pd.Index(user_demographics[dem].cat.categories) for dem in Demographic
+        }
+        self.demographic_arrays = {
+            dem: count_array(
+                pair_slices, n_slices, [user_codes[dem]], [self.demographic_labels[dem]]
+            )
+            for dem in Demographic
+        }
+        self.cross_section_labels = []
+        self.cross_sections_array = None
+        if self.cross_sections is not None:
+            self.cross_section_labels = [
+                self.demographic_labels[dem] for dem in self.cross_sections
+            ]
+            self.cross_sections_array = count_array(
+                pair_slices,
+                n_slices,
+                [user_codes[dem] for dem in self.cross_sections],
+                self.cross_section_labels,
+            )
+
+
+def join_users(
+    user_post_times: pd.DataFrame, user_demographics: pd.DataFrame
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Join each post to its user's row of demographics, from encoded input data (see
+    `encode_user_data`).
+
+    Returns:
+    Which posts have a user with demographics, the position of each of those posts'
+    user among the users sorted by ID, and the order of the users sorted by ID
+    """
+    demographic_userids = user_demographics["userid"].to_numpy()
+    user_order = np.argsort(demographic_userids, kind="stable")
+    sorted_userids = demographic_userids[user_order]
+    post_userids = user_post_times["userid"].to_numpy()
+    positions = np.minimum(
+        np.searchsorted(sorted_userids, post_userids),
+        max(len(sorted_userids) - 1, 0),
+    )
+    found = (
+        sorted_userids[positions] == post_userids
+        if len(sorted_userids) > 0
+        else np.zeros(len(post_userids), dtype=bool)
+    )
+    return found, positions[found], user_order
+
+
+def code_time_slices(
+    created_at: pd.Series, time_aggregation: TimeAggregation
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the time slices posts fall in.
+
+    Returns:
+    The sorted starts of the time slices, and the position of each post's time
+    slice among them
+    """
+    slice_starts = time_slice_starts(created_at, time_aggregation).to_numpy(
+        dtype="datetime64[ns]"
+    )
+    time_slices, post_slices = np.unique(slice_starts, return_inverse=True)
+    return time_slices, post_slices
+
+
+def count_array(
+    pair_slices: np.ndarray,
+    n_slices: int,
+    codes: list[np.ndarray],
+    labels: list[pd.Index],
+) -> np.ndarray:
+    """
+    Count deduplicated (time slice, user) pairs per time slice and combination of
+    demographic codes, into a dense array. Pairs with a missing code are skipped.
+    """
+    valid = np.logical_and.reduce([code >= 0 for code in codes])
+    shape = (n_slices, *map(len, labels))
+    cells = np.ravel_multi_index(
+        (pair_slices[valid], *(code[valid] for code in codes)), shape
+    )
+    return np.bincount(cells, minlength=int(np.prod(shape))).reshape(shape)
@@ -0,0 +1,125 @@
+"""
+Module defining a user demographics aggregation pushed down to PostgreSQL, which
+joins the users with their demographics and counts them in the database.
+"""
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+from panel_api.aggregation.user_demographics import (
+    TimeSlicedUserDemographicAggregation,
+    count_labels,
+    dense_counts,
+    time_slice_starts,
+)
+from panel_api.api_values import Demographic, TimeAggregation
+from panel_api.sql_utils import VoterSchema, aggregate_user_slices, grouping_mask
+
+
+class PostgresTimeSlicedUserDemographicAggregation(
+    TimeSlicedUserDemographicAggregation
+):
+    """
+    Time-sliced aggregation of user demographics, with output identical to
+    TimeSlicedUserDemographicAggregation. The tweet counts per (time slice, user)
+    are copied to PostgreSQL, which joins them with the voters' demographics
+    (VOTERS.SCHEMA) and computes every table with one GROUPING SETS query. The user
+    demographics passed in are not used, so they need not be looked up.
+    """
+
+    def __init__(
+        self,
+        user_post_times: pd.DataFrame,
+        user_demographics: Optional[pd.DataFrame],
+        time_aggregation: TimeAggregation,
+        cross_sections: Optional[list[Demographic]] = None,
+        time_slice_column: str = "ts",
+        keep_user_slices: bool = False,
+    ):
+        super().__init__(
+            user_post_times,
+            pd.DataFrame(columns=["userid", *Demographic]),
+            time_aggregation,
+            cross_sections=cross_sections,
+            time_slice_column=time_slice_column,
+            keep_user_slices=keep_user_slices,
+        )
+
+    def _aggregate(
+        self,
+        user_post_times: pd.DataFrame,
+        user_demographics: pd.DataFrame,
+        time_aggregation: TimeAggregation,
+    ) -> None:
+        user_slices = (
+            user_post_times.assign(
+                created_at=time_slice_starts(
+                    user_post_times["created_at"], time_aggregation
+                )
+            )
+            .groupby(["created_at", "userid"])["tweet_count"]
+            .sum()
+            .reset_index()
+        )
+        if self._keep_user_slices:
+            # Rolling up joins the demographics in the database again
+            self.user_slices = user_slices
+            self.user_demographics = user_demographics
+
+        groups = aggregate_user_slices(
+            user_slices,
+            self.cross_sections,
+            schema=current_app.config["VOTERS"].get("SCHEMA", VoterSchema.JSON),
+        )
+        totals = groups[groups["grouping"] == grouping_mask([])].sort_values(
+            "created_at"
+        )
+        time_slices = pd.DatetimeIndex(
+            totals["created_at"], name=self.time_slice_column
+        )
+        self.counts = pd.DataFrame(
+            {
+                "n_tweets": totals["n_tweets"].to_numpy(dtype=np.int64),
+                "n_tweeters": totals["n_users"].to_numpy(dtype=np.int64),
+            },
+            index=time_slices,
+        )
+
+        self.demographic_labels = {}
+        self.demographic_arrays = {}
+        for dem in Demographic:
+            table = self._group_counts(groups, [dem])
+            labels = count_labels(dem, table)
+            self.demographic_labels[dem] = labels
+            self.demographic_arrays[dem] = dense_counts(table, time_slices, [labels])
+
+        self.cross_section_labels = []
+        self.cross_sections_array = None
+        if self.cross_sections is not None:
+            table = self._group_counts(groups, self.cross_sections)
+            self.cross_section_labels = [
+                count_labels(dem, table) for dem in self.cross_sections
+            ]
+            self.cross_sections_array = dense_counts(
+                table, time_slices, self.cross_section_labels
+            )
+
+    def _group_counts(
+        self, groups: pd.DataFrame, demographics: list[Demographic]
+    ) -> pd.Series:
+        """
+        Select the user counts of the grouping set of some demographics, indexed by
+        time slice and demographic values. Groups with a missing value are dropped.
+        """
+        rows = groups[groups["grouping"] == grouping_mask(demographics)].dropna(
+            subset=demographics
+        )
+        return (
+            rows.rename(columns={"created_at": self.time_slice_column})
+            .set_index([self.time_slice_column, *demographics])
+            .loc[:, "n_users"]
+        )
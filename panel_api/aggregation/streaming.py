@@ -0,0 +1,137 @@
+"""
+Module defining running tweet counts per time slice and user, which chunks of
+tweets are folded into as they are read, so the tweets are never held all at once.
+"""
+from __future__ import annotations
+
+import threading
+
+import pandas as pd
+
+from panel_api.aggregation.user_demographics import time_slice_starts
+from panel_api.api_values import TimeAggregation
+
+# Reduced chunks are merged into the running counts once they have at least as many
+# rows as the counts, and at least this many
+MIN_MERGE_ROWS = 100000
+
+
+class UserSliceAccumulator:
+    """
+    Running tweet counts per distinct (time slice, user) pair. Chunks of tweets are
+    reduced to such counts as they are added, and merged together lazily, so memory
+    is bounded by the number of distinct pairs rather than the number of tweets.
+    Chunks may be added concurrently from several threads.
+    """
+
+    def __init__(self, time_aggregation: TimeAggregation):
+        """
+        Create empty counts.
+
+        Parameters:
+        time_aggregation: Size of the time slices
+        """
+        self.time_aggregation = time_aggregation
+        self.n_tweets = 0
+        self._counts = empty_user_slices()
+        self._pending: list[pd.DataFrame] = []
+        self._pending_rows = 0
+        self._lock = threading.Lock()
+
+    def add(self, chunk: pd.DataFrame) -> None:
+        """
+        Fold a chunk of tweets into the counts.
+
+        Parameters:
+        chunk: DataFrame with "created_at" and "userid" columns, and optionally a
+            "tweet_count" column holding the number of tweets each row stands for
+        """
+        if len(chunk) == 0:
+            return
+        reduced = reduce_chunk(chunk, self.time_aggregation)
+        with self._lock:
+            self.n_tweets += int(reduced["tweet_count"].sum())
+            self._pending.append(reduced)
+            self._pending_rows += len(reduced)
+            if self._pending_rows >= max(len(self._counts), MIN_MERGE_ROWS):
+                self._merge()
+
+    @property
+    def n_rows(self) -> int:
+        """
+        Number of rows held: the merged counts, and the reduced chunks not merged
+        yet.
+        """
+        with self._lock:
+            return len(self._counts) + self._pending_rows
+
+    def userids(self) -> pd.Index:
+        """
+        Distinct users counted so far.
+        """
+        return pd.Index(self.user_slices()["userid"].unique())
+
+    def user_slices(self) -> pd.DataFrame:
+        """
+        Tweet counts, with one row per time slice and user, where "created_at" is the
+        start of the time slice.
+        """
+        with self._lock:
+            self._merge()
+            return self._counts
+
+    def _merge(self) -> None:
+        if len(self._pending) == 0:
+            return
+        self._counts = merge_user_slices([self._counts, *self._pending])
+        self._pending = []
+        self._pending_rows = 0
+
+
+def empty_user_slices() -> pd.DataFrame:
+    """
+    Tweet counts per time slice and user, without any row.
+    """
+    return pd.DataFrame(
+        {
+            "created_at": pd.Series(dtype="datetime64[ns]"),
+            "userid": pd.Series(dtype=object),
+            "tweet_count": pd.Series(dtype="int64"),
+        }
+    )
+
+
+def reduce_chunk(
+    chunk: pd.DataFrame, time_aggregation: TimeAggregation
+) -> pd.DataFrame:
+    """
+    Reduce a chunk of tweets to tweet counts per (time slice, user).
+    """
+    tweet_counts = (
+        chunk["tweet_count"].to_numpy() if "tweet_count" in chunk.columns else 1
+    )
+    return merge_user_slices(
+        [
+            pd.DataFrame(
+                {
+                    "created_at": time_slice_starts(
+                        chunk["created_at"], time_aggregation
+                    ).to_numpy(),
+                    "userid": chunk["userid"].astype(str).to_numpy(),
+                    "tweet_count": tweet_counts,
+                }
+            )
+        ]
+    )
+
+
+def merge_user_slices(parts: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Sum the tweet counts per (time slice, user) of several DataFrames.
+    """
+    return (
+        pd.concat(parts, ignore_index=True)
+        .groupby(["created_at", "userid"], sort=False)["tweet_count"]
+        .sum()
+        .reset_index()
+    )
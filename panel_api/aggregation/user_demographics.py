@@ -3,13 +3,100 @@ Modulde defining an aggregation of just user demographics.
 """
 from __future__ import annotations
 
+import copy
+import io
 import itertools
-from typing import Any, Hashable, Optional, Tuple
+from datetime import datetime
+from typing import Any, Hashable, Iterable, Optional, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
+import ujson
+from werkzeug.http import http_date
 
-from panel_api.api_utils import censor_table
-from panel_api.api_values import Demographic, TimeAggregation
+from panel_api.api_utils import demographic_categorical, numeric_userids
+from panel_api.api_values import CENSORED_COUNT, Demographic, TimeAggregation
+
+# Standard errors below an estimated count its lower bound is, for censoring
+CENSOR_STANDARD_ERRORS = 3
+
+
+def encode_user_data(
+    user_post_times: pd.DataFrame, user_demographics: pd.DataFrame
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Keep only the columns an aggregation needs from its input data, with compact
+    dtypes: int64 user IDs, and Categorical demographics over the demographics'
+    lists of API values. Rows with non-numeric user IDs, and repeated users in the
+    demographics, are dropped.
+
+    Returns:
+    The encoded post times, with a "tweet_count" column, and demographics
+    """
+    userids, rows = numeric_userids(user_post_times["userid"])
+    user_post_times = pd.DataFrame(
+        {
+            "created_at": user_post_times["created_at"].to_numpy()[rows],
+            "userid": userids,
+            "tweet_count": (
+                user_post_times["tweet_count"].to_numpy(dtype="int64")[rows]
+                if "tweet_count" in user_post_times.columns
+                else 1
+            ),
+        }
+    )
+
+    userids, rows = numeric_userids(user_demographics["userid"])
+    demographic_columns: dict[str, Any] = {"userid": userids}
+    for dem in Demographic:
+        demographic_columns[dem] = demographic_categorical(
+            dem, user_demographics[dem].to_numpy()[rows]
+        )
+    user_demographics = pd.DataFrame(demographic_columns).drop_duplicates("userid")
+    return user_post_times, user_demographics
+
+
+def time_slice_starts(
+    created_at: pd.Series, time_aggregation: TimeAggregation
+) -> pd.Series:
+    """
+    Find the start of the time slice each post time falls in.
+    """
+    return (
+        pd.to_datetime(created_at).dt.to_period(time_aggregation.round_key())
+    ).dt.start_time
+
+
+def user_slice_counts(
+    user_post_times: pd.DataFrame,
+    user_demographics: pd.DataFrame,
+    time_aggregation: TimeAggregation,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Count the tweets of each user with demographics per time slice, from encoded
+    input data (see `encode_user_data`).
+
+    Returns:
+    Post times with one row per time slice and user, where "created_at" is the
+    start of the time slice, and the demographics of those users
+    """
+    user_post_times = user_post_times[
+        user_post_times["userid"].isin(user_demographics["userid"])
+    ]
+    user_slices = (
+        user_post_times.assign(
+            created_at=time_slice_starts(
+                user_post_times["created_at"], time_aggregation
+            )
+        )
+        .groupby(["created_at", "userid"])["tweet_count"]
+        .sum()
+        .reset_index()
+    )
+    return (
+        user_slices,
+        user_demographics[user_demographics["userid"].isin(user_slices["userid"])],
+    )
 
 
 class TimeSlicedUserDemographicAggregation:
@@ -26,53 +113,104 @@ class TimeSlicedUserDemographicAggregation:
         time_aggregation: TimeAggregation,
         cross_sections: Optional[list[Demographic]] = None,
         time_slice_column: str = "ts",
+        keep_user_slices: bool = False,
     ):
         """
         Create this data aggregation.
 
         Parameters:
         user_post_times (DataFrame): When users posted tweets. This DataFrame
-            must contain columns ["created_at", "userid"]
+            must contain columns ["created_at", "userid"]. It may also contain a
+            "tweet_count" column, if each row stands for more than one tweet
         user_demographics (DataFrame): Demographic information of the users. Must
             contain columns for each Demographic and "userid"
         time_aggregation (TimeAggregation): size of time slices
         cross_sections (list[Demographic]): Optional. Specify Demographics for a
             cross-sectional distribution per time slice
         time_slice_column (str): Optional. Name of the time-slice field to create
+        keep_user_slices (bool): Optional. Keep the tweet counts of each user per
+            time slice, and the users' demographics, so the aggregation can be
+            rolled up into coarser time slices (see `rollup`)
         """
         self.time_slice_column: str = time_slice_column
+        self.time_aggregation = TimeAggregation(time_aggregation)
+        # Relative standard error of the counts, if they are estimates
+        self.relative_error: Optional[float] = None
         if cross_sections is None or len(cross_sections) == 0:
             self.cross_sections: Optional[list[Demographic]] = None
         else:
-            self.cross_sections = list(cross_sections)
+            self.cross_sections = [Demographic(dem) for dem in cross_sections]
 
-        user_demographics = user_demographics.rename(
-            columns={"userid": "userid_demographics"}
-        )
-        data = user_post_times.merge(
-            user_demographics, left_on="userid", right_on="userid_demographics"
-        )
-        data[self.time_slice_column] = (
-            pd.to_datetime(data["created_at"])
-            .dt.to_period(time_aggregation.round_key())
-            .dt.start_time
+        user_post_times, user_demographics = encode_user_data(
+            user_post_times, user_demographics
         )
+        self.user_slices: Optional[pd.DataFrame] = None
+        self.user_demographics: Optional[pd.DataFrame] = None
+        self._keep_user_slices = keep_user_slices
+        self._aggregate(user_post_times, user_demographics, time_aggregation)
+        if keep_user_slices and self.user_slices is None:
+            # This engine does not group the tweets per (time slice, user) itself
+            self.user_slices, self.user_demographics = user_slice_counts(
+                user_post_times, user_demographics, time_aggregation
+            )
 
-        self.counts: pd.DataFrame = self._get_counts(data)
-        self.demographic_distributions: dict[
-            Demographic, pd.Series
-        ] = self._user_demographic_counts(data)
-        self.cross_sections_table = self._user_cross_sections(data)
-
-    def _get_counts(self, data: pd.DataFrame) -> pd.DataFrame:
-        data = data[[self.time_slice_column, "userid"]].assign(count=0)
-        table = (
-            data.groupby([self.time_slice_column, "userid"])
-            .count()
-            .reset_index("userid")["count"]
+    def _aggregate(
+        self,
+        user_post_times: pd.DataFrame,
+        user_demographics: pd.DataFrame,
+        time_aggregation: TimeAggregation,
+    ) -> None:
+        """
+        Compute the counts, demographic distributions and cross-sections tables
+        from encoded input data (see `encode_user_data`). If user-level data is
+        kept, also set `user_slices` and `user_demographics`.
+        """
+        data = user_post_times.merge(user_demographics, on="userid")
+        data[self.time_slice_column] = time_slice_starts(
+            data["created_at"], time_aggregation
         )
-        ts_groups = table.groupby(self.time_slice_column)
-        counts = ts_groups.sum().to_frame().rename(columns={"count": "n_tweets"})
+
+        user_slice_tweets = data.groupby([self.time_slice_column, "userid"])[
+            "tweet_count"
+        ].sum()
+        self.counts: pd.DataFrame = self._get_counts(user_slice_tweets)
+        if self._keep_user_slices:
+            self.user_slices = user_slice_tweets.rename_axis(
+                ["created_at", "userid"]
+            ).reset_index()
+            self.user_demographics = user_demographics[
+                user_demographics["userid"].isin(self.user_slices["userid"])
+            ]
+        time_slices = pd.Index(self.counts.index)
+
+        self.demographic_labels: dict[Demographic, pd.Index] = {}
+        self.demographic_arrays: dict[Demographic, np.ndarray] = {}
+        for dem, table in self._user_demographic_counts(data).items():
+            labels = count_labels(dem, table)
+            self.demographic_labels[dem] = labels
+            self.demographic_arrays[dem] = dense_counts(table, time_slices, [labels])
+
+        self.cross_section_labels: list[pd.Index] = []
+        self.cross_sections_array: Optional[np.ndarray] = None
+        if self.cross_sections is not None:
+            cross_sections_table = self._user_cross_sections(data)
+            cross_section_counts = (
+                cross_sections_table.reset_index()
+                .set_index([self.time_slice_column, *self.cross_sections])
+                .loc[:, "count"]
+                if len(cross_sections_table) > 0
+                else pd.Series(dtype=np.int64)
+            )
+            self.cross_section_labels = [
+                count_labels(dem, cross_section_counts) for dem in self.cross_sections
+            ]
+            self.cross_sections_array = dense_counts(
+                cross_section_counts, time_slices, self.cross_section_labels
+            )
+
+    def _get_counts(self, user_slice_tweets: pd.Series) -> pd.DataFrame:
+        ts_groups = user_slice_tweets.groupby(level=self.time_slice_column)
+        counts = ts_groups.sum().to_frame().rename(columns={"tweet_count": "n_tweets"})
         counts["n_tweeters"] = ts_groups.count()
         return counts
 
@@ -84,7 +222,7 @@ class TimeSlicedUserDemographicAggregation:
         for dem in Demographic:
             demographic_counts[dem] = (
                 distinct_data.assign(count=0)
-                .groupby([self.time_slice_column, dem])
+                .groupby([self.time_slice_column, dem], observed=True)
                 .count()["count"]
             )
         return demographic_counts
@@ -95,91 +233,628 @@ class TimeSlicedUserDemographicAggregation:
         distinct_data = data.drop_duplicates([self.time_slice_column, "userid"])
         cross_sections_table = (
             distinct_data.assign(count=0)
-            .groupby([self.time_slice_column, *self.cross_sections])
+            .groupby([self.time_slice_column, *self.cross_sections], observed=True)
             .count()["count"]
             .reset_index()
         )
         return cross_sections_table
 
-    def censor(self, min_displayed_users: int) -> TimeSlicedUserDemographicAggregation:
+    def select_slices(
+        self, time_slices: Iterable[Any]
+    ) -> TimeSlicedUserDemographicAggregation:
+        """
+        Restrict this aggregation to some of its time slices. Time slices it does not
+        have are skipped.
+
+        Parameters:
+        time_slices: Starts of the time slices to keep
+
+        Returns:
+        A new aggregation, in the order of the given time slices
         """
-        Remove demographic counds below a minimum display threshold.
+        positions = pd.Index(self.counts.index).get_indexer(list(time_slices))
+        positions = positions[positions >= 0]
+        selected = copy.copy(self)
+        selected.counts = self.counts.iloc[positions]
+        selected.demographic_arrays = {
+            dem: array[positions] for dem, array in self.demographic_arrays.items()
+        }
+        if self.cross_sections_array is not None:
+            selected.cross_sections_array = self.cross_sections_array[positions]
+        if self.user_slices is not None:
+            selected.user_slices = self.user_slices[
+                self.user_slices["created_at"].isin(selected.counts.index)
+            ]
+        return selected
+
+    @staticmethod
+    def concat(
+        aggregations: Sequence[TimeSlicedUserDemographicAggregation],
+    ) -> TimeSlicedUserDemographicAggregation:
         """
-        for dem in self.demographic_distributions.keys():
-            self.demographic_distributions[dem] = censor_table(
-                self.demographic_distributions[dem],
-                min_displayed_count=min_displayed_users,
-            ).dropna()
+        Combine aggregations of the same cross-sections over disjoint time slices.
 
-        if self.cross_sections is not None:
-            self.cross_sections_table["count"] = censor_table(
-                self.cross_sections_table["count"],
-                min_displayed_count=min_displayed_users,
+        Parameters:
+        aggregations: At least one aggregation to combine
+
+        Returns:
+        A new aggregation of all their time slices, in time order
+        """
+        combined = copy.copy(aggregations[0])
+        combined.counts = pd.concat([part.counts for part in aggregations])
+        combined.demographic_labels = {}
+        combined.demographic_arrays = {}
+        for dem in Demographic:
+            part_labels = [part.demographic_labels[dem] for part in aggregations]
+            labels = union_labels(dem, part_labels)
+            combined.demographic_labels[dem] = labels
+            combined.demographic_arrays[dem] = np.concatenate(
+                [
+                    realign_counts(part.demographic_arrays[dem], [old], [labels])
+                    for part, old in zip(aggregations, part_labels)
+                ]
+            )
+        if combined.cross_sections is not None:
+            combined.cross_section_labels = [
+                union_labels(
+                    dem, [part.cross_section_labels[axis] for part in aggregations]
+                )
+                for axis, dem in enumerate(combined.cross_sections)
+            ]
+            combined.cross_sections_array = np.concatenate(
+                [
+                    realign_counts(
+                        part.cross_sections_array,
+                        part.cross_section_labels,
+                        combined.cross_section_labels,
+                    )
+                    for part in aggregations
+                    if part.cross_sections_array is not None
+                ]
+            )
+        user_slices = [
+            slices for part in aggregations if (slices := part.user_slices) is not None
+        ]
+        user_demographics = [
+            demographics
+            for part in aggregations
+            if (demographics := part.user_demographics) is not None
+        ]
+        if len(user_slices) == len(aggregations):
+            combined.user_slices = pd.concat(user_slices)
+            combined.user_demographics = pd.concat(user_demographics).drop_duplicates(
+                "userid"
             )
-            self.cross_sections_table = self.cross_sections_table.dropna()
+        else:
+            combined.user_slices = None
+            combined.user_demographics = None
+        return combined.select_slices(combined.counts.index.sort_values())
+
+    def rollup(
+        self, time_aggregation: TimeAggregation
+    ) -> TimeSlicedUserDemographicAggregation:
+        """
+        Aggregate the kept user-level data of this aggregation into coarser time
+        slices made of whole time slices of this one, giving the same results as
+        aggregating the original data into them.
+
+        Parameters:
+        time_aggregation (TimeAggregation): size of the coarser time slices
 
+        Returns:
+        A new aggregation, which also keeps its user-level data
+        """
+        if self.user_slices is None or self.user_demographics is None:
+            raise ValueError("This aggregation did not keep its user-level data")
+        if not self.time_aggregation.is_finer_than(time_aggregation):
+            raise ValueError(
+                f"Can't roll up {self.time_aggregation} slices into {time_aggregation}"
+            )
+        return type(self)(
+            self.user_slices,
+            self.user_demographics,
+            time_aggregation,
+            cross_sections=self.cross_sections,
+            time_slice_column=self.time_slice_column,
+            keep_user_slices=True,
+        )
+
+    def censor(self, min_displayed_users: int) -> TimeSlicedUserDemographicAggregation:
+        """
+        Censor demographic counts below a minimum display threshold, by replacing
+        them with CENSORED_COUNT. Estimated counts (see `relative_error`) are
+        censored when their lower error bound is below the threshold.
+        """
+        arrays = list(self.demographic_arrays.values())
+        if self.cross_sections_array is not None:
+            arrays.append(self.cross_sections_array)
+        for array in arrays:
+            array[
+                (array > 0) & self._below_threshold(array, min_displayed_users)
+            ] = CENSORED_COUNT
         return self
 
-    def to_list(self) -> list[dict[Hashable, Any]]:
+    def _below_threshold(
+        self, array: np.ndarray, min_displayed_users: int
+    ) -> np.ndarray:
+        if self.relative_error is None:
+            return array < min_displayed_users
+        # Estimates are censored by their lower error bound
+        lower_bound = array * max(1 - CENSOR_STANDARD_ERRORS * self.relative_error, 0)
+        return lower_bound < min_displayed_users
+
+    def to_list(self, explicit_zeros: bool = False) -> list[dict[Hashable, Any]]:
         """
         Convert this aggregation into a JSON serializable Python list.
+
+        Parameters:
+        explicit_zeros (bool): Optional. Report a count for every API value of
+            every demographic (and every combination of them in cross-sections),
+            with zeros for values no user had and for censored counts. Otherwise,
+            only non-zero, uncensored counts are reported
+
+        Returns:
+        One record per time slice
         """
         records = self.counts.reset_index().to_dict("records")
-        for record in records:
-            record.update(**self._base_record_tables())
-        indexed_records = {record[self.time_slice_column]: record for record in records}
-        for dem in Demographic:
-            for ts, table in (
-                self.demographic_distributions[dem]
-                .reset_index()
-                .groupby(self.time_slice_column)
-            ):
-                indexed_records[ts][dem] = table.set_index(dem)["count"].to_dict()
+        demographic_cells = {
+            dem: reported_cells(
+                self.demographic_arrays[dem],
+                [dem],
+                [self.demographic_labels[dem]],
+                explicit_zeros,
+            )
+            for dem in Demographic
+        }
         if self.cross_sections is not None:
-            for ts, table in self.cross_sections_table.reset_index().groupby(
-                self.time_slice_column
-            ):
-                indexed_records[ts]["groups"] = table[
-                    [*self.cross_sections, "count"]
-                ].to_dict("records")
+            assert self.cross_sections_array is not None
+            group_cells = reported_cells(
+                self.cross_sections_array,
+                self.cross_sections,
+                self.cross_section_labels,
+                explicit_zeros,
+            )
+
+        for i, record in enumerate(records):
+            for dem in Demographic:
+                labels = self.demographic_labels[dem]
+                counts = self.demographic_arrays[dem][i]
+                record[dem] = {
+                    labels[j]: uncensored_count(counts[j])
+                    for j in np.flatnonzero(demographic_cells[dem][i])
+                }
+            if self.cross_sections is not None:
+                assert self.cross_sections_array is not None
+                counts = self.cross_sections_array[i]
+                record["groups"] = [
+                    {
+                        **{
+                            dem: labels[j]
+                            for dem, labels, j in zip(
+                                self.cross_sections, self.cross_section_labels, cell
+                            )
+                        },
+                        "count": uncensored_count(counts[cell]),
+                    }
+                    for cell in zip(*np.nonzero(group_cells[i]))
+                ]
         return records
 
-    def _base_record_tables(self) -> dict[str, Any]:
-        base_record: dict[str, Any] = {}
+    def to_json(self, explicit_zeros: bool = False) -> str:
+        """
+        Serialize this aggregation straight into the JSON of `to_list`, from its
+        count arrays, without building the Python list. Time slices are formatted
+        as HTTP dates, like Flask's JSON encoder formats datetimes.
+
+        Parameters:
+        explicit_zeros (bool): Optional. See `to_list`
+
+        Returns:
+        JSON array with one object per time slice
+        """
+        n_tweets = self.counts["n_tweets"].to_numpy(dtype=np.int64).astype(str)
+        n_tweeters = self.counts["n_tweeters"].to_numpy(dtype=np.int64).astype(str)
+        fields = [
+            [
+                f"{ujson.dumps(self.time_slice_column)}:"
+                f"{ujson.dumps(format_time_slice(ts))}"
+                for ts in self.counts.index
+            ],
+            [f'"n_tweets":{count}' for count in n_tweets],
+            [f'"n_tweeters":{count}' for count in n_tweeters],
+        ]
+        for dem in Demographic:
+            array = self.demographic_arrays[dem]
+            cells = reported_cells(
+                array, [dem], [self.demographic_labels[dem]], explicit_zeros
+            )
+            prefixes = np.array(
+                [
+                    f"{ujson.dumps(str(label))}:"
+                    for label in self.demographic_labels[dem]
+                ]
+            )
+            fields.append(
+                [
+                    f"{ujson.dumps(str(dem))}:{{{values}}}"
+                    for values in json_cells(array, cells, prefixes, "")
+                ]
+            )
+        if self.cross_sections is not None:
+            assert self.cross_sections_array is not None
+            array = self.cross_sections_array
+            cells = reported_cells(
+                array, self.cross_sections, self.cross_section_labels, explicit_zeros
+            )
+            keys = [ujson.dumps(str(dem)) for dem in self.cross_sections]
+            prefixes = np.array(
+                [
+                    "{"
+                    + "".join(
+                        f"{key}:{ujson.dumps(label)},"
+                        for key, label in zip(keys, combination)
+                    )
+                    + '"count":'
+                    for combination in itertools.product(*self.cross_section_labels)
+                ]
+            ).reshape(array.shape[1:])
+            fields.append(
+                [
+                    f'"groups":[{values}]'
+                    for values in json_cells(array, cells, prefixes, "}")
+                ]
+            )
+        return "[" + ",".join("{" + ",".join(row) + "}" for row in zip(*fields)) + "]"
+
+    def to_columnar(self) -> dict[str, Any]:
+        """
+        Convert this aggregation into a JSON serializable columnar layout: one list
+        of time slices and of each count, and one count matrix per demographic (and
+        for cross-sections), shaped (time slices, values...), whose labels are
+        listed once. Censored counts are None.
+        """
+        columnar: dict[str, Any] = {
+            self.time_slice_column: self.counts.index.tolist(),
+            "n_tweets": self.counts["n_tweets"].tolist(),
+            "n_tweeters": self.counts["n_tweeters"].tolist(),
+        }
         for dem in Demographic:
-            base_record[dem] = {}
+            columnar[dem] = {
+                "labels": self.demographic_labels[dem].tolist(),
+                "counts": reported_counts(self.demographic_arrays[dem]).tolist(),
+            }
         if self.cross_sections is not None:
-            base_record["groups"] = []
-        return base_record
-
-    def _fill_zeros(self) -> Tuple:
-        time_slices = self.counts.reset_index()[
-            self.time_slice_column
-        ].drop_duplicates()
-        demographic_distributions = {}
+            assert self.cross_sections_array is not None
+            columnar["groups"] = {
+                "demographics": [str(dem) for dem in self.cross_sections],
+                "labels": [labels.tolist() for labels in self.cross_section_labels],
+                "counts": reported_counts(self.cross_sections_array).tolist(),
+            }
+        return columnar
+
+    def to_arrow(self, metadata: Optional[dict[str, str]] = None) -> bytes:
+        """
+        Serialize this aggregation as an Arrow IPC stream of one row per time slice.
+        Each demographic (and the cross-sections, as "groups") is a fixed-size list
+        column of counts, in the order of the labels listed in the schema metadata,
+        with nulls for censored counts. Cross-section counts are flattened in
+        row-major order.
+
+        Parameters:
+        metadata (dict[str, str]): Optional. Extra schema metadata
+
+        Returns:
+        The IPC stream
+        """
+        # pylint: disable-next=import-outside-toplevel
+        import pyarrow as pa  # Optional dependency, only needed for this format
+
+        columns = {
+            self.time_slice_column: pa.array(
+                pd.to_datetime(self.counts.index.to_series()), pa.timestamp("ms")
+            ),
+            "n_tweets": pa.array(self.counts["n_tweets"], pa.int64()),
+            "n_tweeters": pa.array(self.counts["n_tweeters"], pa.int64()),
+        }
+        labels: dict[str, Any] = {}
+        arrays = {str(dem): self.demographic_arrays[dem] for dem in Demographic}
         for dem in Demographic:
-            table = self.demographic_distributions[dem]
-            indices = list(zip(time_slices, dem.values()))
-            demographic_distributions[dem] = table.reindex(indices, fill_value=0)
-        if self.cross_sections is None:
-            cross_sections_table = pd.DataFrame()
-        else:
-            index_columns = [self.time_slice_column, *self.cross_sections]
-            indices = list(
-                zip(
-                    time_slices,
-                    itertools.chain(
-                        *[
-                            Demographic.values(Demographic(dem))
-                            for dem in index_columns[1:]
-                        ]
-                    ),
+            labels[str(dem)] = self.demographic_labels[dem].tolist()
+        if self.cross_sections is not None:
+            assert self.cross_sections_array is not None
+            arrays["groups"] = self.cross_sections_array
+            labels["groups"] = {
+                str(dem): dem_labels.tolist()
+                for dem, dem_labels in zip(
+                    self.cross_sections, self.cross_section_labels
                 )
+            }
+        for name, array in arrays.items():
+            flat = array.reshape(-1)
+            columns[name] = pa.FixedSizeListArray.from_arrays(
+                pa.array(flat, pa.int64(), mask=flat == CENSORED_COUNT),
+                int(np.prod(array.shape[1:])),
             )
-            cross_sections_table = (
-                self.cross_sections_table.reset_index()
-                .set_index(index_columns)
-                .reindex(indices)
+
+        table = pa.table(columns).replace_schema_metadata(
+            {"labels": ujson.dumps(labels), **(metadata or {})}
+        )
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+    def to_bytes(self, include_user_data: bool = True) -> bytes:
+        """
+        Serialize this aggregation for the result cache, as an uncompressed NumPy
+        .npz archive of its count arrays (and kept user-level data), with its labels
+        and other attributes in a JSON "metadata" entry. Unlike a pickle, reading it
+        back can't run code. See `from_bytes`.
+
+        Parameters:
+        include_user_data (bool): Optional. Include the kept user-level data, if
+            any. Otherwise, the rebuilt aggregation can't be rolled up
+        """
+        arrays: dict[str, np.ndarray] = {
+            "time_slices": np.asarray(self.counts.index, dtype="datetime64[ns]"),
+            "n_tweets": self.counts["n_tweets"].to_numpy(dtype=np.int64),
+            "n_tweeters": self.counts["n_tweeters"].to_numpy(dtype=np.int64),
+        }
+        metadata: dict[str, Any] = {
+            "class": qualified_name(type(self)),
+            "time_slice_column": self.time_slice_column,
+            "time_aggregation": str(self.time_aggregation),
+            "relative_error": self.relative_error,
+            "cross_sections": (
+                [str(dem) for dem in self.cross_sections]
+                if self.cross_sections is not None
+                else None
+            ),
+            "demographic_labels": {},
+            "cross_section_labels": [
+                labels.tolist() for labels in self.cross_section_labels
+            ],
+            "user_demographic_labels": None,
+        }
+        for dem in Demographic:
+            arrays[f"demographic.{dem}"] = self.demographic_arrays[dem]
+            metadata["demographic_labels"][str(dem)] = self.demographic_labels[
+                dem
+            ].tolist()
+        if self.cross_sections_array is not None:
+            arrays["cross_sections"] = self.cross_sections_array
+        if (
+            include_user_data
+            and self.user_slices is not None
+            and self.user_demographics is not None
+        ):
+            for column in ["created_at", "userid", "tweet_count"]:
+                arrays[f"user_slices.{column}"] = self.user_slices[column].to_numpy()
+            arrays["user_demographics.userid"] = self.user_demographics[
+                "userid"
+            ].to_numpy()
+            metadata["user_demographic_labels"] = {}
+            for dem in Demographic:
+                values = self.user_demographics[dem].astype("category")
+                arrays[f"user_demographics.{dem}"] = values.cat.codes.to_numpy()
+                metadata["user_demographic_labels"][
+                    str(dem)
+                ] = values.cat.categories.tolist()
+        arrays["metadata"] = np.frombuffer(
+            ujson.dumps(metadata).encode(), dtype=np.uint8
+        )
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> TimeSlicedUserDemographicAggregation:
+        """
+        Rebuild an aggregation serialized by `to_bytes`, as an instance of the same
+        class.
+
+        Raises:
+        ValueError: If the data is not a serialized aggregation
+        """
+        with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        metadata = ujson.loads(arrays.pop("metadata").tobytes())
+        cls = aggregation_class_named(metadata["class"])
+        aggregation = cls.__new__(cls)
+        aggregation.time_slice_column = metadata["time_slice_column"]
+        aggregation.time_aggregation = TimeAggregation(metadata["time_aggregation"])
+        aggregation.relative_error = metadata["relative_error"]
+        aggregation.cross_sections = (
+            [Demographic(dem) for dem in metadata["cross_sections"]]
+            if metadata["cross_sections"] is not None
+            else None
+        )
+        aggregation.counts = pd.DataFrame(
+            {"n_tweets": arrays["n_tweets"], "n_tweeters": arrays["n_tweeters"]},
+            index=pd.DatetimeIndex(
+                arrays["time_slices"], name=aggregation.time_slice_column
+            ),
+        )
+        aggregation.demographic_labels = {
+            dem: pd.Index(metadata["demographic_labels"][str(dem)])
+            for dem in Demographic
+        }
+        aggregation.demographic_arrays = {
+            dem: arrays[f"demographic.{dem}"] for dem in Demographic
+        }
+        aggregation.cross_section_labels = [
+            pd.Index(labels) for labels in metadata["cross_section_labels"]
+        ]
+        aggregation.cross_sections_array = arrays.get("cross_sections")
+        aggregation.user_slices = None
+        aggregation.user_demographics = None
+        user_demographic_labels = metadata["user_demographic_labels"]
+        if user_demographic_labels is not None:
+            aggregation.user_slices = pd.DataFrame(
+                {
+                    column: arrays[f"user_slices.{column}"]
+                    for column in ["created_at", "userid", "tweet_count"]
+                }
+            )
+            aggregation.user_demographics = pd.DataFrame(
+                {
+                    "userid": arrays["user_demographics.userid"],
+                    **{
+                        dem: pd.Categorical.from_codes(
+                            arrays[f"user_demographics.{dem}"],
+                            categories=user_demographic_labels[str(dem)],
+                        )
+                        for dem in Demographic
+                    },
+                }
             )
+        return aggregation
+
+
+def reported_cells(
+    array: np.ndarray,
+    demographics: list[Demographic],
+    labels: list[pd.Index],
+    explicit_zeros: bool,
+) -> np.ndarray:
+    """
+    Find which cells of a dense count array are reported in a list of results: all
+    non-zero, uncensored counts, and with explicit zeros, every combination of API
+    values.
+    """
+    if not explicit_zeros:
+        return array > 0
+    listed = np.ones(array.shape[1:], dtype=bool)
+    for axis, (dem, dem_labels) in enumerate(zip(demographics, labels)):
+        shape = [1] * len(labels)
+        shape[axis] = len(dem_labels)
+        listed = listed & np.asarray(dem_labels.isin(dem.values())).reshape(shape)
+    return listed | (array > 0)
+
+
+def union_labels(demographic: Demographic, labels: Iterable[pd.Index]) -> pd.Index:
+    """
+    Combine the labels of a demographic's axis in several dense count arrays, with
+    the demographic's API values first.
+    """
+    return pd.Index(
+        demographic_categorical(
+            demographic,
+            np.concatenate([axis_labels.to_numpy() for axis_labels in labels]),
+        ).categories
+    )
+
+
+def realign_counts(
+    array: np.ndarray, labels: list[pd.Index], new_labels: list[pd.Index]
+) -> np.ndarray:
+    """
+    Move the counts of a dense count array to the positions of the same labels
+    among other labels. Labels missing from the original count zero.
+    """
+    if all(old.equals(new) for old, new in zip(labels, new_labels)):
+        return array
+    realigned = np.zeros((len(array), *map(len, new_labels)), dtype=array.dtype)
+    realigned[
+        np.ix_(
+            np.arange(len(array)),
+            *(new.get_indexer(old) for old, new in zip(labels, new_labels)),
+        )
+    ] = array
+    return realigned
+
+
+def count_labels(demographic: Demographic, table: pd.Series) -> pd.Index:
+    """
+    Find the labels of a demographic's axis in a dense count array: its list of API
+    values, then any other labels in a count table.
+    """
+    if len(table) == 0:
+        return pd.Index(demographic.values())
+    level = table.index.get_level_values(demographic)
+    if isinstance(level, pd.CategoricalIndex):
+        return pd.Index(level.categories)
+    return pd.Index(demographic_categorical(demographic, level).categories)
+
+
+def dense_counts(
+    table: pd.Series, time_slices: pd.Index, labels: list[pd.Index]
+) -> np.ndarray:
+    """
+    Convert a count table, indexed by time slice and demographic values, into a
+    dense array shaped (time slices, values of the first demographic, ...).
+    Combinations missing from the table count zero.
+    """
+    array = np.zeros((len(time_slices), *map(len, labels)), dtype=np.int64)
+    if len(table) > 0:
+        positions = tuple(
+            axis_labels.get_indexer(table.index.get_level_values(level))
+            for level, axis_labels in enumerate([time_slices, *labels])
+        )
+        array[positions] = table.to_numpy(dtype=np.int64)
+    return array
+
+
+def json_cells(
+    array: np.ndarray, cells: np.ndarray, prefixes: np.ndarray, suffix: str
+) -> list[str]:
+    """
+    Serialize the reported cells of a dense count array, per time slice, as
+    comma-separated `prefix + count + suffix` strings. Censored counts are zeros.
+    """
+    counts = np.where(array == CENSORED_COUNT, 0, array).astype(str)
+    texts = np.char.add(np.char.add(prefixes, counts), suffix)
+    return [",".join(texts[i][cells[i]].tolist()) for i in range(len(array))]
+
 
-        return demographic_distributions, cross_sections_table
+def format_time_slice(time_slice: Any) -> str:
+    """
+    Format the start of a time slice the way Flask's JSON encoder does.
+    """
+    if isinstance(time_slice, datetime):
+        return http_date(time_slice)
+    return str(time_slice)
+
+
+def reported_counts(array: np.ndarray) -> np.ndarray:
+    """
+    Replace censored counts of a dense count array with None.
+    """
+    counts = array.astype(object)
+    counts[array == CENSORED_COUNT] = None
+    return counts
+
+
+def uncensored_count(count: np.int64) -> int:
+    """
+    Convert a dense array count into its JSON value in a list of results, 0 if
+    censored, as if the count was left out.
+    """
+    return 0 if count == CENSORED_COUNT else int(count)
+
+
+def qualified_name(cls: type) -> str:
+    """
+    Name a class by its module and qualified name.
+    """
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def aggregation_class_named(name: str) -> type[TimeSlicedUserDemographicAggregation]:
+    """
+    Find the aggregation class (TimeSlicedUserDemographicAggregation or one of its
+    subclasses) with a qualified name. Only classes that are already imported are
+    found.
+
+    Raises:
+    ValueError: If no such aggregation class is imported
+    """
+    classes: list[type[TimeSlicedUserDemographicAggregation]] = [
+        TimeSlicedUserDemographicAggregation
+    ]
+    while len(classes) > 0:
+        cls = classes.pop()
+        if qualified_name(cls) == name:
+            return cls
+        classes.extend(cls.__subclasses__())
+    raise ValueError(f"Unknown aggregation class '{name}'")
@@ -4,12 +4,12 @@ Module for API-specific utilities.
 from __future__ import annotations
 
 from datetime import date
+from typing import Optional, Sequence, Tuple, cast
 
 import numpy as np
 import pandas as pd
 
-from .api_values import Demographic
-from .data_utils import fill_record_counts, fill_value_counts
+from .api_values import AGE_BUCKET_EDGES, MISSING_CODE, Demographic, ResponseFormat
 
 
 def int_or_nan(num) -> int:
@@ -45,62 +45,82 @@ def demographic_from_name(name: str) -> Demographic:
     raise ValueError(f"Name '{name}' is not a recognized demographic")
 
 
-def censor_table(table: pd.Series, min_displayed_count: int) -> pd.Series:
+def response_format_from_name(name: str) -> Optional[ResponseFormat]:
     """
-    Remove all values of a numeric column under a display threshold.
+    Translate the name of a response format to the ResponseFormat enumeration.
+    Returns None if the name is not a response format.
     """
+    try:
+        return ResponseFormat(name)
+    except ValueError:
+        return None
+
+
+def numeric_userids(userids) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert Twitter user IDs to int64, skipping IDs that are not numeric.
+
+    Returns:
+    The converted IDs, and the positions of the IDs they were converted from
+    """
+    userids = pd.Series(userids)
+    if pd.api.types.is_integer_dtype(userids.dtype):
+        return userids.to_numpy(dtype=np.int64), np.arange(len(userids))
+    userids = userids.astype(str)
+    numeric = userids.str.fullmatch(r"[0-9]+").to_numpy(dtype=bool)
+    return userids[numeric].astype(np.int64).to_numpy(), np.flatnonzero(numeric)
+
 
-    def censor_function(count):
-        return -1 if count < min_displayed_count else count
+def demographic_categorical(demographic: Demographic, values) -> pd.Categorical:
+    """
+    Convert demographic values to a Categorical over the demographic's list of API
+    values. Values that are not in that list are kept, as extra categories after
+    the API values.
+    """
+    categories = demographic.values()
+    observed = pd.unique(pd.Series(values).dropna())
+    extra = sorted(set(observed) - set(categories))
+    return pd.Categorical(values, categories=[*categories, *extra])
 
-    table = table.apply(censor_function).replace(-1, None).dropna()
 
-    return table
+def encode_demographic(demographic: Demographic, values) -> np.ndarray:
+    """
+    Encode demographic values as their positions in the demographic's list of API
+    values. Values that are not in that list are encoded as MISSING_CODE.
+    """
+    codes = pd.Categorical(values, categories=demographic.values()).codes
+    return np.where(codes < 0, MISSING_CODE, codes).astype(np.uint8)
 
 
-def fill_zeros(results):
+def decode_demographic(demographic: Demographic, codes: np.ndarray) -> np.ndarray:
+    """
+    Decode positions in a demographic's list of API values back to the values.
+    MISSING_CODE is decoded as None.
     """
-    Add explicit zeros to a data response.
+    values = np.array([*demographic.values(), None], dtype=object)
+    return values[np.minimum(codes, len(values) - 1)]
 
-    Parameters:
-    results: Data response
+
+def categorize_ages(ages) -> pd.Categorical:
+    """
+    Bucket ages into age categories, found in api_values.py, in one vectorized
+    operation. Missing and non-numeric ages are bucketed as "Unknown".
 
     Returns:
-    Equivalent data response with explicit zeros
-    """
-    filled_results = []
-
-    for period in results:
-        filled_period = period.copy()
-        for dem in Demographic:
-            filled_period[dem] = fill_value_counts(
-                filled_period[dem], all_values=Demographic.values(dem)
-            )
-        if "groups" in period:
-            group_by = [
-                field
-                for field in filled_period["groups"][0].keys()
-                if not field == "count"
-            ]
-            filled_period["groups"] = fill_record_counts(
-                filled_period["groups"],
-                values_mapping={dem: Demographic.values(dem) for dem in group_by},
-            )
-        filled_results.append(filled_period)
-    return filled_results
+    Categorical of age buckets, with the age categories as its categories
+    """
+    categories = Demographic.AGE.values()
+    ages = pd.to_numeric(pd.Series(ages), errors="coerce").to_numpy(dtype=float)
+    codes = np.where(
+        np.isnan(ages),
+        categories.index("Unknown"),
+        np.digitize(ages, AGE_BUCKET_EDGES),
+    )
+    return pd.Categorical.from_codes(cast(Sequence[int], codes), categories=categories)
 
 
 def categorize_age(age: int) -> str:
     """
-    Bucket ages into age categories, found in api_values.py.
+    Bucket a single age into an age category. See `categorize_ages`.
     """
-    if np.isnan(age):
-        category = "Unknown"
-    elif age < 30:
-        category = "under 30"
-    elif age >= 70:
-        category = "70+"
-    else:
-        category = str(10 * int(age / 10)) + " - " + str(10 + 10 * int(age / 10))
-
-    return category
+    return categorize_ages([age])[0]
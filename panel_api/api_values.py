@@ -2,6 +2,8 @@
 
 from enum import Enum
 
+from pandas.tseries.frequencies import is_subperiod  # type: ignore[attr-defined]
+
 
 class Demographic(str, Enum):
     """
@@ -41,6 +43,32 @@ class TimeAggregation(str, Enum):
         """
         return AGG_TO_ROUND_KEY[self]
 
+    def calendar_interval(self):
+        """
+        Return the Elasticsearch calendar interval for this aggregation.
+        """
+        return AGG_TO_CALENDAR_INTERVAL[self]
+
+    def is_finer_than(self, other):
+        """
+        Return whether every time slice of another aggregation is made of whole time
+        slices of this one.
+        """
+        return self != other and is_subperiod(self.round_key(), other.round_key())
+
+
+class ResponseFormat(str, Enum):
+    """
+    Layouts of the response data of the keyword search endpoint.
+    """
+
+    RECORDS = "records"
+    COLUMNAR = "columnar"
+    ARROW = "arrow"
+
+    def __str__(self):
+        return self.value
+
 
 AGG_TO_ROUND_KEY = {
     TimeAggregation.DAY: "D",
@@ -48,6 +76,21 @@ AGG_TO_ROUND_KEY = {
     TimeAggregation.MONTH: "M",
 }
 
+AGG_TO_CALENDAR_INTERVAL = {
+    TimeAggregation.DAY: "day",
+    TimeAggregation.WEEK: "week",
+    TimeAggregation.MONTH: "month",
+}
+
+# Code of a demographic value that is not in its list of values, in uint8 encodings
+MISSING_CODE = 255
+
+# Count reported in place of a count below the display threshold
+CENSORED_COUNT = -1
+
+# Lower age of each age category after "under 30", in the order of its values
+AGE_BUCKET_EDGES = [30, 40, 50, 60, 70]
+
 DEMOGRAPHIC_VALUES = {
     Demographic.RACE: [
         "Caucasian",
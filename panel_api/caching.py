@@ -0,0 +1,329 @@
+"""
+Module for caches shared by the requests a worker process handles, either in
+process or on disk, shared by every worker.
+"""
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from enum import Enum
+from typing import Any, Generic, Hashable, Iterable, Mapping, Optional, TypeVar, Union
+
+from flask import Flask, current_app
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Thread-safe mapping bounded to a maximum number of entries, and optionally to a
+    maximum total size of its values. When full, the least recently used entries
+    are evicted. Entries may also expire after a time to live.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        """
+        Create an empty cache.
+
+        Parameters:
+        max_entries: Maximum number of entries kept
+        ttl: Optional. Seconds after which an entry expires
+        max_bytes: Optional. Maximum total size of the values kept, as measured by
+            `sys.getsizeof`. Values larger than this are not cached
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: Iterable[K]) -> dict[K, V]:
+        """
+        Look up several keys at once. Returns the cached entries, and leaves out
+        keys that missed.
+        """
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] < now:
+                    self._pop(key)
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self._entries.move_to_end(key)
+                found[key] = entry[1]
+        return found
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        """Look up a single key."""
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, entries: Mapping[K, V]) -> None:
+        """Add or replace several entries at once."""
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            for key, value in entries.items():
+                self._pop(key)
+                if self.max_bytes is not None:
+                    size = sys.getsizeof(value)
+                    if size > self.max_bytes:
+                        continue
+                    self._bytes += size
+                self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                self._pop(next(iter(self._entries)))
+
+    def set(self, key: K, value: V) -> None:
+        """Add or replace a single entry."""
+        self.set_many({key: value})
+
+    def invalidate(self, keys: Optional[Iterable[K]] = None) -> None:
+        """
+        Drop entries from the cache.
+
+        Parameters:
+        keys: Optional. Keys to drop. If not given, every entry is dropped
+        """
+        with self._lock:
+            if keys is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            for key in keys:
+                self._pop(key)
+
+    def _pop(self, key: K) -> None:
+        # Drop an entry if present, with the lock held
+        entry = self._entries.pop(key, None)
+        if entry is not None and self.max_bytes is not None:
+            self._bytes -= sys.getsizeof(entry[1])
+
+    def stats(self) -> dict[str, Any]:
+        """Summarize the usage of this cache, for monitoring."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes if self.max_bytes is not None else None,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups > 0 else None,
+            }
+
+
+class DiskCache:
+    """
+    Cache of bytes by string key in a SQLite database, shared by every process that
+    opens the same file. When full, the least recently used entries are evicted.
+    Entries may also expire after a time to live.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        """
+        Open a cache, creating its database if needed.
+
+        Parameters:
+        path: Path of the SQLite database file
+        max_entries: Maximum number of entries kept
+        ttl: Optional. Seconds after which an entry expires
+        max_bytes: Optional. Maximum total size of the values kept. Values larger
+            than this are not cached
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, expires REAL, accessed REAL, value BLOB)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per operation, since connections can't be shared by threads
+        # or forked processes
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str, default: Optional[bytes] = None) -> Optional[bytes]:
+        """Look up a single key."""
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            row = connection.execute(
+                "SELECT value FROM entries WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+                )
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return row[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        """Add or replace a single entry, and evict expired and excess entries."""
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else float("inf")
+        with closing(self._connect()) as connection, connection:
+            if self.max_bytes is not None and len(value) > self.max_bytes:
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, expires, now, value),
+            )
+            connection.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+            connection.execute(
+                "DELETE FROM entries WHERE key IN ("
+                "SELECT key FROM entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            if self.max_bytes is not None:
+                connection.execute(
+                    "DELETE FROM entries WHERE key IN (SELECT key FROM ("
+                    "SELECT key, sum(length(value)) OVER ("
+                    "ORDER BY accessed DESC, key ROWS UNBOUNDED PRECEDING) AS total "
+                    "FROM entries) WHERE total > ?)",
+                    (self.max_bytes,),
+                )
+
+    def invalidate(self, keys: Optional[Iterable[str]] = None) -> None:
+        """
+        Drop entries from the cache.
+
+        Parameters:
+        keys: Optional. Keys to drop. If not given, every entry is dropped
+        """
+        with closing(self._connect()) as connection, connection:
+            if keys is None:
+                connection.execute("DELETE FROM entries")
+            else:
+                connection.executemany(
+                    "DELETE FROM entries WHERE key = ?", [(key,) for key in keys]
+                )
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Summarize the usage of this cache, for monitoring. Hits and misses are
+        counted by this process only.
+        """
+        with closing(self._connect()) as connection:
+            entries, total_bytes = connection.execute(
+                "SELECT COUNT(*), coalesce(sum(length(value)), 0) FROM entries"
+            ).fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "bytes": total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups > 0 else None,
+            }
+
+
+class CacheBackend(str, Enum):
+    """
+    Where query results are cached.
+    """
+
+    NONE = "none"
+    MEMORY = "memory"
+    DISK = "disk"
+
+    def __str__(self):
+        return self.value
+
+
+ResultCache = Union[LRUCache[str, bytes], DiskCache]
+
+
+def init_app(app: Flask) -> None:
+    """Attach the caches configured for a Flask application to it."""
+    voters_config = app.config["VOTERS"]
+    cache_size = voters_config.get("CACHE_SIZE", 100000)
+    app.extensions["demographic_cache"] = (
+        LRUCache(cache_size, ttl=voters_config.get("CACHE_TTL", 3600))
+        if cache_size > 0
+        else None
+    )
+
+    results_config = app.config["RESULT_CACHE"]
+    backend = CacheBackend(results_config.get("BACKEND", CacheBackend.NONE))
+    results_size = results_config.get("SIZE", 1000)
+    results_ttl = results_config.get("TTL", 3600)
+    results_bytes = results_config.get("MAX_BYTES")
+    results_cache: Optional[ResultCache] = None
+    if backend == CacheBackend.MEMORY:
+        results_cache = LRUCache(results_size, ttl=results_ttl, max_bytes=results_bytes)
+    elif backend == CacheBackend.DISK:
+        # Must not depend on the working directory, which may be shared or writable
+        # by others
+        path = results_config.get("PATH")
+        if path is None or not os.path.isabs(path):
+            raise ValueError(
+                "RESULT_CACHE PATH must be an absolute path with the disk backend"
+            )
+        results_cache = DiskCache(
+            path, results_size, ttl=results_ttl, max_bytes=results_bytes
+        )
+    app.extensions["result_cache"] = results_cache
+
+
+def demographic_cache() -> Optional[LRUCache]:
+    """
+    Provide this worker's cache of demographics by Twitter user ID, if enabled.
+    """
+    return current_app.extensions.get("demographic_cache")
+
+
+def result_cache() -> Optional[ResultCache]:
+    """
+    Provide the cache of serialized query results by query key, if enabled.
+    """
+    return current_app.extensions.get("result_cache")
+
+
+def cache_stats() -> dict[str, Any]:
+    """Provide usage statistics of this worker's caches."""
+    return {
+        name: cache.stats() if cache is not None else None
+        for name, cache in [
+            ("demographics", demographic_cache()),
+            ("results", result_cache()),
+        ]
+    }
@@ -0,0 +1,153 @@
+"""
+Command line interface for maintaining the data behind the API. Commands run
+with the application's configuration, including the `API_CONFIG` file.
+"""
+from typing import Any, Optional
+
+import click
+from flask import current_app
+from flask.cli import FlaskGroup
+
+from . import create_app
+from .api_utils import categorize_ages
+from .api_values import Demographic
+from .es_utils import elastic_enrich_tweets
+from .ingest import ingest_tweets, ingest_voters, read_ndjson
+from .snapshot import VoterSnapshot
+from .source.voters import DemographicSource
+from .sql_utils import migrate_voter_demographics, stream_all_voter_demographics
+
+
+@click.group(cls=FlaskGroup, create_app=create_app)
+def cli():
+    """Manage the Twitter panel API."""
+
+
+@cli.group()
+def snapshot():
+    """Manage the demographic snapshot of the voters table."""
+
+
+@snapshot.command("build")
+@click.option(
+    "--output",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory to write the snapshot to. Defaults to VOTERS.SNAPSHOT_PATH.",
+)
+def build_snapshot(output: Optional[str]):
+    """Rebuild the demographic snapshot from the PostgreSQL voters table."""
+    path = output or current_app.config["VOTERS"]["SNAPSHOT_PATH"]
+    voters = stream_all_voter_demographics()
+    voters[Demographic.AGE] = categorize_ages(voters[Demographic.AGE])
+    voter_snapshot = VoterSnapshot.from_voters(voters)
+    voter_snapshot.save(path)
+    click.echo(f"Wrote a snapshot of {len(voter_snapshot)} voters to {path}")
+
+
+@cli.group()
+def voters():
+    """Manage the PostgreSQL voters tables."""
+
+
+@voters.command("migrate")
+def migrate_voters():
+    """
+    Create and fill the normalized voter_demographics table from the voters table,
+    for VOTERS.SCHEMA "normalized".
+    """
+    count = migrate_voter_demographics()
+    click.echo(f"Wrote the demographics of {count} voters to voter_demographics")
+
+
+@cli.group()
+def enrich():
+    """Denormalize voter demographics into other data."""
+
+
+@enrich.command("tweets")
+@click.option(
+    "--all",
+    "enrich_all",
+    is_flag=True,
+    help="Enrich every tweet again, not only those that have not been enriched.",
+)
+@click.option(
+    "--page-size",
+    type=int,
+    default=10000,
+    show_default=True,
+    help="Number of tweets read and updated at a time.",
+)
+def enrich_tweets(enrich_all: bool, page_size: int):
+    """
+    Write the demographics of each tweet's user onto the tweets index, for queries
+    with TWEETS.RETRIEVAL set to "enriched".
+    """
+
+    def lookup(userids: list[str]) -> dict[str, dict[str, Any]]:
+        voters = DemographicSource().get_demographics(userids)
+        voters = voters[["userid", *Demographic]].astype(object)
+        voters = voters.where(voters.notna(), None)
+        return {
+            str(row[0]): {str(dem): value for dem, value in zip(Demographic, row[1:])}
+            for row in voters.itertuples(index=False, name=None)
+        }
+
+    n_tweets, n_enriched = 0, 0
+    for page_tweets, page_enriched in elastic_enrich_tweets(
+        lookup, only_missing=not enrich_all, page_size=page_size
+    ):
+        n_tweets += page_tweets
+        n_enriched += page_enriched
+    click.echo(f"Updated {n_tweets} tweets, {n_enriched} of them by users in the panel")
+
+
+@cli.group()
+def ingest():
+    """Load data dumps into the API's backends."""
+
+
+@ingest.command("tweets")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(dir_okay=False))
+@click.option(
+    "--chunk-size",
+    type=int,
+    default=500,
+    show_default=True,
+    help="Number of tweets per bulk request.",
+)
+@click.option(
+    "--threads",
+    type=int,
+    default=4,
+    show_default=True,
+    help="Number of bulk requests sent concurrently.",
+)
+def ingest_tweets_command(paths: tuple[str, ...], chunk_size: int, threads: int):
+    """
+    Index newline-delimited JSON dumps of tweets (optionally gzipped) into the
+    tweets index.
+    """
+    report = ingest_tweets(
+        read_ndjson(paths), chunk_size=chunk_size, thread_count=threads
+    )
+    click.echo(f"Indexed {report}")
+
+
+@ingest.command("voters")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(dir_okay=False))
+@click.option(
+    "--batch-size",
+    type=int,
+    default=100000,
+    show_default=True,
+    help="Number of voters copied at a time.",
+)
+def ingest_voters_command(paths: tuple[str, ...], batch_size: int):
+    """
+    Copy newline-delimited JSON dumps of voters (optionally gzipped) into the
+    voters table.
+    """
+    report = ingest_voters(read_ndjson(paths), batch_size=batch_size)
+    click.echo(f"Copied {report}")
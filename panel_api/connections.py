@@ -1,21 +1,159 @@
 """
 Module for managing database connections for the application.
 """
-import psycopg2
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, Mapping, Optional, Tuple
+
 from elasticsearch import Elasticsearch
-from flask import current_app
+from flask import Flask, current_app
 from psycopg2 import extensions
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+
+class Connections:
+    """
+    Connection pools shared by all requests handled by one worker process.
+
+    Pools are created on first use and recreated if the process has been forked
+    since, so that a server preloading the application never shares sockets
+    between its workers. Threads wait for a PostgreSQL connection to be returned
+    when every connection of the pool is checked out, for up to
+    DATABASE_POOL_TIMEOUT seconds.
+    """
+
+    def __init__(self, config: Mapping[str, Any]):
+        self.config = config
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._elasticsearch: Optional[Elasticsearch] = None
+        self._postgresql_pool: Optional[ThreadedConnectionPool] = None
+        self._postgresql_slots: Optional[threading.BoundedSemaphore] = None
+        self._postgresql_in_use = 0
+        self._postgresql_checkouts = 0
+
+    def _check_process(self) -> None:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._elasticsearch = None
+            self._postgresql_pool = None
+            self._postgresql_slots = None
+            self._postgresql_in_use = 0
+            self._postgresql_checkouts = 0
+
+    def elasticsearch(self) -> Elasticsearch:
+        """Provide the shared client of the Elasticsearch cluster."""
+        with self._lock:
+            self._check_process()
+            if self._elasticsearch is None:
+                self._elasticsearch = Elasticsearch(
+                    [self.config.get("ELASTICSEARCH_URL")],
+                    maxsize=self.config.get("ELASTICSEARCH_POOL_SIZE", 10),
+                )
+            return self._elasticsearch
+
+    def _postgresql_pool_for_process(
+        self,
+    ) -> Tuple[ThreadedConnectionPool, threading.BoundedSemaphore]:
+        with self._lock:
+            self._check_process()
+            if self._postgresql_pool is None or self._postgresql_slots is None:
+                pool_size = self.config.get("DATABASE_POOL_SIZE", 10)
+                self._postgresql_pool = ThreadedConnectionPool(
+                    1, pool_size, self.config.get("DATABASE_URL")
+                )
+                # The pool raises instead of waiting when it is exhausted
+                self._postgresql_slots = threading.BoundedSemaphore(pool_size)
+            return self._postgresql_pool, self._postgresql_slots
+
+    @contextmanager
+    def postgresql(self) -> Iterator[extensions.connection]:
+        """
+        Check a connection out of the PostgreSQL pool for the duration of the
+        context. The transaction is committed if the context exits normally, and
+        rolled back otherwise, before the connection is returned to the pool.
+
+        Raises:
+        PoolError: If no connection was returned to the pool in time
+        """
+        pool, slots = self._postgresql_pool_for_process()
+        if not slots.acquire(timeout=self.config.get("DATABASE_POOL_TIMEOUT", 30)):
+            raise PoolError("Timed out waiting for a PostgreSQL connection")
+        try:
+            conn = pool.getconn()
+        except BaseException:
+            slots.release()
+            raise
+        with self._lock:
+            self._postgresql_in_use += 1
+            self._postgresql_checkouts += 1
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            with self._lock:
+                self._postgresql_in_use -= 1
+            pool.putconn(conn)
+            slots.release()
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Summarize the state of the connection pools, for monitoring.
+        """
+        with self._lock:
+            self._check_process()
+            nodes = []
+            if self._elasticsearch is not None:
+                connection_pool = self._elasticsearch.transport.connection_pool
+                for connection in connection_pool.connections:
+                    http_pool = getattr(connection, "pool", None)
+                    nodes.append(
+                        {
+                            "host": getattr(connection, "host", None),
+                            "connections": getattr(http_pool, "num_connections", None),
+                            "requests": getattr(http_pool, "num_requests", None),
+                        }
+                    )
+            return {
+                "pid": self._pid,
+                "elasticsearch": {
+                    "pool_size": self.config.get("ELASTICSEARCH_POOL_SIZE", 10),
+                    "nodes": nodes,
+                },
+                "postgresql": {
+                    "pool_size": self.config.get("DATABASE_POOL_SIZE", 10),
+                    "open": self._postgresql_pool is not None,
+                    "in_use": self._postgresql_in_use,
+                    "checkouts": self._postgresql_checkouts,
+                },
+            }
+
+
+def init_app(app: Flask) -> None:
+    """Attach connection management to a Flask application."""
+    app.extensions["connections"] = Connections(app.config)
+
+
+def _connections() -> Connections:
+    return current_app.extensions["connections"]
 
 
 def elasticsearch_connection() -> Elasticsearch:
     """Provide a connection to the Elasticsearch cluster."""
-    host = current_app.config.get("ELASTICSEARCH_URL")
-    es_handle = Elasticsearch([host])
-    return es_handle
+    return _connections().elasticsearch()
+
+
+@contextmanager
+def postgresql_connection() -> Iterator[extensions.connection]:
+    """Provide a pooled connection to the PostgreSQL database."""
+    with _connections().postgresql() as conn:
+        yield conn
 
 
-def postgresql_connection() -> extensions.connection:
-    """Provide a connection to the PostgreSQL database."""
-    url = current_app.config.get("DATABASE_URL")
-    conn: extensions.connection = psycopg2.connect(url)
-    return conn
+def connection_stats() -> dict[str, Any]:
+    """Provide connection pool statistics of this worker process."""
+    return _connections().stats()
@@ -1,8 +1,13 @@
 """
 Main Flask application endpoints file. Creates the Flask app on import.
 """
-from flask import Blueprint, current_app, request
+import ujson
+from flask import Blueprint, current_app, jsonify, request
 
+from panel_api.api_utils import response_format_from_name
+from panel_api.api_values import ResponseFormat
+from panel_api.caching import cache_stats
+from panel_api.connections import connection_stats
 from panel_api.query.keyword_query import KeywordQuery
 
 public_api = Blueprint("public_api", __name__)
@@ -19,14 +24,62 @@ def keyword_search():
     query = KeywordQuery.from_raw_query(
         request_json, max_cross_sections=current_app.config.get("MAX_CROSS_SECTIONS")
     )
-    if query is not None:
-        results = (
-            query.execute().censor(current_app.config["MIN_DISPLAYED_USERS"]).to_list()
+    response_format = response_format_from_name(
+        request_json.get("format", ResponseFormat.RECORDS)
+    )
+    if query is not None and response_format is not None:
+        aggregation, cache_hit = query.execute_cached()
+        results = aggregation.censor(current_app.config["MIN_DISPLAYED_USERS"])
+        # Approximate results come with the relative standard error of their counts
+        error_fields = (
+            {"relative_error": results.relative_error}
+            if results.relative_error is not None
+            else {}
         )
-        return {"query": request_json, "response_data": results}
+        if response_format == ResponseFormat.ARROW:
+            response = current_app.response_class(
+                results.to_arrow(
+                    metadata={
+                        "query": ujson.dumps(request_json),
+                        **{name: str(value) for name, value in error_fields.items()},
+                    }
+                ),
+                mimetype="application/vnd.apache.arrow.stream",
+            )
+        elif response_format == ResponseFormat.COLUMNAR:
+            response = jsonify(
+                query=request_json,
+                response_data=results.to_columnar(),
+                **error_fields,
+            )
+        else:
+            response_data = results.to_json(
+                explicit_zeros=current_app.config.get("EXPLICIT_ZEROS", False)
+            )
+            response = current_app.response_class(
+                f'{{"query":{ujson.dumps(request_json)},'
+                f'"response_data":{response_data}'
+                + "".join(
+                    f',"{name}":{ujson.dumps(value)}'
+                    for name, value in error_fields.items()
+                )
+                + "}",
+                mimetype="application/json",
+            )
+        response.headers["X-Cache"] = "HIT" if cache_hit else "MISS"
+        return response
 
     message = "invalid query"
     return {
         "query": request_json,
         "response_data": message,
     }
+
+
+@public_api.route("/stats", methods=["GET"])
+def stats():
+    """
+    Report the resource usage of the worker process handling the request, for
+    monitoring.
+    """
+    return {"connections": connection_stats(), "caches": cache_stats()}
@@ -1,44 +1,394 @@
 """
 Module for interacting with an Elasticsearch backend.
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from typing import Optional
+from typing import Any, Callable, Iterable, Iterator, Mapping, Optional
 
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import ScanError, streaming_bulk
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import Match, Range
 
+from .api_values import Demographic
 from .connections import elasticsearch_connection
+from .helpers import batched
 
+# Field of tweet documents telling whether their user is in the panel, written along
+# with the user's demographics by `elastic_enrich_tweets`
+ENRICHED_FIELD = "panel_member"
 
-def elastic_query_for_keyword(
-    keyword: str, before: Optional[date] = None, after: Optional[date] = None
-):
-    """
-    Given a string (keyword), return all tweets in the tweets index that contain
-    that string.
+# Maximum number of values of a demographic returned by a terms aggregation
+DEMOGRAPHIC_TERMS_SIZE = 1000
 
-    Return as raw ES output.
+# Distinct counts below this are close to exact in a cardinality aggregation (the
+# maximum Elasticsearch allows)
+CARDINALITY_PRECISION_THRESHOLD = 40000
+
+# Relative standard error of cardinality estimates above the precision threshold.
+# Elasticsearch then counts with HyperLogLog++ sketches of 2 ** 18 registers
+CARDINALITY_RELATIVE_ERROR = 1.04 / 2**9
+
+
+def _keyword_search(
+    es_handle: Elasticsearch,
+    keyword: str,
+    before: Optional[date] = None,
+    after: Optional[date] = None,
+) -> Search:
+    """
+    Build a search of the tweets index for a keyword over a date range.
     """
-    es_handle = elasticsearch_connection()
     search = Search(using=es_handle, index="tweets").query(Match(full_text=keyword))
     range_query = {}
     range_query.update({"lte": before.isoformat()} if before is not None else {})
     range_query.update({"gte": after.isoformat()} if after is not None else {})
     if len(range_query) > 0:
         search = search.query(Range(created_at=range_query))
-    res = (hit.to_dict() for hit in search.scan())
-    return res
+    return search
 
 
-def elastic_query_users(users: list[str]):
+def _slice(search: Search, slice_id: int, max_slices: int) -> Search:
+    """
+    Restrict a scrolled search to one of several slices, if there is more than one.
+    """
+    if max_slices > 1:
+        search = search.extra(slice={"id": slice_id, "max": max_slices})
+    return search
+
+
+def elastic_query_for_keyword(
+    keyword: str,
+    before: Optional[date] = None,
+    after: Optional[date] = None,
+    slice_id: int = 0,
+    max_slices: int = 1,
+):
     """
-    Given a list of users (as user Twitter profile IDs),
-    pull all users from ES that have an ID in the list.
+    Given a string (keyword), return all tweets in the tweets index that contain
+    that string. With more than one slice, return only the tweets of one slice of
+    the scroll, so that slices can be scrolled concurrently.
+
     Return as raw ES output.
     """
     es_handle = elasticsearch_connection()
-    search = Search(using=es_handle, index="voters").query(
-        "terms", twProfileID=[str(u) for u in users]
+    search = _slice(
+        _keyword_search(es_handle, keyword, before=before, after=after),
+        slice_id,
+        max_slices,
     )
-    res = [hit.to_dict() for hit in search.scan()]
+    res = (hit.to_dict() for hit in search.scan())
     return res
+
+
+def _scroll_pages(
+    es_handle: Elasticsearch,
+    body: dict[str, Any],
+    page_size: int,
+    filter_path: list[str],
+    scroll: str = "5m",
+) -> Iterator[list[dict[str, Any]]]:
+    """
+    Scroll through every hit of a search of the tweets index, one page at a time.
+    """
+    response = es_handle.search(
+        index="tweets",
+        body=body,
+        scroll=scroll,
+        size=page_size,
+        filter_path=["_scroll_id", "_shards.failed", *filter_path],
+    )
+    scroll_id = response.get("_scroll_id")
+    try:
+        while True:
+            if response.get("_shards", {}).get("failed", 0) > 0:
+                raise ScanError(scroll_id, "Scroll request has failed shards")
+            hits = response.get("hits", {}).get("hits", [])
+            if len(hits) == 0:
+                break
+            yield hits
+            response = es_handle.scroll(
+                body={"scroll_id": scroll_id, "scroll": scroll},
+                filter_path=["_scroll_id", "_shards.failed", *filter_path],
+            )
+            scroll_id = response.get("_scroll_id", scroll_id)
+    finally:
+        if scroll_id is not None:
+            es_handle.clear_scroll(body={"scroll_id": [scroll_id]}, ignore=(404,))
+
+
+def elastic_query_for_keyword_fields(
+    keyword: str,
+    before: Optional[date] = None,
+    after: Optional[date] = None,
+    page_size: int = 10000,
+    slice_id: int = 0,
+    max_slices: int = 1,
+) -> Iterator[list[dict[str, Any]]]:
+    """
+    Given a string (keyword), return all tweets in the tweets index that contain
+    that string, without their source documents. Only the "created_at" (in epoch
+    milliseconds) and "user.id" doc values of each tweet are retrieved. With more
+    than one slice, return only the tweets of one slice of the scroll.
+
+    Return as pages of raw ES hits.
+    """
+    es_handle = elasticsearch_connection()
+    body = (
+        _slice(
+            _keyword_search(es_handle, keyword, before=before, after=after),
+            slice_id,
+            max_slices,
+        )
+        .source(False)
+        .sort("_doc")
+        .extra(
+            docvalue_fields=[
+                {"field": "created_at", "format": "epoch_millis"},
+                "user.id",
+            ],
+            track_total_hits=False,
+        )
+        .to_dict()
+    )
+    return _scroll_pages(
+        es_handle, body, page_size=page_size, filter_path=["hits.hits.fields"]
+    )
+
+
+def elastic_aggregate_keyword(
+    keyword: str,
+    calendar_interval: str,
+    before: Optional[date] = None,
+    after: Optional[date] = None,
+    page_size: int = 10000,
+) -> Iterator[dict[str, Any]]:
+    """
+    Given a string (keyword), count the tweets in the tweets index that contain that
+    string, per user and per time slice of the calendar interval. The counting is
+    done by Elasticsearch with a composite aggregation, which is paged through until
+    every (time slice, user) pair has been returned.
+
+    Return as raw ES composite aggregation buckets. Each bucket key has a
+    "created_at" (start of the time slice, in epoch milliseconds) and a "userid".
+    """
+    es_handle = elasticsearch_connection()
+    body = (
+        _keyword_search(es_handle, keyword, before=before, after=after)
+        .extra(size=0, track_total_hits=False)
+        .to_dict()
+    )
+    composite: dict[str, Any] = {
+        "size": page_size,
+        "sources": [
+            {
+                "created_at": {
+                    "date_histogram": {
+                        "field": "created_at",
+                        "calendar_interval": calendar_interval,
+                    }
+                }
+            },
+            {"userid": {"terms": {"field": "user.id"}}},
+        ],
+    }
+    body["aggs"] = {"user_slices": {"composite": composite}}
+
+    while True:
+        response = es_handle.search(
+            index="tweets",
+            body=body,
+            filter_path=[
+                "aggregations.user_slices.after_key",
+                "aggregations.user_slices.buckets.key",
+                "aggregations.user_slices.buckets.doc_count",
+            ],
+        )
+        user_slices = response.get("aggregations", {}).get("user_slices", {})
+        buckets = user_slices.get("buckets", [])
+        yield from buckets
+        if len(buckets) == 0 or "after_key" not in user_slices:
+            break
+        composite["after"] = user_slices["after_key"]
+
+
+def elastic_query_users(
+    users: Iterable[str],
+    fields: list[str],
+    batch_size: int = 10000,
+    max_workers: int = 4,
+) -> list[dict[str, Any]]:
+    """
+    Given users (as user Twitter profile IDs), pull the users of the voters index
+    with those IDs. Voter documents must be indexed with their Twitter profile ID as
+    `_id`, so users are fetched by ID with `mget` rather than matched with a `terms`
+    query, which `index.max_terms_count` limits. IDs are sent in batches, several
+    batches at a time.
+
+    Parameters:
+    users: Twitter profile IDs to look up
+    fields: Fields of the voter documents to return
+    batch_size: Number of IDs per `mget` request
+    max_workers: Number of `mget` requests sent concurrently
+
+    Returns:
+    The requested fields of each user found, with the ID as "twProfileID"
+    """
+    # The client is thread-safe, and the pool threads have no application context
+    es_handle = elasticsearch_connection()
+
+    def get_batch(batch: list[str]) -> list[dict[str, Any]]:
+        response = es_handle.mget(
+            body={"ids": batch}, index="voters", _source_includes=fields
+        )
+        return [
+            {**doc.get("_source", {}), "twProfileID": doc["_id"]}
+            for doc in response["docs"]
+            if doc.get("found", False)
+        ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return [
+            user
+            for users_found in pool.map(
+                get_batch, batched((str(u) for u in users), batch_size)
+            )
+            for user in users_found
+        ]
+
+
+def elastic_enrich_tweets(
+    lookup: Callable[[list[str]], Mapping[str, Mapping[str, Any]]],
+    only_missing: bool = True,
+    page_size: int = 10000,
+) -> Iterator[tuple[int, int]]:
+    """
+    Write the demographics of each tweet's user onto the tweets index, so that
+    keyword queries can be aggregated by Elasticsearch (see
+    `elastic_aggregate_demographics`). Each tweet gets a keyword field per
+    demographic, named after it, and ENRICHED_FIELD, which is false for users
+    outside the panel.
+
+    Parameters:
+    lookup: Function returning the demographics of the panel members among a list
+        of Twitter user IDs, by user ID
+    only_missing: Only enrich tweets that have not been enriched yet
+    page_size: Number of tweets read, and updated in bulk, at a time
+
+    Returns:
+    The number of tweets updated, and of those of panel members, per page
+    """
+    es_handle = elasticsearch_connection()
+    es_handle.indices.put_mapping(
+        index="tweets",
+        body={
+            "properties": {
+                ENRICHED_FIELD: {"type": "boolean"},
+                **{str(dem): {"type": "keyword"} for dem in Demographic},
+            }
+        },
+    )
+    body = {
+        "query": (
+            {"bool": {"must_not": {"exists": {"field": ENRICHED_FIELD}}}}
+            if only_missing
+            else {"match_all": {}}
+        ),
+        "_source": False,
+        "sort": ["_doc"],
+        "docvalue_fields": ["user.id"],
+        "track_total_hits": False,
+    }
+    outside_panel: dict[str, Any] = {
+        ENRICHED_FIELD: False,
+        **{str(dem): None for dem in Demographic},
+    }
+    for hits in _scroll_pages(
+        es_handle,
+        body,
+        page_size=page_size,
+        filter_path=["hits.hits._index", "hits.hits._id", "hits.hits.fields"],
+    ):
+        hit_userids = [str(hit["fields"]["user.id"][0]) for hit in hits]
+        demographics = lookup(sorted(set(hit_userids)))
+        actions = (
+            {
+                "_op_type": "update",
+                "_index": hit["_index"],
+                "_id": hit["_id"],
+                "doc": (
+                    {ENRICHED_FIELD: True, **demographics[userid]}
+                    if userid in demographics
+                    else outside_panel
+                ),
+            }
+            for hit, userid in zip(hits, hit_userids)
+        )
+        for _ in streaming_bulk(es_handle, actions, chunk_size=page_size):
+            pass
+        yield len(hits), sum(userid in demographics for userid in hit_userids)
+
+
+def elastic_aggregate_demographics(
+    keyword: str,
+    calendar_interval: str,
+    cross_sections: Optional[list[Demographic]] = None,
+    before: Optional[date] = None,
+    after: Optional[date] = None,
+) -> list[dict[str, Any]]:
+    """
+    Given a string (keyword), aggregate the demographics of the panel members who
+    posted tweets containing that string, per time slice of the calendar interval.
+    This relies on the tweets having been enriched with their users' demographics
+    (see `elastic_enrich_tweets`), so no user-level data leaves Elasticsearch.
+
+    Return as raw ES date_histogram buckets. Each has the number of tweets
+    ("doc_count"), and a cardinality aggregation of the users ("users"), overall,
+    under a terms aggregation named after each demographic, and under nested terms
+    aggregations of the cross-sections' demographics, each named "cross_section".
+    """
+    es_handle = elasticsearch_connection()
+
+    def users() -> dict[str, Any]:
+        return {
+            "users": {
+                "cardinality": {
+                    "field": "user.id",
+                    "precision_threshold": CARDINALITY_PRECISION_THRESHOLD,
+                }
+            }
+        }
+
+    def terms(dem: Demographic, aggs: dict[str, Any]) -> dict[str, Any]:
+        return {
+            "terms": {"field": str(dem), "size": DEMOGRAPHIC_TERMS_SIZE},
+            "aggs": aggs,
+        }
+
+    slice_aggs = {**users(), **{str(dem): terms(dem, users()) for dem in Demographic}}
+    if cross_sections:
+        nested = users()
+        for dem in reversed(cross_sections):
+            nested = {"cross_section": terms(dem, nested)}
+        slice_aggs.update(nested)
+
+    body = (
+        _keyword_search(es_handle, keyword, before=before, after=after)
+        .filter("term", **{ENRICHED_FIELD: True})
+        .extra(size=0, track_total_hits=False)
+        .to_dict()
+    )
+    body["aggs"] = {
+        "slices": {
+            "date_histogram": {
+                "field": "created_at",
+                "calendar_interval": calendar_interval,
+                "min_doc_count": 1,
+            },
+            "aggs": slice_aggs,
+        }
+    }
+    response = es_handle.search(
+        index="tweets", body=body, filter_path=["aggregations.slices.buckets"]
+    )
+    return response.get("aggregations", {}).get("slices", {}).get("buckets", [])
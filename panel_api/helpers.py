@@ -2,7 +2,8 @@
 Helper functions for code ergonomics. Avoid putting every stray function in here.
 """
 
-from typing import Callable, Optional, TypeVar
+import itertools
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
 
 T = TypeVar("T")
 U = TypeVar("U")
@@ -15,3 +16,12 @@ def if_present(callable: Callable[[T], U], optional: Optional[T]) -> Optional[U]
     if optional is None:
         return None
     return callable(optional)
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[list[T]]:
+    """
+    Split an iterable into lists of `size` items. The last list may be shorter.
+    """
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
@@ -0,0 +1,218 @@
+"""
+Module for loading dumps of tweets into Elasticsearch, and of voters into
+PostgreSQL, as fast as the backends allow.
+"""
+import csv
+import gzip
+import io
+import time
+from contextlib import contextmanager
+from typing import IO, Any, Iterable, Iterator, Optional
+
+import ujson
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+
+from .connections import elasticsearch_connection, postgresql_connection
+from .helpers import batched
+
+# Mapping of the tweets index when it is created, so dates and user IDs are not
+# left to dynamic mapping. "created_at" is in the format of the Twitter API
+TWEETS_MAPPING = {
+    "properties": {
+        "created_at": {"type": "date", "format": "EEE MMM dd HH:mm:ss Z yyyy"},
+        "user": {"properties": {"id": {"type": "long"}}},
+    }
+}
+
+
+class IngestReport:
+    """
+    Number of documents loaded, and how long it took.
+    """
+
+    def __init__(self) -> None:
+        self.documents = 0
+        self.seconds = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Documents loaded per second."""
+        return self.documents / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.documents} documents in {self.seconds:.1f}s "
+            f"({self.rate:.0f} docs/s)"
+        )
+
+
+def open_dump(path: str) -> IO[str]:
+    """
+    Open a text dump for reading, decompressing it if its name ends with ".gz".
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def read_ndjson(paths: Iterable[str]) -> Iterator[dict[str, Any]]:
+    """
+    Read the documents of newline-delimited JSON dumps, one file after the other.
+    Blank lines are skipped.
+    """
+    for path in paths:
+        with open_dump(path) as lines:
+            for line in lines:
+                if line.strip():
+                    yield ujson.loads(line)
+
+
+@contextmanager
+def _refresh_disabled(es_handle: Elasticsearch, index: str) -> Iterator[None]:
+    """
+    Disable the periodic refresh of an index for the duration of the context, then
+    restore its refresh interval and refresh it once.
+    """
+    settings = es_handle.indices.get_settings(
+        index=index, name="index.refresh_interval"
+    )
+    previous: Optional[str] = None
+    for index_settings in settings.values():
+        previous = (
+            index_settings.get("settings", {})
+            .get("index", {})
+            .get("refresh_interval", previous)
+        )
+    es_handle.indices.put_settings(
+        index=index, body={"index": {"refresh_interval": "-1"}}
+    )
+    try:
+        yield
+    finally:
+        es_handle.indices.put_settings(
+            index=index, body={"index": {"refresh_interval": previous}}
+        )
+        es_handle.indices.refresh(index=index)
+
+
+def ingest_tweets(
+    tweets: Iterable[dict[str, Any]],
+    chunk_size: int = 500,
+    thread_count: int = 4,
+    index: str = "tweets",
+) -> IngestReport:
+    """
+    Index tweets into Elasticsearch with concurrent bulk requests. The index's
+    refresh is disabled during the load. Tweets with an "id_str" (or "id") keep it
+    as their document ID, so loading a dump again overwrites its tweets.
+
+    Parameters:
+    tweets: Tweet documents
+    chunk_size: Number of tweets per bulk request
+    thread_count: Number of bulk requests sent concurrently
+    index: Index to load the tweets into. It is created with TWEETS_MAPPING if
+        missing
+
+    Returns:
+    The number of tweets indexed, and the time taken
+    """
+    es_handle = elasticsearch_connection()
+    es_handle.indices.create(index=index, body={"mappings": TWEETS_MAPPING}, ignore=400)
+    actions = (
+        {
+            "_index": index,
+            **(
+                {"_id": str(tweet_id)}
+                if (tweet_id := tweet.get("id_str", tweet.get("id"))) is not None
+                else {}
+            ),
+            "_source": tweet,
+        }
+        for tweet in tweets
+    )
+    report = IngestReport()
+    start = time.perf_counter()
+    with _refresh_disabled(es_handle, index):
+        for _ in parallel_bulk(
+            es_handle, actions, chunk_size=chunk_size, thread_count=thread_count
+        ):
+            report.documents += 1
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def ingest_voters(
+    voters: Iterable[dict[str, Any]], batch_size: int = 100000
+) -> IngestReport:
+    """
+    Load voter documents into the PostgreSQL voters table with `COPY FROM STDIN`,
+    in a single transaction. Each voter's Twitter profile ID ("twProfileID") goes
+    in the "userid" column, and the whole document in the "data" JSON column.
+    Voters without a Twitter profile ID are skipped. Batches are copied into a
+    temporary table first, and replace the voters with the same userid, so loading
+    a dump again does not duplicate its voters. Within a batch, the last voter of
+    each userid is kept.
+
+    Parameters:
+    voters: Voter documents
+    batch_size: Number of voters buffered per COPY
+
+    Returns:
+    The number of voters loaded, and the time taken
+    """
+    report = IngestReport()
+    start = time.perf_counter()
+    with postgresql_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS voters (
+                userid varchar(255),
+                data jsonb
+            )
+            """
+        )
+        # Replacing voters looks them up by userid
+        cur.execute("CREATE INDEX IF NOT EXISTS voters_userid ON voters (userid)")
+        cur.execute(
+            """
+            CREATE TEMPORARY TABLE voters_staging (
+                position serial,
+                userid varchar(255),
+                data jsonb
+            ) ON COMMIT DROP
+            """
+        )
+        for batch in batched(
+            (voter for voter in voters if voter.get("twProfileID") is not None),
+            batch_size,
+        ):
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                (str(voter["twProfileID"]), ujson.dumps(voter)) for voter in batch
+            )
+            buffer.seek(0)
+            cur.copy_expert(
+                "COPY voters_staging (userid, data) FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+            cur.execute(
+                """
+                DELETE FROM voters
+                USING voters_staging
+                WHERE voters.userid = voters_staging.userid
+                """
+            )
+            cur.execute(
+                """
+                INSERT INTO voters (userid, data)
+                SELECT DISTINCT ON (userid) userid, data
+                FROM voters_staging
+                ORDER BY userid, position DESC
+                """
+            )
+            cur.execute("TRUNCATE voters_staging")
+            report.documents += len(batch)
+        cur.execute("ANALYZE voters")
+    report.seconds = time.perf_counter() - start
+    return report
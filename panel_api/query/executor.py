@@ -0,0 +1,259 @@
+"""
+This module runs the stages of a keyword query concurrently, so that they overlap
+their I/O instead of running one after the other.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+import pandas as pd
+from flask import Flask, current_app
+
+from ..aggregation.streaming import UserSliceAccumulator
+from ..api_values import Demographic, TimeAggregation
+from ..source.tweets import TweetSource
+from ..source.voters import DemographicSource
+
+
+class StageTimings:
+    """
+    Thread-safe record of the time spent in each stage of a query.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stages: dict[str, dict[str, Any]] = {}
+
+    def record(self, stage: str, seconds: float, items: int = 0) -> None:
+        """Add one run of a stage, which processed some items."""
+        with self._lock:
+            timing = self._stages.setdefault(
+                stage, {"runs": 0, "seconds": 0.0, "items": 0}
+            )
+            timing["runs"] += 1
+            timing["seconds"] += seconds
+            timing["items"] += items
+
+    def summary(self) -> dict[str, dict[str, Any]]:
+        """Total runs, seconds and items of each stage."""
+        with self._lock:
+            return {stage: dict(timing) for stage, timing in self._stages.items()}
+
+
+class QueryExecutor:
+    """
+    Executes the data collection of a keyword query as a pipeline:
+
+    1. Tweets are fetched from every stream of the tweet source concurrently, in
+       chunks.
+    2. As soon as a chunk arrives, the demographics of the users not seen in earlier
+       chunks are looked up, in a pool of worker threads.
+    3. Each chunk is also folded in the pool into running tweet counts per
+       (time slice, user), so the tweets are never held all at once.
+
+    Demographic lookups thus start on the first chunk of users while the tweet
+    source is still being read. Without workers, the chunks are folded one after
+    the other, and the distinct users are looked up at the end.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        """
+        Create an executor.
+
+        Parameters:
+        max_workers: Number of threads looking up demographics and folding chunks,
+            or 0 to run every stage on the calling thread
+        """
+        self.max_workers = max_workers
+        self.timings = StageTimings()
+
+    def collect(
+        self,
+        keyword: str,
+        time_range: Tuple[Optional[date], Optional[date]],
+        time_aggregation: TimeAggregation,
+        with_demographics: bool = True,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Collect the data of a keyword query.
+
+        Parameters:
+        keyword: Keyword to search tweets for
+        time_range: start and end dates of the time range
+        time_aggregation: Size of the time slices
+        with_demographics: Look up the demographics of the users. If not, the
+            returned demographics are empty
+
+        Returns:
+        Tweet counts, with one row per time slice and user, where "created_at" is the
+        start of the time slice, and the demographics of those users
+        """
+        start = time.perf_counter()
+        streams = TweetSource().match_keyword_streams(
+            keyword, time_range, time_aggregation
+        )
+        named_streams = [
+            (f"slice {i + 1}/{len(streams)} of '{keyword}'", stream)
+            for i, stream in enumerate(streams)
+        ]
+        accumulator = UserSliceAccumulator(time_aggregation)
+        if self.max_workers > 0:
+            demographics = self._collect_concurrently(
+                named_streams, accumulator, with_demographics
+            )
+        else:
+            demographics = self._collect_sequentially(
+                named_streams, accumulator, with_demographics
+            )
+
+        merge_start = time.perf_counter()
+        user_slices = accumulator.user_slices()
+        user_demographics = (
+            pd.concat(demographics, ignore_index=True).drop_duplicates("userid")
+            if len(demographics) > 0
+            else pd.DataFrame(columns=["userid", *Demographic])
+        )
+        self.timings.record(
+            "merge", time.perf_counter() - merge_start, len(user_slices)
+        )
+        self.timings.record("total", time.perf_counter() - start)
+
+        current_app.logger.info(
+            "Collected '%s' with %d workers: %s",
+            keyword,
+            self.max_workers,
+            self.timings.summary(),
+        )
+        return user_slices, user_demographics
+
+    def _collect_sequentially(
+        self,
+        streams: list[Tuple[str, Iterable[pd.DataFrame]]],
+        accumulator: UserSliceAccumulator,
+        with_demographics: bool,
+    ) -> list[pd.DataFrame]:
+        """
+        Fold every chunk of the streams into the accumulator one after the other,
+        then look up the demographics of the distinct users.
+        """
+        for name, stream in streams:
+            for chunk in self._timed_chunks(name, stream):
+                reduce_start = time.perf_counter()
+                accumulator.add(chunk)
+                self.timings.record(
+                    "reduce", time.perf_counter() - reduce_start, len(chunk)
+                )
+        if not with_demographics:
+            return []
+        userids = accumulator.userids()
+        if len(userids) == 0:
+            return []
+        lookup_start = time.perf_counter()
+        demographics = DemographicSource().get_demographics(userids)
+        self.timings.record("lookup", time.perf_counter() - lookup_start, len(userids))
+        return [demographics]
+
+    def _collect_concurrently(
+        self,
+        streams: list[Tuple[str, Iterable[pd.DataFrame]]],
+        accumulator: UserSliceAccumulator,
+        with_demographics: bool,
+    ) -> list[pd.DataFrame]:
+        """
+        Read the streams concurrently, and as each chunk arrives, look up the
+        demographics of its new users and fold it into the accumulator in the
+        worker pool.
+        """
+        app = current_app._get_current_object()  # type: ignore[attr-defined]
+        seen_userids: set[str] = set()
+        seen_lock = threading.Lock()
+        lookups: list[Future[pd.DataFrame]] = []
+        reductions: list[Future[None]] = []
+
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as workers, ThreadPoolExecutor(max_workers=len(streams)) as fetchers:
+
+            def fetch(name: str, stream: Iterable[pd.DataFrame]) -> None:
+                for chunk in self._timed_chunks(name, stream):
+                    reductions.append(
+                        workers.submit(
+                            self._run, app, "reduce", len(chunk), accumulator.add, chunk
+                        )
+                    )
+                    if not with_demographics:
+                        continue
+                    userids = pd.unique(chunk["userid"].astype(str))
+                    with seen_lock:
+                        new_userids = [u for u in userids if u not in seen_userids]
+                        seen_userids.update(new_userids)
+                    if len(new_userids) > 0:
+                        lookups.append(
+                            workers.submit(
+                                self._run,
+                                app,
+                                "lookup",
+                                len(new_userids),
+                                DemographicSource().get_demographics,
+                                new_userids,
+                            )
+                        )
+
+            fetches = [
+                fetchers.submit(self._run, app, None, 0, fetch, name, stream)
+                for name, stream in streams
+            ]
+            for future in fetches:
+                future.result()
+            # Every lookup and reduction has been submitted once fetching is done
+            for reduction in reductions:
+                reduction.result()
+            return [future.result() for future in lookups]
+
+    def _timed_chunks(
+        self, name: str, stream: Iterable[pd.DataFrame]
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Iterate over the non-empty chunks of a stream, recording the time spent
+        fetching each, and log the stream's total once it is read.
+        """
+        chunks = iter(stream)
+        rows = 0
+        seconds = 0.0
+        while True:
+            fetch_start = time.perf_counter()
+            chunk = next(chunks, None)
+            fetch_seconds = time.perf_counter() - fetch_start
+            seconds += fetch_seconds
+            if chunk is None:
+                current_app.logger.info(
+                    "Read %s: %d rows in %.3fs", name, rows, seconds
+                )
+                return
+            rows += len(chunk)
+            self.timings.record("fetch", fetch_seconds, len(chunk))
+            if len(chunk) > 0:
+                yield chunk
+
+    def _run(
+        self,
+        app: Flask,
+        stage: Optional[str],
+        items: int,
+        task: Callable[..., Any],
+        *args: Any,
+    ) -> Any:
+        """
+        Run a stage in a worker thread, within an application context, and record
+        its timing under the stage's name, if any.
+        """
+        with app.app_context():
+            start = time.perf_counter()
+            result = task(*args)
+            if stage is not None:
+                self.timings.record(stage, time.perf_counter() - start, items)
+            return result
@@ -3,12 +3,21 @@ This module specifies structures and functions for a keyword search query.
 """
 from __future__ import annotations
 
-from datetime import date, timedelta
+import hashlib
+from datetime import date, datetime, timedelta, timezone
 from typing import Iterable, Mapping, Optional, Tuple
 
+import pandas as pd
+import ujson
+from flask import current_app
+
+from panel_api.aggregation.engines import AggregationEngine, aggregation_class
+from panel_api.aggregation.pushdown import PostgresTimeSlicedUserDemographicAggregation
 from panel_api.aggregation.user_demographics import TimeSlicedUserDemographicAggregation
+from panel_api.caching import LRUCache, ResultCache, result_cache
+from panel_api.query.executor import QueryExecutor
 from panel_api.source.tweets import TweetSource
-from panel_api.source.voters import DemographicSource
+from panel_api.source.types import RetrievalMode
 
 from ..api_utils import demographic_from_name, parse_api_date
 from ..api_values import Demographic, TimeAggregation
@@ -27,11 +36,13 @@ class KeywordQuery:
         cross_sections: Optional[Iterable[Demographic]] = None,
         time_range: Tuple[Optional[date], Optional[date]] = (None, None),
         max_cross_sections: Optional[int] = None,
+        approximate: bool = False,
     ):
         self.keyword = keyword
         self.time_aggregation = TimeAggregation(time_aggregation)
         self.cross_sections = [*cross_sections] if cross_sections else []
         self.time_range = time_range
+        self.approximate = approximate
         if not self.validate(max_cross_sections):
             raise ValueError()
 
@@ -47,6 +58,7 @@ class KeywordQuery:
         group_by = raw_query.get("cross_sections")
         if group_by:
             group_by = [*map(demographic_from_name, group_by)]
+        approximate = raw_query.get("approximate", False)
         before = raw_query.get("before")
         after = raw_query.get("after")
         time_range = (
@@ -62,6 +74,7 @@ class KeywordQuery:
                     cross_sections=group_by,
                     time_range=time_range,
                     max_cross_sections=max_cross_sections,
+                    approximate=approximate,
                 )
             except ValueError:
                 return None
@@ -89,6 +102,8 @@ class KeywordQuery:
             return False
         if len(self.time_range) != 2:
             return False
+        if not isinstance(self.approximate, bool):
+            return False
         if self.time_range[0] is not None and self.time_range[1] is not None:
             if self.time_range[1] - self.time_range[0] < timedelta(0):
                 return False
@@ -98,17 +113,177 @@ class KeywordQuery:
         """
         Collect and aggregate the response data for this query.
         """
-        twitter_data = TweetSource().match_keyword(
-            keyword=self.keyword, time_range=self.time_range
+        retrieval = current_app.config["TWEETS"].get("RETRIEVAL")
+        # Distinct users are only estimated by the source, from enriched tweets,
+        # when asked for. Otherwise, they are counted exactly by joining the tweets
+        if self.approximate and retrieval == RetrievalMode.ENRICHED:
+            return TweetSource().aggregate_keyword(
+                keyword=self.keyword,
+                time_range=self.time_range,
+                time_aggregation=self.time_aggregation,
+                cross_sections=self.cross_sections,
+            )
+        aggregation_config = current_app.config["AGGREGATION"]
+        engine = aggregation_config.get("ENGINE", AggregationEngine.PANDAS)
+        cls = aggregation_class(engine)
+        workers = current_app.config.get("EXECUTOR", {}).get("WORKERS", 0)
+        twitter_data, demographic_data = QueryExecutor(workers).collect(
+            keyword=self.keyword,
+            time_range=self.time_range,
+            time_aggregation=self.time_aggregation,
+            # The database joins the demographics itself
+            with_demographics=cls is not PostgresTimeSlicedUserDemographicAggregation,
         )
-        demographic_data = DemographicSource().get_demographics(twitter_data["userid"])
-        return TimeSlicedUserDemographicAggregation(
+        return cls(
             user_post_times=twitter_data,
             user_demographics=demographic_data,
             time_aggregation=self.time_aggregation,
             cross_sections=self.cross_sections,
+            keep_user_slices=aggregation_config.get("ROLLUP", False),
+        )
+
+    def cache_key(self) -> str:
+        """
+        Hash the canonical form of this query, which is equal for equivalent
+        queries (e.g. listing the same cross-sections in another order).
+        """
+        return hash_canonical(
+            {
+                "keyword": self.keyword,
+                "time_aggregation": str(self.time_aggregation),
+                "cross_sections": sorted(str(dem) for dem in self.cross_sections),
+                "time_range": [
+                    if_present(date.isoformat, day) for day in self.time_range
+                ],
+                "approximate": self.approximate,
+            }
         )
 
+    def slice_cache_key(self, slice_start: date) -> str:
+        """
+        Hash the canonical form of one time slice of this query's results. Unlike in
+        `cache_key`, cross-sections are kept in order, since cached time slices are
+        combined along the same axes.
+        """
+        return hash_canonical(
+            {
+                "keyword": self.keyword,
+                "time_aggregation": str(self.time_aggregation),
+                "cross_sections": [str(dem) for dem in self.cross_sections],
+                "slice": slice_start.isoformat(),
+                "approximate": self.approximate,
+            }
+        )
+
+    def execute_cached(self) -> Tuple[TimeSlicedUserDemographicAggregation, bool]:
+        """
+        Collect and aggregate the response data for this query, unless an equivalent
+        query's results are in the result cache.
+
+        Returns:
+        The aggregation, and whether it was found in the cache
+        """
+        cache = result_cache()
+        if cache is None:
+            return self.execute(), False
+        key = self.cache_key()
+        cached = cache.get(key)
+        if cached is not None:
+            return TimeSlicedUserDemographicAggregation.from_bytes(cached), True
+        aggregation = self.rollup_cached()
+        if aggregation is not None:
+            cache.set(key, cached_bytes(cache, aggregation))
+            return aggregation, True
+        if current_app.config["RESULT_CACHE"].get("INCREMENTAL", True):
+            aggregation = self.execute_incremental()
+        else:
+            aggregation = self.execute()
+        cache.set(key, cached_bytes(cache, aggregation))
+        return aggregation, False
+
+    def rollup_cached(self) -> Optional[TimeSlicedUserDemographicAggregation]:
+        """
+        Roll up the cached results of this query with finer time slices, if any kept
+        their user-level data. Returns None if there are none.
+        """
+        cache = result_cache()
+        if cache is None or not current_app.config["AGGREGATION"].get("ROLLUP", False):
+            return None
+        for time_aggregation in TimeAggregation:
+            if not time_aggregation.is_finer_than(self.time_aggregation):
+                continue
+            finer_query = KeywordQuery(
+                self.keyword,
+                time_aggregation,
+                cross_sections=self.cross_sections,
+                time_range=self.time_range,
+                approximate=self.approximate,
+            )
+            cached = cache.get(finer_query.cache_key())
+            if cached is None:
+                continue
+            finer_aggregation = TimeSlicedUserDemographicAggregation.from_bytes(cached)
+            if finer_aggregation.user_slices is not None:
+                return finer_aggregation.rollup(self.time_aggregation)
+        return None
+
+    def execute_incremental(self) -> TimeSlicedUserDemographicAggregation:
+        """
+        Collect and aggregate the response data for this query, reusing the cached
+        results of closed time slices: slices that are over, and entirely in the
+        time range. Only the other slices are queried from the sources, and the
+        closed ones among them are cached.
+        """
+        cache = result_cache()
+        after, before = self.time_range
+        today = datetime.now(timezone.utc).date()
+        last_day = today if before is None else min(before, today)
+        if cache is None or after is None or after > last_day:
+            return self.execute()
+
+        parts = []
+        missing_ranges: list[list[Optional[date]]] = []
+        missing_closed_slices = []
+        for period in pd.period_range(
+            after.isoformat(),
+            last_day.isoformat(),
+            freq=self.time_aggregation.round_key(),
+        ):
+            start = period.start_time.date()
+            end = period.end_time.date()
+            if after <= start and end <= last_day and end < today:
+                cached = cache.get(self.slice_cache_key(start))
+                if cached is not None:
+                    parts.append(
+                        TimeSlicedUserDemographicAggregation.from_bytes(cached)
+                    )
+                    continue
+                missing_closed_slices.append(start)
+            range_start = max(start, after)
+            range_end = end if end < last_day else before
+            if missing_ranges and missing_ranges[-1][1] == range_start - timedelta(1):
+                missing_ranges[-1][1] = range_end
+            else:
+                missing_ranges.append([range_start, range_end])
+
+        for range_start, range_end in missing_ranges:
+            parts.append(
+                KeywordQuery(
+                    self.keyword,
+                    self.time_aggregation,
+                    cross_sections=self.cross_sections,
+                    time_range=(range_start, range_end),
+                    approximate=self.approximate,
+                ).execute()
+            )
+        aggregation = TimeSlicedUserDemographicAggregation.concat(parts)
+        for start in missing_closed_slices:
+            cache.set(
+                self.slice_cache_key(start),
+                cached_bytes(cache, aggregation.select_slices([pd.Timestamp(start)])),
+            )
+        return aggregation
+
     def __eq__(self, __o: object) -> bool:
         if isinstance(__o, self.__class__):
             return self.__dict__ == __o.__dict__
@@ -116,3 +291,21 @@ class KeywordQuery:
 
     def __ne__(self, __o: object) -> bool:
         return not self.__eq__(__o)
+
+
+def hash_canonical(canonical: Mapping) -> str:
+    """
+    Hash the JSON serializable canonical form of a query.
+    """
+    return hashlib.sha256(ujson.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+def cached_bytes(
+    cache: ResultCache, aggregation: TimeSlicedUserDemographicAggregation
+) -> bytes:
+    """
+    Serialize an aggregation for the result cache. User-level data links Twitter
+    users to their demographics, so it is only kept by in-process caches, and never
+    written to disk.
+    """
+    return aggregation.to_bytes(include_user_data=isinstance(cache, LRUCache))
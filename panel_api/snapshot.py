@@ -0,0 +1,133 @@
+"""
+Module for a columnar snapshot of panel voters' demographics, stored as NumPy
+files that are memory-mapped when loaded. Every worker process maps the same
+files, so the operating system shares one copy of the snapshot between them.
+"""
+from __future__ import annotations
+
+import os
+import shutil
+import threading
+from typing import Collection, Mapping
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+from .api_utils import decode_demographic, encode_demographic, numeric_userids
+from .api_values import Demographic
+
+_load_lock = threading.Lock()
+
+
+class VoterSnapshot:
+    """
+    Demographics of panel voters, as sorted int64 Twitter user IDs and, for each
+    Demographic, the uint8 code of each user's value (see `encode_demographic`).
+    """
+
+    def __init__(self, userids: np.ndarray, codes: Mapping[Demographic, np.ndarray]):
+        """
+        Create a snapshot from its arrays.
+
+        Parameters:
+        userids: Sorted, distinct Twitter user IDs
+        codes: Demographic codes of each user, aligned with `userids`
+        """
+        if any(len(codes[dem]) != len(userids) for dem in Demographic):
+            raise ValueError("Snapshot arrays have mismatched lengths")
+        self.userids = userids
+        self.codes = dict(codes)
+
+    def __len__(self) -> int:
+        return len(self.userids)
+
+    @staticmethod
+    def from_voters(voters: pd.DataFrame) -> VoterSnapshot:
+        """
+        Create a snapshot from a DataFrame of voters, with a "userid" column and one
+        column per Demographic. Users with non-numeric IDs are left out, and only
+        the first row of a repeated user is kept.
+        """
+        userids, user_rows = numeric_userids(voters["userid"])
+        order = np.argsort(userids, kind="stable")
+        sorted_userids, first = np.unique(userids[order], return_index=True)
+        rows = user_rows[order[first]]
+        return VoterSnapshot(
+            sorted_userids,
+            {
+                dem: encode_demographic(dem, voters[dem].to_numpy()[rows])
+                for dem in Demographic
+            },
+        )
+
+    @staticmethod
+    def load(path: str) -> VoterSnapshot:
+        """Memory-map the snapshot saved in a directory."""
+        return VoterSnapshot(
+            np.load(os.path.join(path, "userid.npy"), mmap_mode="r"),
+            {
+                dem: np.load(os.path.join(path, f"{dem}.npy"), mmap_mode="r")
+                for dem in Demographic
+            },
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Save the snapshot to a directory. The snapshot is written beside the
+        directory first, and then swapped in place of it.
+        """
+        new_path = f"{path}.new"
+        old_path = f"{path}.old"
+        shutil.rmtree(new_path, ignore_errors=True)
+        os.makedirs(new_path)
+        np.save(os.path.join(new_path, "userid.npy"), self.userids)
+        for dem in Demographic:
+            np.save(os.path.join(new_path, f"{dem}.npy"), self.codes[dem])
+        if os.path.exists(path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(path, old_path)
+        os.rename(new_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def lookup(self, twitter_user_ids: Collection[str]) -> pd.DataFrame:
+        """
+        Look demographics up for Twitter users, with a vectorized binary search.
+
+        Returns:
+        DataFrame with a "userid" column, and one column per Demographic, for the
+        users found in the snapshot
+        """
+        distinct_ids = pd.Series(list(twitter_user_ids), dtype=object).astype(str)
+        distinct_ids = distinct_ids.drop_duplicates()
+        userids, rows = numeric_userids(distinct_ids)
+        if len(self.userids) == 0:
+            positions = np.zeros(0, dtype=np.int64)
+            found = np.zeros(len(userids), dtype=bool)
+        else:
+            positions = np.searchsorted(self.userids, userids)
+            positions = np.minimum(positions, len(self.userids) - 1)
+            found = self.userids[positions] == userids
+            positions = positions[found]
+        return pd.DataFrame(
+            {
+                "userid": distinct_ids.to_numpy()[rows[found]],
+                **{
+                    dem: decode_demographic(dem, self.codes[dem][positions])
+                    for dem in Demographic
+                },
+            }
+        )
+
+
+def voter_snapshot() -> VoterSnapshot:
+    """
+    Provide the snapshot configured for the application, loading it on first use.
+    A rebuilt snapshot is picked up by newly started worker processes.
+    """
+    with _load_lock:
+        snapshot = current_app.extensions.get("voter_snapshot")
+        if snapshot is None:
+            snapshot = VoterSnapshot.load(current_app.config["VOTERS"]["SNAPSHOT_PATH"])
+            current_app.extensions["voter_snapshot"] = snapshot
+    return snapshot
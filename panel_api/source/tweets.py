@@ -1,14 +1,26 @@
 """
 Module defining sources of Twitter information, relevant to this API.
 """
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from typing import Iterable, Optional, Tuple, Union
 
 import pandas as pd
 from flask import current_app
 
-from ..es_utils import elastic_query_for_keyword
-from .types import SourceType
+from ..aggregation.enriched import EnrichedTimeSlicedUserDemographicAggregation
+from ..aggregation.user_demographics import TimeSlicedUserDemographicAggregation
+from ..api_values import Demographic, TimeAggregation
+from ..es_utils import (
+    CARDINALITY_RELATIVE_ERROR,
+    elastic_aggregate_demographics,
+    elastic_aggregate_keyword,
+    elastic_query_for_keyword,
+    elastic_query_for_keyword_fields,
+)
+from ..helpers import batched
+from .types import RetrievalMode, SourceType
 
 
 class TweetSource:
@@ -20,6 +32,7 @@ class TweetSource:
         self,
         keyword: str,
         time_range: Union[Tuple[Optional[date], Optional[date]], list[Optional[date]]],
+        time_aggregation: Optional[TimeAggregation] = None,
     ) -> pd.DataFrame:
         """
         Pull tweets from the source, containing a keyword, over a specific time range.
@@ -27,34 +40,210 @@ class TweetSource:
         keyword: str of len>=1 to search for
         time_range: start and end dates of the time range. Either may be None to
             represent "no boundary"
+        time_aggregation: Optional. Size of the time slices the tweets will be
+            aggregated into. Sources may use this to pre-aggregate tweets
 
-        returns: DataFrame with "created_at" and "userid" columns
+        returns: DataFrame with "created_at" and "userid" columns. If the source
+            pre-aggregated the tweets, each row is a distinct (time slice, user)
+            pair, "created_at" is the start of the time slice and an extra
+            "tweet_count" column holds the number of tweets the row stands for
         """
         source = current_app.config["TWEETS"]["SOURCE"]
         if source == SourceType.ELASTICSEARCH:
-            return ElasticsearchTweetSource().match_keyword(keyword, time_range)
+            return ElasticsearchTweetSource().match_keyword(
+                keyword, time_range, time_aggregation
+            )
         elif source == SourceType.ATTACHED:
             return pd.DataFrame(current_app.config["TWEETS"]["ATTACHED_DATA"])
         else:
             raise NotImplementedError(f"TweetSource is not implemented for '{source}'")
 
+    def match_keyword_streams(
+        self,
+        keyword: str,
+        time_range: Union[Tuple[Optional[date], Optional[date]], list[Optional[date]]],
+        time_aggregation: Optional[TimeAggregation] = None,
+    ) -> list[Iterable[pd.DataFrame]]:
+        """
+        Pull tweets from the source like `match_keyword`, as independent streams of
+        DataFrame chunks, which may be read concurrently from different threads
+        (within an application context). Elasticsearch streams each scroll slice
+        lazily, a chunk at a time. Other sources give a single stream of a single
+        chunk.
+        """
+        source = current_app.config["TWEETS"]["SOURCE"]
+        if source == SourceType.ELASTICSEARCH:
+            return ElasticsearchTweetSource().match_keyword_streams(
+                keyword, time_range, time_aggregation
+            )
+        return [[self.match_keyword(keyword, time_range, time_aggregation)]]
+
+    def aggregate_keyword(
+        self,
+        keyword: str,
+        time_range: Union[Tuple[Optional[date], Optional[date]], list[Optional[date]]],
+        time_aggregation: TimeAggregation,
+        cross_sections: Optional[list[Demographic]] = None,
+    ) -> TimeSlicedUserDemographicAggregation:
+        """
+        Aggregate the demographics of the users who posted tweets containing a
+        keyword in the source itself, from demographics enriched onto the tweets
+        (`panel_api enrich tweets`). Distinct user counts may be estimates, whose
+        relative standard error is the aggregation's `relative_error`.
+
+        keyword: str of len>=1 to search for
+        time_range: start and end dates of the time range
+        time_aggregation: Size of the time slices
+        cross_sections: Optional. Demographics of the cross-sectional distribution
+        """
+        source = current_app.config["TWEETS"]["SOURCE"]
+        if source == SourceType.ELASTICSEARCH:
+            return ElasticsearchTweetSource().aggregate_keyword(
+                keyword, time_range, time_aggregation, cross_sections
+            )
+        raise NotImplementedError(
+            f"TweetSource cannot aggregate demographics for '{source}'"
+        )
+
 
 class ElasticsearchTweetSource(TweetSource):
     """
     Class for an Elasticsearch backend for Twitter data.
     """
 
-    def match_keyword(self, keyword, time_range):
-        res = elastic_query_for_keyword(
-            keyword, before=time_range[1], after=time_range[0]
+    def match_keyword(self, keyword, time_range, time_aggregation=None):
+        streams = self.match_keyword_streams(keyword, time_range, time_aggregation)
+        app = current_app._get_current_object()  # type: ignore[attr-defined]
+
+        def read(slice_id: int) -> list[pd.DataFrame]:
+            with app.app_context():
+                start = time.perf_counter()
+                chunks = list(streams[slice_id])
+                current_app.logger.info(
+                    "Scrolled slice %d/%d for '%s': %d tweets in %.3fs",
+                    slice_id + 1,
+                    len(streams),
+                    keyword,
+                    sum(len(chunk) for chunk in chunks),
+                    time.perf_counter() - start,
+                )
+                return chunks
+
+        if len(streams) == 1:
+            slices = [read(0)]
+        else:
+            # Scroll the slices concurrently
+            with ThreadPoolExecutor(max_workers=len(streams)) as pool:
+                slices = list(pool.map(read, range(len(streams))))
+        chunks = [chunk for slice_chunks in slices for chunk in slice_chunks]
+        if len(chunks) == 0:
+            return pd.DataFrame(
+                {
+                    "created_at": pd.Series(dtype=object),
+                    "userid": pd.Series(dtype=object),
+                }
+            )
+        return pd.concat(chunks, ignore_index=True)
+
+    def aggregate_keyword(
+        self, keyword, time_range, time_aggregation, cross_sections=None
+    ):
+        slice_buckets = elastic_aggregate_demographics(
+            keyword,
+            TimeAggregation(time_aggregation).calendar_interval(),
+            cross_sections=cross_sections,
+            before=time_range[1],
+            after=time_range[0],
+        )
+        return EnrichedTimeSlicedUserDemographicAggregation(
+            slice_buckets,
+            time_aggregation,
+            cross_sections=cross_sections,
+            relative_error=CARDINALITY_RELATIVE_ERROR,
         )
-        return self._raw_data_to_dataframe(res)
+
+    def match_keyword_streams(self, keyword, time_range, time_aggregation=None):
+        retrieval = current_app.config["TWEETS"].get("RETRIEVAL", RetrievalMode.SCAN)
+        chunk_size = current_app.config["TWEETS"].get("CHUNK_SIZE", 10000)
+        if retrieval == RetrievalMode.AGGREGATION and time_aggregation is not None:
+            buckets = elastic_aggregate_keyword(
+                keyword,
+                TimeAggregation(time_aggregation).calendar_interval(),
+                before=time_range[1],
+                after=time_range[0],
+                page_size=chunk_size,
+            )
+            return [
+                map(self._aggregated_data_to_dataframe, batched(buckets, chunk_size))
+            ]
+
+        max_slices = current_app.config.get("ELASTICSEARCH_SLICES", 1)
+        streams: list[Iterable[pd.DataFrame]] = []
+        for slice_id in range(max_slices):
+            if retrieval == RetrievalMode.DOCVALUES:
+                pages = elastic_query_for_keyword_fields(
+                    keyword,
+                    before=time_range[1],
+                    after=time_range[0],
+                    page_size=chunk_size,
+                    slice_id=slice_id,
+                    max_slices=max_slices,
+                )
+                streams.append(
+                    self._docvalue_data_to_dataframe([page]) for page in pages
+                )
+            else:
+                hits = elastic_query_for_keyword(
+                    keyword,
+                    before=time_range[1],
+                    after=time_range[0],
+                    slice_id=slice_id,
+                    max_slices=max_slices,
+                )
+                streams.append(
+                    map(self._raw_data_to_dataframe, batched(hits, chunk_size))
+                )
+        return streams
 
     def _raw_data_to_dataframe(self, es_data: Iterable[dict]):
-        df = pd.DataFrame(es_data)
-        if len(df) == 0:
-            return pd.DataFrame(columns=["created_at", "userid"])
+        # Only keep the two fields used, rather than whole tweets
+        created_at: list[str] = []
+        userid: list[str] = []
+        for tweet in es_data:
+            created_at.append(tweet["created_at"])
+            userid.append(str(tweet["user"]["id"]))
+        return pd.DataFrame(
+            {
+                "created_at": pd.Series(created_at, dtype=object),
+                "userid": pd.Series(userid, dtype=object),
+            }
+        )
 
-        df["userid"] = df["user"].apply(lambda u: str(u["id"]))
+    def _docvalue_data_to_dataframe(self, es_pages: Iterable[list[dict]]):
+        created_at: list[str] = []
+        userid: list[str] = []
+        for hits in es_pages:
+            created_at.extend(hit["fields"]["created_at"][0] for hit in hits)
+            userid.extend(hit["fields"]["user.id"][0] for hit in hits)
+        return pd.DataFrame(
+            {
+                "created_at": pd.to_datetime(
+                    pd.to_numeric(pd.Series(created_at, dtype=object)), unit="ms"
+                ),
+                "userid": pd.Series(userid, dtype=object).astype(str),
+            }
+        )
 
-        return df
+    def _aggregated_data_to_dataframe(self, es_buckets: Iterable[dict]):
+        created_at, userid, tweet_count = [], [], []
+        for bucket in es_buckets:
+            created_at.append(bucket["key"]["created_at"])
+            userid.append(str(bucket["key"]["userid"]))
+            tweet_count.append(bucket["doc_count"])
+        return pd.DataFrame(
+            {
+                "created_at": pd.to_datetime(created_at, unit="ms"),
+                "userid": pd.Series(userid, dtype=object),
+                "tweet_count": pd.Series(tweet_count, dtype="int64"),
+            }
+        )
@@ -12,3 +12,17 @@ class SourceType(str, Enum):
     ELASTICSEARCH = "elasticsearch"  # Elasticsearch cluster
     DATABASE = "database"  # SQL databases (just postgres for now, will add more later)
     ATTACHED = "attached"  # Data attached alongside, in the config, for testing
+    SNAPSHOT = "snapshot"  # Memory-mapped files, built from another source
+
+
+class RetrievalMode(str, Enum):
+    """
+    Ways of retrieving tweets from a source that supports more than one.
+    """
+
+    SCAN = "scan"  # Stream every matching tweet document
+    DOCVALUES = "docvalues"  # Stream only the tweet fields needed for aggregation
+    AGGREGATION = "aggregation"  # Count tweets per (time slice, user) in the source
+    ENRICHED = (
+        "enriched"  # Aggregate approximate queries from enriched tweets in the source
+    )
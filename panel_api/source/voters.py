@@ -1,14 +1,24 @@
 """
 Module defining sources of demographic information.
 """
-from typing import Collection
+from typing import Collection, Iterable, Optional
 
 import pandas as pd
 from flask import current_app
 
-from ..api_utils import categorize_age
+from ..api_utils import categorize_ages
 from ..api_values import Demographic
-from ..sql_utils import collect_voters
+from ..caching import demographic_cache
+from ..es_utils import elastic_query_users
+from ..snapshot import voter_snapshot
+from ..sql_utils import (
+    VOTER_DEMOGRAPHIC_FIELDS,
+    LookupStrategy,
+    VoterSchema,
+    collect_voters,
+    lookup_voter_demographics,
+    stream_voter_demographics,
+)
 from .types import SourceType
 
 
@@ -31,7 +41,15 @@ class DemographicSource:
         """
         source = current_app.config["VOTERS"]["SOURCE"]
         if source == SourceType.DATABASE:
-            return PostgresDemographicSource().get_demographics(twitter_user_ids)
+            return CachedDemographicSource(
+                PostgresDemographicSource()
+            ).get_demographics(twitter_user_ids)
+        elif source == SourceType.ELASTICSEARCH:
+            return CachedDemographicSource(
+                ElasticsearchDemographicSource()
+            ).get_demographics(twitter_user_ids)
+        elif source == SourceType.SNAPSHOT:
+            return SnapshotDemographicSource().get_demographics(twitter_user_ids)
         elif source == SourceType.ATTACHED:
             return pd.DataFrame(current_app.config["VOTERS"]["ATTACHED_DATA"])
         else:
@@ -55,8 +73,28 @@ class PostgresDemographicSource(DemographicSource):
         self.connection_params = kwargs
 
     def get_demographics(self, twitter_user_ids: Collection[str]) -> pd.DataFrame:
+        config = current_app.config["VOTERS"]
+        if config.get("SCHEMA", VoterSchema.JSON) == VoterSchema.NORMALIZED:
+            return lookup_voter_demographics(
+                twitter_ids=twitter_user_ids,
+                strategy=config.get("LOOKUP", LookupStrategy.ANY),
+                batch_size=config.get("BATCH_SIZE", 10000),
+            )
+        if config.get("STREAM", False):
+            voters_df = stream_voter_demographics(
+                twitter_ids=twitter_user_ids,
+                strategy=config.get("LOOKUP", LookupStrategy.ANY),
+                batch_size=config.get("BATCH_SIZE", 10000),
+                itersize=config.get("ITERSIZE", 2000),
+            )
+            voters_df[Demographic.AGE] = categorize_ages(voters_df[Demographic.AGE])
+            return voters_df
+
         voters = collect_voters(
-            twitter_ids=twitter_user_ids, connection_params=self.connection_params
+            twitter_ids=twitter_user_ids,
+            connection_params=self.connection_params,
+            strategy=config.get("LOOKUP", LookupStrategy.ANY),
+            batch_size=config.get("BATCH_SIZE", 10000),
         )
         voters_df = pd.DataFrame(dict(voter) for voter in voters)
         if len(voters_df) == 0:
@@ -69,5 +107,107 @@ class PostgresDemographicSource(DemographicSource):
             },
             inplace=True,
         )
-        voters_df[Demographic.AGE] = voters_df[Demographic.AGE].apply(categorize_age)
+        voters_df[Demographic.AGE] = categorize_ages(voters_df[Demographic.AGE])
+        return voters_df
+
+
+class ElasticsearchDemographicSource(DemographicSource):
+    """
+    Elasticsearch source of demographic information about Twitter users, from a
+    "voters" index whose documents have the users' Twitter profile IDs as `_id`.
+    """
+
+    def get_demographics(self, twitter_user_ids: Collection[str]) -> pd.DataFrame:
+        config = current_app.config["VOTERS"]
+        voters = elastic_query_users(
+            twitter_user_ids,
+            fields=[*VOTER_DEMOGRAPHIC_FIELDS.values()],
+            batch_size=config.get("BATCH_SIZE", 10000),
+            max_workers=config.get("LOOKUP_WORKERS", 4),
+        )
+        if len(voters) == 0:
+            return pd.DataFrame(columns=["userid", *Demographic])
+        voters_df = pd.DataFrame(
+            {
+                "userid": [voter["twProfileID"] for voter in voters],
+                **{
+                    dem: [voter.get(field) for voter in voters]
+                    for dem, field in VOTER_DEMOGRAPHIC_FIELDS.items()
+                },
+            }
+        )
+        voters_df[Demographic.AGE] = categorize_ages(voters_df[Demographic.AGE])
         return voters_df
+
+
+class SnapshotDemographicSource(DemographicSource):
+    """
+    Source of demographic information from the memory-mapped snapshot of the
+    voters table, configured by VOTERS.SNAPSHOT_PATH. Rebuild the snapshot with
+    `panel_api snapshot build`.
+    """
+
+    def get_demographics(self, twitter_user_ids: Collection[str]) -> pd.DataFrame:
+        return voter_snapshot().lookup(twitter_user_ids)
+
+
+class CachedDemographicSource(DemographicSource):
+    """
+    Source of demographic information that remembers the demographics it has
+    looked up in this worker's demographic cache, and only asks another source for
+    the users it has not seen recently. Users the other source does not know are
+    remembered too.
+    """
+
+    def __init__(self, source: DemographicSource) -> None:
+        """
+        Create a cached demographic source.
+
+        Parameters:
+        source: Source of demographics for users missing from the cache
+        """
+        self.source = source
+
+    def get_demographics(self, twitter_user_ids: Collection[str]) -> pd.DataFrame:
+        cache = demographic_cache()
+        if cache is None:
+            return self.source.get_demographics(twitter_user_ids)
+
+        user_ids = {str(user_id) for user_id in twitter_user_ids}
+        cached = cache.get_many(user_ids)
+        missing = [user_id for user_id in user_ids if user_id not in cached]
+        if len(missing) > 0:
+            fetched = self.source.get_demographics(missing)[["userid", *Demographic]]
+            fetched_rows = {
+                str(row[0]): tuple(row[1:])
+                for row in fetched.itertuples(index=False, name=None)
+            }
+            cache.set_many({user_id: fetched_rows.get(user_id) for user_id in missing})
+            cached.update(fetched_rows)
+
+        return pd.DataFrame(
+            [
+                (user_id, *demographics)
+                for user_id, demographics in cached.items()
+                if demographics is not None
+            ],
+            columns=["userid", *Demographic],
+        )
+
+
+def invalidate_demographics(twitter_user_ids: Optional[Iterable[str]] = None) -> None:
+    """
+    Forget cached demographics, so they are looked up again. Call this when the
+    panel changes.
+
+    Parameters:
+    twitter_user_ids: Optional. Users to forget. If not given, every user is
+        forgotten
+    """
+    cache = demographic_cache()
+    if cache is not None:
+        cache.invalidate(
+            None
+            if twitter_user_ids is None
+            else [str(user_id) for user_id in twitter_user_ids]
+        )
@@ -1,38 +1,501 @@
 """
 Module for interacting with a PostgreSQL data backend.
 """
-from typing import Any, Iterable, Mapping, Optional
+import csv
+import io
+from enum import Enum
+from typing import Any, Iterable, Mapping, Optional, Sequence
 
+import numpy as np
+import pandas as pd
+from psycopg2 import extensions
+
+from .api_utils import decode_demographic, numeric_userids
+from .api_values import AGE_BUCKET_EDGES, MISSING_CODE, Demographic
 from .connections import postgresql_connection
+from .helpers import batched
+
+# Fields of the voters' JSON documents holding each demographic
+VOTER_DEMOGRAPHIC_FIELDS = {
+    Demographic.STATE: "vf_source_state",
+    Demographic.AGE: "voterbase_age",
+    Demographic.GENDER: "voterbase_gender",
+    Demographic.RACE: "voterbase_race",
+}
+
+# PostgreSQL regular expression of the texts `pd.to_numeric` parses as numbers,
+# apart from "inf" and "nan"
+NUMERIC_PATTERN = r"^[+-]?([0-9]+(\.[0-9]*)?|\.[0-9]+)([eE][+-]?[0-9]+)?$"
+
+
+# Normalized table of the voters' demographics, coded as positions in the lists of
+# API values of the demographics, and ages already bucketed. The covering primary
+# key makes lookups index-only scans
+VOTER_DEMOGRAPHICS_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS voter_demographics (
+    userid bigint NOT NULL,
+    {", ".join(f"{dem} smallint" for dem in Demographic)},
+    PRIMARY KEY (userid) INCLUDE ({", ".join(str(dem) for dem in Demographic)})
+)
+"""
+
+
+class VoterSchema(str, Enum):
+    """
+    Layouts of the voters' information in PostgreSQL.
+    """
+
+    JSON = "json"  # "voters" table of (userid, data) JSON documents
+    NORMALIZED = "normalized"  # "voter_demographics" table of coded demographics
+
+
+class LookupStrategy(str, Enum):
+    """
+    Ways of sending a set of Twitter user IDs to PostgreSQL to look voters up.
+    """
+
+    ANY = "any"  # Batches of IDs as a single array parameter, with `= ANY(%s)`
+    COPY = "copy"  # All IDs copied into a session-scoped temporary table
 
 
 def collect_voters(
-    twitter_ids: Iterable[str], connection_params: Optional[Mapping] = None
+    twitter_ids: Iterable[str],
+    connection_params: Optional[Mapping] = None,
+    strategy: LookupStrategy = LookupStrategy.ANY,
+    batch_size: int = 10000,
 ) -> Iterable[Mapping[str, Any]]:
     """
     Collect panel voters' information from their Twitter user IDs.
+
+    Parameters:
+    twitter_ids: Twitter user IDs to look up. Duplicates are only looked up once
+    connection_params: Unused. Connections come from the application's pool
+    strategy: How the IDs are sent to the database
+    batch_size: Number of IDs sent per query, with the ANY strategy
     """
-    temp_table_command = """
-    CREATE TABLE temp (
-        id varchar(255)
+    distinct_ids = list({str(id) for id in twitter_ids})
+
+    with postgresql_connection() as conn, conn.cursor() as cur:
+        if LookupStrategy(strategy) == LookupStrategy.COPY:
+            _copy_lookup_ids(cur, distinct_ids)
+            cur.execute(
+                """
+                SELECT voters.data
+                FROM voters INNER JOIN lookup_ids
+                ON voters.userid=lookup_ids.id
+                """
+            )
+            voters = [x[0] for x in cur.fetchall()]
+        else:
+            voters = []
+            for start in range(0, len(distinct_ids), batch_size):
+                end = start + batch_size
+                batch = distinct_ids[start:end]
+                cur.execute(
+                    """
+                    SELECT voters.data
+                    FROM voters
+                    WHERE voters.userid = ANY(%s)
+                    """,
+                    (batch,),
+                )
+                voters.extend(x[0] for x in cur.fetchall())
+
+    return voters
+
+
+def stream_voter_demographics(
+    twitter_ids: Iterable[str],
+    strategy: LookupStrategy = LookupStrategy.ANY,
+    batch_size: int = 10000,
+    itersize: int = 2000,
+) -> pd.DataFrame:
+    """
+    Collect panel voters' demographics from their Twitter user IDs, streaming them
+    through a server-side cursor. Only the demographic fields are read out of the
+    voters' documents, and rows are copied into columnar arrays as they arrive, so
+    no more than `itersize` rows are held as Python objects at any time.
+
+    Parameters:
+    twitter_ids: Twitter user IDs to look up. Duplicates are only looked up once
+    strategy: How the IDs are sent to the database
+    batch_size: Number of IDs sent per query, with the ANY strategy
+    itersize: Number of rows fetched from the server-side cursor at a time
+
+    Returns:
+    DataFrame with a "userid" column, and one column per Demographic. Ages are
+    the voters' numeric ages, not age buckets
+    """
+    distinct_ids = list({str(id) for id in twitter_ids})
+    fields = _demographic_fields_sql()
+    columns = _VoterColumns(capacity=len(distinct_ids))
+
+    with postgresql_connection() as conn:
+        if LookupStrategy(strategy) == LookupStrategy.COPY:
+            with conn.cursor() as cur:
+                _copy_lookup_ids(cur, distinct_ids)
+            query = f"""
+            SELECT voters.userid, {fields}
+            FROM voters INNER JOIN lookup_ids
+            ON voters.userid=lookup_ids.id
+            """
+            columns.extend_from_cursor(conn, query, None, itersize)
+        else:
+            query = f"""
+            SELECT voters.userid, {fields}
+            FROM voters
+            WHERE voters.userid = ANY(%s)
+            """
+            for start in range(0, len(distinct_ids), batch_size):
+                end = start + batch_size
+                batch = distinct_ids[start:end]
+                columns.extend_from_cursor(conn, query, (batch,), itersize)
+
+    return columns.to_dataframe()
+
+
+def stream_all_voter_demographics(itersize: int = 10000) -> pd.DataFrame:
+    """
+    Collect the demographics of every panel voter, streaming them through a
+    server-side cursor like `stream_voter_demographics`.
+
+    Returns:
+    DataFrame with a "userid" column, and one column per Demographic. Ages are
+    the voters' numeric ages, not age buckets
+    """
+    columns = _VoterColumns(capacity=itersize)
+    with postgresql_connection() as conn:
+        columns.extend_from_cursor(
+            conn,
+            f"SELECT voters.userid, {_demographic_fields_sql()} FROM voters",
+            None,
+            itersize,
+        )
+    return columns.to_dataframe()
+
+
+def _demographic_fields_sql() -> str:
+    return ", ".join(
+        f"voters.data->>'{VOTER_DEMOGRAPHIC_FIELDS[dem]}'" for dem in Demographic
     )
+
+
+class _VoterColumns:
     """
-    fill_table_command = """
-    INSERT INTO temp (id) VALUES (%s)
+    Preallocated columns of voter demographics, filled from database rows.
     """
-    collect_voters_command = """
-    SELECT voters.data
-    FROM voters INNER JOIN temp
-    ON voters.userid=temp.id
+
+    def __init__(self, capacity: int):
+        self.size = 0
+        self.userid = np.empty(capacity, dtype=object)
+        self.demographics = {
+            dem: np.empty(capacity, dtype=float if dem == Demographic.AGE else object)
+            for dem in Demographic
+        }
+
+    def _reserve(self, count: int) -> None:
+        capacity = len(self.userid)
+        if self.size + count > capacity:
+            capacity = max(2 * capacity, self.size + count)
+            self.userid = np.resize(self.userid, capacity)
+            for dem in Demographic:
+                self.demographics[dem] = np.resize(self.demographics[dem], capacity)
+
+    def extend(self, rows: Sequence[tuple]) -> None:
+        """Copy rows of (userid, *demographics) into the columns."""
+        chunk = np.array(rows, dtype=object).reshape(len(rows), 1 + len(Demographic))
+        self._reserve(len(rows))
+        end = self.size + len(rows)
+        window = slice(self.size, end)
+        self.userid[window] = chunk[:, 0]
+        for i, dem in enumerate(Demographic, start=1):
+            if dem == Demographic.AGE:
+                self.demographics[dem][window] = pd.to_numeric(
+                    chunk[:, i], errors="coerce"
+                )
+            else:
+                self.demographics[dem][window] = chunk[:, i]
+        self.size = end
+
+    def extend_from_cursor(
+        self,
+        conn: extensions.connection,
+        query: str,
+        params: Optional[tuple],
+        itersize: int,
+    ) -> None:
+        """Run a query on a server-side cursor, and copy its rows into the columns."""
+        with conn.cursor(name="voter_demographics") as cur:
+            cur.itersize = itersize
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(itersize)
+                if len(rows) == 0:
+                    break
+                self.extend(rows)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Assemble the filled part of the columns into a DataFrame."""
+        return pd.DataFrame(
+            {
+                "userid": self.userid[: self.size],
+                **{dem: self.demographics[dem][: self.size] for dem in Demographic},
+            }
+        )
+
+
+def _copy_lookup_ids(cur: extensions.cursor, twitter_ids: list[str]) -> None:
+    """
+    Fill the "lookup_ids" temporary table of this session with Twitter user IDs.
+    The table is emptied when the transaction commits, so pooled connections can
+    reuse it.
+    """
+    cur.execute(
+        """
+        CREATE TEMPORARY TABLE IF NOT EXISTS lookup_ids (
+            id varchar(255)
+        ) ON COMMIT DELETE ROWS
+        """
+    )
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([id] for id in twitter_ids)
+    buffer.seek(0)
+    cur.copy_expert("COPY lookup_ids (id) FROM STDIN WITH (FORMAT csv)", buffer)
+    cur.execute("ANALYZE lookup_ids")
+
+
+def migrate_voter_demographics() -> int:
     """
+    Create the normalized voter_demographics table (VOTER_DEMOGRAPHICS_SCHEMA) if
+    needed, and refill it from the voters table, within the database. Voters with
+    non-numeric Twitter user IDs are skipped, and demographic values that are not
+    API values are stored as NULL, so they are not counted. Aggregations of the
+    JSON voters instead count such values under labels of their own.
 
-    conn = postgresql_connection()
-    cur = conn.cursor()
+    Returns:
+    The number of voters in the table
+    """
+    codes = []
+    params: list[Any] = []
+    for dem in Demographic:
+        field = f"voters.data->>'{VOTER_DEMOGRAPHIC_FIELDS[dem]}'"
+        if dem == Demographic.AGE:
+            codes.append(_age_code_sql(field, params))
+        else:
+            codes.append(f"array_position(%s::text[], {field}) - 1")
+            params.append(dem.values())
 
-    cur.execute(temp_table_command)
-    cur.executemany(fill_table_command, [(id,) for id in twitter_ids])
-    cur.execute(collect_voters_command)
+    with postgresql_connection() as conn, conn.cursor() as cur:
+        cur.execute(VOTER_DEMOGRAPHICS_SCHEMA)
+        cur.execute("TRUNCATE voter_demographics")
+        cur.execute(
+            f"""
+            INSERT INTO voter_demographics (userid, {", ".join(map(str, Demographic))})
+            SELECT voters.userid::bigint, {", ".join(codes)}
+            FROM voters
+            WHERE voters.userid ~ '^[0-9]+$'
+            ON CONFLICT (userid) DO NOTHING
+            """,
+            params,
+        )
+        count = cur.rowcount
 
-    voters = [x[0] for x in cur.fetchall()]
+    # Index-only scans need the visibility map, which VACUUM sets, outside of a
+    # transaction
+    with postgresql_connection() as conn:
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("VACUUM ANALYZE voter_demographics")
+        finally:
+            conn.autocommit = False
+    return count
 
-    return voters
+
+def lookup_voter_demographics(
+    twitter_ids: Iterable[str],
+    strategy: LookupStrategy = LookupStrategy.ANY,
+    batch_size: int = 10000,
+) -> pd.DataFrame:
+    """
+    Collect panel voters' demographics from their Twitter user IDs, in the
+    normalized voter_demographics table (see `migrate_voter_demographics`).
+
+    Parameters:
+    twitter_ids: Twitter user IDs to look up. Duplicates are only looked up once,
+        and non-numeric IDs are skipped
+    strategy: How the IDs are sent to the database
+    batch_size: Number of IDs sent per query, with the ANY strategy
+
+    Returns:
+    DataFrame with a "userid" column, and one column per Demographic. Ages are age
+    buckets
+    """
+    distinct_ids = pd.unique(pd.Series(list(twitter_ids), dtype=object).astype(str))
+    userids, _ = numeric_userids(distinct_ids)
+    fields = ", ".join(
+        f"COALESCE(voter_demographics.{dem}, {MISSING_CODE})" for dem in Demographic
+    )
+    rows: list[tuple] = []
+    with postgresql_connection() as conn, conn.cursor() as cur:
+        if LookupStrategy(strategy) == LookupStrategy.COPY:
+            _copy_lookup_ids(cur, [str(userid) for userid in userids])
+            cur.execute(
+                f"""
+                SELECT voter_demographics.userid, {fields}
+                FROM voter_demographics INNER JOIN lookup_ids
+                ON voter_demographics.userid=lookup_ids.id::bigint
+                """
+            )
+            rows = cur.fetchall()
+        else:
+            for batch in batched(userids.tolist(), batch_size):
+                cur.execute(
+                    f"""
+                    SELECT voter_demographics.userid, {fields}
+                    FROM voter_demographics
+                    WHERE voter_demographics.userid = ANY(%s::bigint[])
+                    """,
+                    (batch,),
+                )
+                rows.extend(cur.fetchall())
+
+    table = np.array(rows, dtype=np.int64).reshape(len(rows), 1 + len(Demographic))
+    return pd.DataFrame(
+        {
+            "userid": table[:, 0].astype(str).astype(object),
+            **{
+                dem: decode_demographic(dem, table[:, column])
+                for column, dem in enumerate(Demographic, start=1)
+            },
+        }
+    )
+
+
+def aggregate_user_slices(
+    user_slices: pd.DataFrame,
+    cross_sections: Optional[Sequence[Demographic]] = None,
+    schema: VoterSchema = VoterSchema.JSON,
+) -> pd.DataFrame:
+    """
+    Join tweet counts per time slice and user with the voters' demographics, and
+    count tweets and users per time slice, per time slice and demographic value,
+    and per time slice and cross-section, all within the database. The counts are
+    copied into a temporary table, and aggregated with one GROUPING SETS query.
+
+    Parameters:
+    user_slices: DataFrame with one row per distinct time slice and user, with
+        "created_at" (start of the time slice), int64 "userid" and "tweet_count"
+        columns
+    cross_sections: Optional. Demographics of the cross-sectional distribution
+    schema: Layout of the voters' demographics to join with
+
+    Returns:
+    DataFrame with one row per group: "created_at", one column per Demographic,
+    holding the group's API value or None, "grouping", the GROUPING() bitmask of
+    the demographics (see `grouping_mask`), and "n_users" and "n_tweets"
+    """
+    params: list[Any] = []
+    if VoterSchema(schema) == VoterSchema.NORMALIZED:
+        panel = f"""
+            SELECT voter_demographics.userid, {", ".join(
+                f"voter_demographics.{dem}" for dem in Demographic
+            )}
+            FROM voter_demographics
+            WHERE voter_demographics.userid IN (SELECT userid FROM user_slices)
+        """
+        join = "panel.userid = user_slices.userid"
+    else:
+        fields = []
+        for dem in Demographic:
+            field = f"voters.data->>'{VOTER_DEMOGRAPHIC_FIELDS[dem]}'"
+            if dem == Demographic.AGE:
+                field = _age_code_sql(field, params)
+            fields.append(f"{field} AS {dem}")
+        panel = f"""
+            SELECT DISTINCT ON (voters.userid) voters.userid, {", ".join(fields)}
+            FROM voters
+            WHERE voters.userid IN (SELECT userid::text FROM user_slices)
+        """
+        join = "panel.userid = user_slices.userid::text"
+
+    dems = ", ".join(map(str, Demographic))
+    grouping_sets = [
+        "(user_slices.created_at)",
+        *(f"(user_slices.created_at, {dem})" for dem in Demographic),
+    ]
+    if cross_sections is not None and len(cross_sections) > 1:
+        grouping_sets.append(
+            f"(user_slices.created_at, {', '.join(map(str, cross_sections))})"
+        )
+    query = f"""
+        WITH panel AS ({panel})
+        SELECT user_slices.created_at, {dems}, GROUPING({dems}),
+            count(*), sum(user_slices.tweet_count)
+        FROM user_slices INNER JOIN panel ON {join}
+        GROUP BY GROUPING SETS ({", ".join(grouping_sets)})
+    """
+
+    with postgresql_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TEMPORARY TABLE IF NOT EXISTS user_slices (
+                created_at timestamp,
+                userid bigint,
+                tweet_count bigint
+            ) ON COMMIT DELETE ROWS
+            """
+        )
+        buffer = io.StringIO()
+        user_slices[["created_at", "userid", "tweet_count"]].to_csv(
+            buffer, header=False, index=False, date_format="%Y-%m-%d %H:%M:%S"
+        )
+        buffer.seek(0)
+        cur.copy_expert(
+            "COPY user_slices (created_at, userid, tweet_count) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+        cur.execute("ANALYZE user_slices")
+        cur.execute(query, params)
+        rows = cur.fetchall()
+
+    groups = pd.DataFrame(
+        rows,
+        columns=["created_at", *Demographic, "grouping", "n_users", "n_tweets"],
+    )
+    for dem in Demographic:
+        if VoterSchema(schema) == VoterSchema.NORMALIZED or dem == Demographic.AGE:
+            codes = groups[dem].fillna(MISSING_CODE).to_numpy(dtype=np.int64)
+            groups[dem] = decode_demographic(dem, codes)
+    groups["created_at"] = pd.to_datetime(groups["created_at"])
+    return groups
+
+
+def grouping_mask(grouped: Iterable[Demographic]) -> int:
+    """
+    Bitmask GROUPING() gives, over every Demographic, to the rows of the grouping
+    set of some demographics (and the time slice).
+    """
+    grouped = set(grouped)
+    return sum(
+        1 << (len(Demographic) - 1 - position)
+        for position, dem in enumerate(Demographic)
+        if dem not in grouped
+    )
+
+
+def _age_code_sql(field: str, params: list[Any]) -> str:
+    """
+    SQL expression bucketing a text field of numeric ages like `categorize_ages`,
+    into positions in the list of age categories. Its parameters are appended to
+    `params`.
+    """
+    params.extend(
+        [NUMERIC_PATTERN, AGE_BUCKET_EDGES, Demographic.AGE.values().index("Unknown")]
+    )
+    return f"""
+        CASE WHEN btrim({field}) ~ %s
+        THEN width_bucket(btrim({field})::numeric, %s::numeric[])
+        ELSE %s END
+    """
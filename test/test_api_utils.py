@@ -1,14 +1,11 @@
-from datetime import datetime
-
+import numpy as np
 import pandas as pd
 import pytest
 
-from panel_api.api_utils import demographic_from_name, fill_zeros
+from panel_api.api_utils import categorize_age, categorize_ages, demographic_from_name
 from panel_api.api_values import Demographic
 from panel_api.query.keyword_query import KeywordQuery
 
-from .utils import list_equals_ignore_order, period_equals
-
 
 def test_demographic_from_name():
     tests = {
@@ -25,6 +22,48 @@ def test_demographic_from_name():
         assert demographic_from_name(name) == dem
 
 
+def categorize_age_per_row(age):
+    """
+    Reference implementation of age bucketing, one age at a time.
+    """
+    if np.isnan(age):
+        category = "Unknown"
+    elif age < 30:
+        category = "under 30"
+    elif age >= 70:
+        category = "70+"
+    else:
+        category = str(10 * int(age / 10)) + " - " + str(10 + 10 * int(age / 10))
+
+    return category
+
+
+def test_categorize_age():
+    tests = {
+        18: "under 30",
+        29.9: "under 30",
+        30: "30 - 40",
+        45: "40 - 50",
+        69.5: "60 - 70",
+        70: "70+",
+        104: "70+",
+        np.nan: "Unknown",
+        None: "Unknown",
+    }
+    for age, category in tests.items():
+        assert categorize_age(age) == category
+
+
+def test_categorize_ages():
+    ages = pd.Series(np.random.default_rng(0).uniform(18, 100, 1_000).round())
+    ages[::7] = np.nan
+
+    results = categorize_ages(ages)
+
+    assert list(results.categories) == Demographic.AGE.values()
+    assert list(results) == list(ages.apply(categorize_age_per_row))
+
+
 def test_parse_query_valid():
     valid_inputs = [
         {"keyword_query": "keyword", "aggregate_time_period": "day"},
@@ -98,96 +137,17 @@ def test_parse_query_invalid():
             "after": "2020-10-10",
             "before": "2020-10-01",
         },  # Invalid time range
+        {
+            "keyword_query": "keyword",
+            "aggregate_time_period": "day",
+            "approximate": "yes",
+        },  # Invalid approximate flag
     ]
 
     for input in invalid_inputs:
         assert KeywordQuery.from_raw_query(input) is None
 
 
-def test_fill_zeros():
-    sparse_results = [
-        {
-            "ts": datetime(2023, 2, 13),
-            "n_tweets": 5,
-            "n_tweeters": 5,
-            "tsmart_state": {"AL": 1, "GA": 1, "PA": 1, "MA": 1, "CT": 1},
-            "voterbase_gender": {"Male": 2, "Female": 2, "Unknown": 1},
-            "vb_age_decade": {"under 30": 2, "30 - 40": 1, "50 - 60": 2},
-            "voterbase_race": {
-                "Caucasian": 3,
-                "Asian": 1,
-                "Uncoded": 1,
-            },
-            "groups": [
-                {"voterbase_race": "Caucasian", "voterbase_gender": "Male", "count": 2},
-                {"voterbase_race": "Asian", "voterbase_gender": "Female", "count": 1},
-                {"voterbase_race": "Uncoded", "voterbase_gender": "Female", "count": 1},
-                {
-                    "voterbase_race": "Caucasian",
-                    "voterbase_gender": "Unknown",
-                    "count": 1,
-                },
-            ],
-        },
-    ]
-    expected_results = [
-        {
-            "ts": datetime(2023, 2, 13),
-            "n_tweets": 5,
-            "n_tweeters": 5,
-            "tsmart_state": (
-                pd.Series([1, 1, 1, 1, 1], index=["AL", "GA", "PA", "MA", "CT"])
-                .reindex(Demographic.STATE.values(), fill_value=0)
-                .to_dict()
-            ),
-            "voterbase_gender": {"Male": 2, "Female": 2, "Unknown": 1},
-            "vb_age_decade": (
-                pd.Series([2, 1, 2], index=["under 30", "30 - 40", "50 - 60"])
-                .reindex(Demographic.AGE.values(), fill_value=0)
-                .to_dict()
-            ),
-            "voterbase_race": {
-                "Caucasian": 3,
-                "Asian": 1,
-                "Uncoded": 1,
-                "African-American": 0,
-                "Hispanic": 0,
-                "Other": 0,
-                "Native American": 0,
-            },
-            "groups": pd.DataFrame(
-                [
-                    ("Caucasian", "Male", 2),
-                    ("Asian", "Female", 1),
-                    ("Uncoded", "Female", 1),
-                    ("Caucasian", "Unknown", 1),
-                    ("Caucasian", "Female", 0),
-                    ("African-American", "Female", 0),
-                    ("African-American", "Male", 0),
-                    ("African-American", "Unknown", 0),
-                    ("Hispanic", "Female", 0),
-                    ("Hispanic", "Male", 0),
-                    ("Hispanic", "Unknown", 0),
-                    ("Uncoded", "Male", 0),
-                    ("Uncoded", "Unknown", 0),
-                    ("Asian", "Male", 0),
-                    ("Asian", "Unknown", 0),
-                    ("Other", "Female", 0),
-                    ("Other", "Male", 0),
-                    ("Other", "Unknown", 0),
-                    ("Native American", "Female", 0),
-                    ("Native American", "Male", 0),
-                    ("Native American", "Unknown", 0),
-                ],
-                columns=[Demographic.RACE, Demographic.GENDER, "count"],
-            ).to_dict("records"),
-        },
-    ]
-    filled_results = fill_zeros(sparse_results)
-
-    assert list_equals_ignore_order(expected_results, filled_results, period_equals)
-
-
 @pytest.fixture
 def valid_outputs():
     return [
@@ -0,0 +1,309 @@
+import pickle
+import sys
+from datetime import date
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+import pytest
+
+from panel_api import create_app
+from panel_api.aggregation.numpy_engine import NumpyTimeSlicedUserDemographicAggregation
+from panel_api.aggregation.user_demographics import TimeSlicedUserDemographicAggregation
+from panel_api.api_values import Demographic, TimeAggregation
+from panel_api.caching import DiskCache, LRUCache, demographic_cache
+from panel_api.query.keyword_query import KeywordQuery
+from panel_api.source.voters import CachedDemographicSource, invalidate_demographics
+
+from .fixtures.data import tweet_data, voter_data  # noqa: F401
+
+
+def test_lru_cache_eviction():
+    cache: LRUCache[str, int] = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
+    assert cache.stats() == {
+        "entries": 2,
+        "max_entries": 2,
+        "bytes": None,
+        "max_bytes": None,
+        "hits": 3,
+        "misses": 1,
+        "hit_ratio": 0.75,
+    }
+
+
+def test_lru_cache_ttl():
+    cache: LRUCache[str, int] = LRUCache(max_entries=2, ttl=10)
+    with patch("panel_api.caching.time.monotonic") as mock_time:
+        mock_time.return_value = 100
+        cache.set("a", 1)
+        mock_time.return_value = 109
+        assert cache.get("a") == 1
+        mock_time.return_value = 111
+        assert cache.get("a") is None
+
+    assert cache.stats()["entries"] == 0
+
+
+def test_lru_cache_max_bytes():
+    value_size = sys.getsizeof(b"x" * 100)
+    cache: LRUCache[str, bytes] = LRUCache(max_entries=10, max_bytes=2 * value_size)
+    cache.set("a", b"x" * 100)
+    cache.set("b", b"x" * 100)
+    cache.set("c", b"x" * 100)
+    cache.set("large", b"x" * 1000)
+
+    assert cache.get_many(["a", "b", "c", "large"]).keys() == {"b", "c"}
+    assert cache.stats()["bytes"] == 2 * value_size
+    cache.invalidate(["b"])
+    assert cache.stats()["bytes"] == value_size
+
+
+def test_lru_cache_invalidate():
+    cache: LRUCache[str, int] = LRUCache(max_entries=3)
+    cache.set_many({"a": 1, "b": 2, "c": 3})
+    cache.invalidate(["a"])
+    assert cache.get_many(["a", "b", "c"]) == {"b": 2, "c": 3}
+    cache.invalidate()
+    assert cache.get_many(["a", "b", "c"]) == {}
+
+
+def test_cached_demographic_source(voter_data):
+    app = create_app(TESTING=True, VOTERS={"SOURCE": "database", "CACHE_SIZE": 100})
+    source = MagicMock()
+    source.get_demographics.side_effect = lambda ids: voter_data[
+        voter_data["userid"].isin(ids)
+    ]
+
+    def lookup(user_ids):
+        return (
+            CachedDemographicSource(source)
+            .get_demographics(user_ids)
+            .sort_values("userid")
+            .reset_index(drop=True)
+        )
+
+    with app.app_context():
+        first = lookup(["0", "1", "missing"])
+        second = lookup(["0", "1", "2", "missing"])
+        invalidate_demographics(["0"])
+        lookup(["0", "1"])
+        stats = demographic_cache().stats()
+
+    fetched = [set(call.args[0]) for call in source.get_demographics.call_args_list]
+    assert fetched == [{"0", "1", "missing"}, {"2"}, {"0"}]
+    assert stats["hits"] == 4
+    pd.testing.assert_frame_equal(
+        second,
+        voter_data.iloc[:3][["userid", *Demographic]].reset_index(drop=True),
+    )
+    pd.testing.assert_frame_equal(first, second.iloc[:2])
+
+
+def test_disk_cache(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = DiskCache(path, max_entries=2, ttl=10)
+    with patch("panel_api.caching.time.time") as mock_time:
+        mock_time.return_value = 100
+        cache.set("a", b"1")
+        mock_time.return_value = 101
+        cache.set("b", b"2")
+        mock_time.return_value = 102
+        assert cache.get("a") == b"1"
+        cache.set("c", b"3")
+
+        # Another process sees the same entries
+        shared = DiskCache(path, max_entries=2, ttl=10)
+        assert shared.get("b") is None
+        assert shared.get("a") == b"1"
+        assert shared.get("c") == b"3"
+
+        mock_time.return_value = 112.5
+        assert cache.get("c") is None
+        cache.invalidate()
+        assert shared.stats()["entries"] == 0
+
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_disk_cache_requires_absolute_path():
+    with pytest.raises(ValueError):
+        create_app(TESTING=True, RESULT_CACHE={"BACKEND": "disk"})
+    with pytest.raises(ValueError):
+        create_app(
+            TESTING=True,
+            RESULT_CACHE={"BACKEND": "disk", "PATH": "results.sqlite"},
+        )
+
+
+@pytest.mark.parametrize("keep_user_slices", [False, True])
+def test_aggregation_bytes(tweet_data, voter_data, keep_user_slices):
+    aggregation = NumpyTimeSlicedUserDemographicAggregation(
+        tweet_data,
+        voter_data,
+        TimeAggregation.DAY,
+        cross_sections=[Demographic.RACE, Demographic.AGE],
+        keep_user_slices=keep_user_slices,
+    )
+
+    restored = TimeSlicedUserDemographicAggregation.from_bytes(aggregation.to_bytes())
+
+    assert type(restored) is NumpyTimeSlicedUserDemographicAggregation
+    assert restored.to_list() == aggregation.to_list()
+    if keep_user_slices:
+        pd.testing.assert_frame_equal(restored.user_slices, aggregation.user_slices)
+        assert (
+            restored.rollup(TimeAggregation.WEEK).to_list()
+            == aggregation.rollup(TimeAggregation.WEEK).to_list()
+        )
+    else:
+        assert restored.user_slices is None
+
+
+def test_aggregation_bytes_refuses_pickles(tweet_data, voter_data):
+    aggregation = TimeSlicedUserDemographicAggregation(
+        tweet_data, voter_data, TimeAggregation.DAY
+    )
+
+    with pytest.raises((ValueError, OSError)):
+        TimeSlicedUserDemographicAggregation.from_bytes(pickle.dumps(aggregation))
+
+
+def test_disk_cache_max_bytes(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"), max_entries=10, max_bytes=250)
+    with patch("panel_api.caching.time.time") as mock_time:
+        for i, key in enumerate(["a", "b", "c"]):
+            mock_time.return_value = 100 + i
+            cache.set(key, b"x" * 100)
+        cache.set("large", b"x" * 1000)
+
+    assert [cache.get(key) is not None for key in ["a", "b", "c", "large"]] == [
+        False,
+        True,
+        True,
+        False,
+    ]
+    assert cache.stats()["bytes"] == 200
+
+
+def test_keyword_query_cache_key():
+    query = KeywordQuery(
+        "keyword",
+        TimeAggregation.DAY,
+        cross_sections=[Demographic.RACE, Demographic.STATE],
+        time_range=(date(2022, 1, 1), None),
+    )
+    reordered = KeywordQuery(
+        "keyword",
+        TimeAggregation.DAY,
+        cross_sections=[Demographic.STATE, Demographic.RACE],
+        time_range=(date(2022, 1, 1), None),
+    )
+    other = KeywordQuery(
+        "keyword",
+        TimeAggregation.WEEK,
+        cross_sections=[Demographic.STATE, Demographic.RACE],
+        time_range=(date(2022, 1, 1), None),
+    )
+
+    assert query.cache_key() == reordered.cache_key()
+    assert query.cache_key() != other.cache_key()
+
+
+@pytest.mark.parametrize("backend", ["none", "memory", "disk"])
+def test_keyword_query_execute_cached(tmp_path, tweet_data, voter_data, backend):
+    app = create_app(
+        TESTING=True,
+        RESULT_CACHE={"BACKEND": backend, "PATH": str(tmp_path / "results.sqlite")},
+    )
+    aggregation = TimeSlicedUserDemographicAggregation(
+        tweet_data, voter_data, TimeAggregation.DAY
+    )
+    query = KeywordQuery("keyword", TimeAggregation.DAY)
+
+    with app.app_context(), patch.object(
+        KeywordQuery, "execute", return_value=aggregation
+    ) as execute:
+        first, first_hit = query.execute_cached()
+        second, second_hit = query.execute_cached()
+
+    assert not first_hit
+    assert second_hit == (backend != "none")
+    assert execute.call_count == (2 if backend == "none" else 1)
+    assert second.to_list() == first.to_list()
+
+
+def test_keyword_query_execute_incremental(voter_data):
+    app = create_app(TESTING=True, RESULT_CACHE={"BACKEND": "memory"})
+    tweets = pd.DataFrame(
+        {
+            "created_at": pd.date_range("2022-01-01", "2022-02-10", freq="3H"),
+            "userid": [str(i % 7) for i in range(321)],
+        }
+    )
+    queried_ranges = []
+
+    def execute(query):
+        queried_ranges.append(query.time_range)
+        after, before = query.time_range
+        days = tweets["created_at"].dt.date
+        in_range = (days >= after) & ((days <= before) if before else True)
+        return TimeSlicedUserDemographicAggregation(
+            tweets[in_range], voter_data, query.time_aggregation
+        )
+
+    def query(after, before):
+        return KeywordQuery("keyword", TimeAggregation.WEEK, time_range=(after, before))
+
+    with app.app_context(), patch.object(
+        KeywordQuery, "execute", autospec=True, side_effect=execute
+    ):
+        query(date(2022, 1, 5), date(2022, 1, 20)).execute_incremental()
+        assert queried_ranges == [(date(2022, 1, 5), date(2022, 1, 20))]
+
+        queried_ranges.clear()
+        incremental = query(date(2022, 1, 5), date(2022, 1, 30)).execute_incremental()
+        assert queried_ranges == [
+            (date(2022, 1, 5), date(2022, 1, 9)),
+            (date(2022, 1, 17), date(2022, 1, 30)),
+        ]
+
+        expected = execute(query(date(2022, 1, 5), date(2022, 1, 30)))
+    assert incremental.to_list() == expected.to_list()
+
+
+@pytest.mark.parametrize("backend", ["memory", "disk"])
+def test_keyword_query_rollup_cached(tmp_path, tweet_data, voter_data, backend):
+    app = create_app(
+        TESTING=True,
+        AGGREGATION={"ROLLUP": True},
+        RESULT_CACHE={"BACKEND": backend, "PATH": str(tmp_path / "results.sqlite")},
+    )
+
+    def execute(query):
+        return TimeSlicedUserDemographicAggregation(
+            tweet_data, voter_data, query.time_aggregation, keep_user_slices=True
+        )
+
+    with app.app_context(), patch.object(
+        KeywordQuery, "execute", autospec=True, side_effect=execute
+    ) as mock_execute:
+        KeywordQuery("keyword", TimeAggregation.DAY).execute_cached()
+        weekly, cache_hit = KeywordQuery(
+            "keyword", TimeAggregation.WEEK
+        ).execute_cached()
+
+    # User-level data is never written to disk, so it can't be rolled up from there
+    assert cache_hit == (backend == "memory")
+    assert mock_execute.call_count == (1 if backend == "memory" else 2)
+    assert (
+        weekly.to_list()
+        == TimeSlicedUserDemographicAggregation(
+            tweet_data, voter_data, TimeAggregation.WEEK
+        ).to_list()
+    )
@@ -37,7 +37,7 @@ class ManualTimeSlicedUserDemographicAggregation(TimeSlicedUserDemographicAggreg
             time_slice_column=time_slice_column,
         )
 
-    def _get_counts(self, _: pd.DataFrame) -> pd.DataFrame:
+    def _get_counts(self, _: pd.Series) -> pd.DataFrame:
         return self.manual_counts
 
     def _user_demographic_counts(self, _: pd.DataFrame) -> dict[Demographic, pd.Series]:
@@ -173,6 +173,35 @@ def test_keyword_search_censor_output(valid_outputs, invalid_outputs):
         assert validate_keyword_search_output(validated_output, privacy_threshold)
 
 
+def test_keyword_search_censor_explicit_zeros(invalid_outputs):
+    privacy_threshold = 10
+
+    output = invalid_outputs[1]
+    explicit_output = (
+        ManualTimeSlicedUserDemographicAggregation.from_list(
+            output, time_slice_column="ts", time_aggregation=TimeAggregation.DAY
+        )
+        .censor(privacy_threshold)
+        .to_list(explicit_zeros=True)
+    )
+    period = explicit_output[0]
+    for dem in Demographic:
+        assert set(dem.values()) <= set(period[dem].keys())
+    assert period[Demographic.STATE]["NY"] == 0
+    assert period[Demographic.RACE]["African-American"] == 10
+    assert len(period["groups"]) == len(Demographic.AGE.values()) * len(
+        Demographic.STATE.values()
+    )
+    groups = {
+        (group[Demographic.AGE], group[Demographic.STATE]): group["count"]
+        for group in period["groups"]
+    }
+    # Censored counts are reported as zeros, as if they were left out
+    assert groups[("under 30", "AL")] == 0
+    assert groups[("under 30", "CA")] == 41
+    assert groups[("30 - 40", "CA")] == 0
+
+
 @pytest.fixture
 def valid_outputs():
     return [
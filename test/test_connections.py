@@ -0,0 +1,107 @@
+import json
+import threading
+from unittest.mock import patch
+
+import pytest
+from psycopg2.pool import PoolError
+
+from panel_api import create_app
+from panel_api.connections import (
+    connection_stats,
+    elasticsearch_connection,
+    postgresql_connection,
+)
+
+
+@pytest.fixture
+def app():
+    test_app = create_app(TESTING=True, DATABASE_POOL_SIZE=3)
+
+    yield test_app
+
+
+@pytest.fixture
+def mock_pool():
+    with patch("panel_api.connections.ThreadedConnectionPool") as m:
+        yield m
+
+
+def test_elasticsearch_connection_shared(app):
+    with app.app_context():
+        es_handle = elasticsearch_connection()
+        assert elasticsearch_connection() is es_handle
+
+    with app.app_context():
+        assert elasticsearch_connection() is es_handle
+
+    with create_app(TESTING=True).app_context():
+        assert elasticsearch_connection() is not es_handle
+
+
+def test_postgresql_connection_pooled(app, mock_pool):
+    pool = mock_pool.return_value
+    conn = pool.getconn.return_value
+    with app.app_context():
+        for _ in range(2):
+            with postgresql_connection() as checked_out:
+                assert checked_out is conn
+                assert connection_stats()["postgresql"]["in_use"] == 1
+        stats = connection_stats()
+
+    mock_pool.assert_called_once_with(1, 3, app.config["DATABASE_URL"])
+    assert conn.commit.call_count == 2
+    assert pool.putconn.call_count == 2
+    assert stats["postgresql"]["in_use"] == 0
+    assert stats["postgresql"]["checkouts"] == 2
+
+
+def test_postgresql_connection_rollback(app, mock_pool):
+    pool = mock_pool.return_value
+    conn = pool.getconn.return_value
+    with app.app_context(), pytest.raises(RuntimeError):
+        with postgresql_connection():
+            raise RuntimeError()
+
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+    pool.putconn.assert_called_once_with(conn)
+
+
+def test_postgresql_connection_waits_for_pool(mock_pool):
+    app = create_app(TESTING=True, DATABASE_POOL_SIZE=1, DATABASE_POOL_TIMEOUT=5)
+    pool = mock_pool.return_value
+    checked_out = threading.Event()
+    release = threading.Event()
+
+    def hold_connection():
+        with app.app_context(), postgresql_connection():
+            checked_out.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold_connection)
+    holder.start()
+    checked_out.wait()
+    threading.Timer(0.1, release.set).start()
+    with app.app_context(), postgresql_connection():
+        # Only checked out once the other thread returned its connection
+        assert pool.putconn.call_count == 1
+    holder.join()
+
+    assert pool.getconn.call_count == 2
+
+
+def test_postgresql_connection_pool_timeout(mock_pool):
+    app = create_app(TESTING=True, DATABASE_POOL_SIZE=1, DATABASE_POOL_TIMEOUT=0.01)
+    with app.app_context(), postgresql_connection():
+        with pytest.raises(PoolError), postgresql_connection():
+            pass
+
+    assert mock_pool.return_value.getconn.call_count == 1
+
+
+def test_stats_endpoint(app):
+    response = app.test_client().get("/stats")
+
+    stats = json.loads(response.data)["connections"]
+    assert stats["postgresql"]["pool_size"] == 3
+    assert stats["postgresql"]["checkouts"] == 0
@@ -29,8 +29,9 @@ def mock_query():
 def test_keyword_search_valid_query(client, mock_query):
     mock_response = MagicMock()
     mock_response.censor.return_value = mock_response
-    mock_response.to_list.return_value = "mock_value"
-    mock_query.execute.return_value = mock_response
+    mock_response.relative_error = None
+    mock_response.to_json.return_value = '"mock_value"'
+    mock_query.execute_cached.return_value = (mock_response, False)
     query_json = {
         "keyword_query": "test query",
         "aggregate_time_period": "week",
@@ -45,15 +46,71 @@ def test_keyword_search_valid_query(client, mock_query):
 
     # Just checking that the correct query params are forwarded.
     # Other params (e.g. 'fill_zeros') are irrelevant to this endpoint's success.
-    mock_query.execute.assert_called_once()
+    mock_query.execute_cached.assert_called_once()
     mock_response.censor.assert_called_once()
 
+    assert response.headers["X-Cache"] == "MISS"
     assert json.loads(response.data) == {
         "query": query_json,
         "response_data": "mock_value",
     }
 
 
+def test_keyword_search_columnar(client, mock_query):
+    mock_response = MagicMock()
+    mock_response.censor.return_value = mock_response
+    mock_response.relative_error = None
+    mock_response.to_columnar.return_value = {"ts": []}
+    mock_query.execute_cached.return_value = (mock_response, False)
+    query_json = {
+        "keyword_query": "test query",
+        "aggregate_time_period": "week",
+        "format": "columnar",
+    }
+    response = client.get("/keyword_search", json=query_json)
+
+    mock_response.to_columnar.assert_called_once()
+    assert json.loads(response.data) == {
+        "query": query_json,
+        "response_data": {"ts": []},
+    }
+
+
+def test_keyword_search_approximate(client, mock_query):
+    mock_response = MagicMock()
+    mock_response.censor.return_value = mock_response
+    mock_response.relative_error = 0.01625
+    mock_response.to_json.return_value = "[]"
+    mock_query.execute_cached.return_value = (mock_response, False)
+    query_json = {
+        "keyword_query": "test query",
+        "aggregate_time_period": "week",
+        "approximate": True,
+    }
+    response = client.get("/keyword_search", json=query_json)
+
+    assert json.loads(response.data) == {
+        "query": query_json,
+        "response_data": [],
+        "relative_error": 0.01625,
+    }
+
+
+def test_keyword_search_invalid_format(client, mock_query):
+    query_json = {
+        "keyword_query": "test query",
+        "aggregate_time_period": "week",
+        "format": "csv",
+    }
+    response = client.get("/keyword_search", json=query_json)
+
+    mock_query.execute_cached.assert_not_called()
+    assert json.loads(response.data) == {
+        "query": query_json,
+        "response_data": "invalid query",
+    }
+
+
 def test_keyword_search_invalid_query(client):
     query_json = {
         "keyword_query": "test query",
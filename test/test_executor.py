@@ -0,0 +1,188 @@
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+
+from panel_api import create_app
+from panel_api.aggregation.streaming import UserSliceAccumulator, reduce_chunk
+from panel_api.aggregation.user_demographics import TimeSlicedUserDemographicAggregation
+from panel_api.api_values import Demographic, TimeAggregation
+from panel_api.helpers import batched
+from panel_api.query.executor import QueryExecutor
+from panel_api.query.keyword_query import KeywordQuery
+from panel_api.source.tweets import ElasticsearchTweetSource
+
+from .test_sources import assert_aggregations_equal, random_user_data
+
+
+def test_batched():
+    assert [*batched(range(5), 2)] == [[0, 1], [2, 3], [4]]
+    assert [*batched([], 2)] == []
+
+
+def test_query_executor():
+    tweets, voters = random_user_data(n_tweets=3000, n_users=200)
+    chunks = [tweets.iloc[rows] for rows in np.array_split(range(len(tweets)), 6)]
+    streams = [chunks[:3], chunks[3:]]
+    app = create_app(TESTING=True, EXECUTOR={"WORKERS": 3})
+    with app.app_context(), patch(
+        "panel_api.query.executor.TweetSource"
+    ) as tweet_source, patch(
+        "panel_api.query.executor.DemographicSource"
+    ) as demographic_source:
+        tweet_source.return_value.match_keyword_streams.return_value = streams
+        demographic_source.return_value.get_demographics.side_effect = (
+            lambda ids: voters[voters["userid"].isin(ids)]
+        )
+        executor = QueryExecutor(max_workers=3)
+        user_slices, user_demographics = executor.collect(
+            "keyword", (None, None), TimeAggregation.WEEK
+        )
+
+        # Each user is looked up once, whichever chunk they first appear in
+        looked_up = [
+            userid
+            for call in demographic_source.return_value.get_demographics.call_args_list
+            for userid in call.args[0]
+        ]
+        assert len(looked_up) == len(set(looked_up)) == tweets["userid"].nunique()
+        assert set(user_demographics["userid"]) == set(
+            voters["userid"][voters["userid"].isin(tweets["userid"])]
+        )
+        assert user_slices["tweet_count"].sum() == tweets["tweet_count"].sum()
+        assert user_slices.duplicated(["created_at", "userid"]).sum() == 0
+
+        timings = executor.timings.summary()
+        assert timings["fetch"]["runs"] == 6
+        assert timings["reduce"]["items"] == len(tweets)
+        assert timings["lookup"]["items"] == len(looked_up)
+
+        # Without demographics, e.g. when the database joins them itself
+        get_demographics = demographic_source.return_value.get_demographics
+        get_demographics.reset_mock()
+        for workers in (3, 0):
+            pushed_slices, no_demographics = QueryExecutor(workers).collect(
+                "keyword", (None, None), TimeAggregation.WEEK, with_demographics=False
+            )
+            assert len(no_demographics) == 0
+            assert len(pushed_slices) == len(user_slices)
+        get_demographics.assert_not_called()
+
+        expected = TimeSlicedUserDemographicAggregation(
+            tweets, voters, TimeAggregation.WEEK
+        )
+        query = KeywordQuery("keyword", TimeAggregation.WEEK)
+        for workers in (3, 0):
+            app.config["EXECUTOR"] = {"WORKERS": workers}
+            assert_aggregations_equal(expected, query.execute())
+
+
+def scrolled_hits(slice_id, n_hits, events, delay=0.0):
+    """
+    Lazily yield the hits of a mocked scroll slice, recording each one read.
+    """
+    for i in range(n_hits):
+        time.sleep(delay)
+        events.append(("read", slice_id, time.perf_counter()))
+        yield {
+            "created_at": f"Fri Feb {17 + i % 3} 12:00:00 +0000 2023",
+            "user": {"id": slice_id * 1000 + i % 7},
+        }
+
+
+def test_query_executor_elasticsearch_streams():
+    app = create_app(
+        TESTING=True,
+        ELASTICSEARCH_SLICES=3,
+        TWEETS={"SOURCE": "elasticsearch", "RETRIEVAL": "scan", "CHUNK_SIZE": 10},
+    )
+    events = []
+    add = UserSliceAccumulator.add
+
+    def recorded_add(accumulator, chunk):
+        events.append(("add", len(chunk), time.perf_counter()))
+        add(accumulator, chunk)
+
+    with app.app_context(), patch(
+        "panel_api.source.tweets.elastic_query_for_keyword"
+    ) as mock_query, patch.object(
+        ElasticsearchTweetSource, "match_keyword", side_effect=AssertionError
+    ), patch.object(
+        UserSliceAccumulator, "add", recorded_add
+    ):
+        mock_query.side_effect = lambda *_, slice_id, **__: scrolled_hits(
+            slice_id, 35, events
+        )
+        executor = QueryExecutor(max_workers=0)
+        user_slices, _ = executor.collect(
+            "keyword", (None, None), TimeAggregation.DAY, with_demographics=False
+        )
+
+    # One stream per slice, each read lazily in chunks, without concatenating
+    # the tweets first
+    assert sorted(call.kwargs["slice_id"] for call in mock_query.call_args_list) == [
+        0,
+        1,
+        2,
+    ]
+    assert [event[:2] for event in events[:11]] == [("read", 0)] * 10 + [("add", 10)]
+    assert executor.timings.summary()["fetch"]["runs"] == 3 * 4
+    assert user_slices["tweet_count"].sum() == 3 * 35
+    assert user_slices["userid"].nunique() == 3 * 7
+
+
+def test_query_executor_overlaps_lookups():
+    app = create_app(
+        TESTING=True,
+        ELASTICSEARCH_SLICES=2,
+        TWEETS={"SOURCE": "elasticsearch", "RETRIEVAL": "scan", "CHUNK_SIZE": 10},
+    )
+    events = []
+
+    def get_demographics(userids):
+        events.append(("lookup", len(userids), time.perf_counter()))
+        return pd.DataFrame(columns=["userid", *Demographic])
+
+    with app.app_context(), patch(
+        "panel_api.source.tweets.elastic_query_for_keyword"
+    ) as mock_query, patch(
+        "panel_api.query.executor.DemographicSource"
+    ) as demographic_source:
+        mock_query.side_effect = lambda *_, slice_id, **__: scrolled_hits(
+            slice_id, 40, events, delay=0.005
+        )
+        demographic_source.return_value.get_demographics.side_effect = get_demographics
+        executor = QueryExecutor(max_workers=2)
+        executor.collect("keyword", (None, None), TimeAggregation.DAY)
+
+    # Users of the first chunks are looked up while the slices are still scrolled
+    first_lookup = min(t for kind, _, t in events if kind == "lookup")
+    last_read = max(t for kind, _, t in events if kind == "read")
+    assert first_lookup < last_read
+    timings = executor.timings.summary()
+    assert timings["fetch"]["runs"] == 2 * 4
+    assert timings["fetch"]["seconds"] >= 2 * 40 * 0.005 / 2
+
+
+def test_user_slice_accumulator():
+    tweets, _ = random_user_data(n_tweets=3000, n_users=200)
+    expected = reduce_chunk(tweets, TimeAggregation.DAY)
+    min_merge_rows = 100
+    with patch("panel_api.aggregation.streaming.MIN_MERGE_ROWS", min_merge_rows):
+        accumulator = UserSliceAccumulator(TimeAggregation.DAY)
+        for rows in np.array_split(range(len(tweets)), 30):
+            accumulator.add(tweets.iloc[rows])
+            # Merged as chunks come, so never much more than the distinct pairs
+            assert accumulator.n_rows <= 2 * len(expected) + min_merge_rows + len(rows)
+        accumulator.add(tweets.iloc[:0])
+
+    assert len(accumulator.user_slices()) == accumulator.n_rows == len(expected)
+    assert accumulator.n_tweets == tweets["tweet_count"].sum()
+    assert set(accumulator.userids()) == set(tweets["userid"])
+    pd.testing.assert_frame_equal(
+        expected.sort_values(["created_at", "userid"], ignore_index=True),
+        accumulator.user_slices().sort_values(
+            ["created_at", "userid"], ignore_index=True
+        ),
+    )
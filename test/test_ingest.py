@@ -0,0 +1,92 @@
+import csv
+import gzip
+import io
+import json
+from unittest.mock import MagicMock, patch
+
+from panel_api import create_app
+from panel_api.ingest import TWEETS_MAPPING, ingest_tweets, ingest_voters, read_ndjson
+
+
+def test_read_ndjson(tmp_path):
+    plain = tmp_path / "tweets.json"
+    plain.write_text('{"id": 1}\n\n{"id": 2}\n', encoding="utf-8")
+    compressed = tmp_path / "tweets.json.gz"
+    with gzip.open(compressed, "wt", encoding="utf-8") as dump:
+        dump.write('{"id": 3}\n')
+
+    assert [*read_ndjson([str(plain), str(compressed)])] == [
+        {"id": 1},
+        {"id": 2},
+        {"id": 3},
+    ]
+
+
+def test_ingest_tweets():
+    app = create_app(TESTING=True)
+    tweets = [{"id_str": "10", "full_text": "a"}, {"full_text": "b"}]
+    bulk_actions = []
+
+    def parallel_bulk(_, actions, chunk_size, thread_count):
+        assert (chunk_size, thread_count) == (1, 2)
+        for action in actions:
+            bulk_actions.append(action)
+            yield True, {}
+
+    with app.app_context(), patch(
+        "panel_api.ingest.elasticsearch_connection"
+    ) as mock_connection, patch("panel_api.ingest.parallel_bulk", parallel_bulk):
+        indices = mock_connection.return_value.indices
+        indices.get_settings.return_value = {
+            "tweets": {"settings": {"index": {"refresh_interval": "5s"}}}
+        }
+        report = ingest_tweets(tweets, chunk_size=1, thread_count=2)
+
+    assert report.documents == 2
+    assert indices.create.call_args.kwargs["body"] == {"mappings": TWEETS_MAPPING}
+    assert bulk_actions[0] == {"_index": "tweets", "_id": "10", "_source": tweets[0]}
+    assert "_id" not in bulk_actions[1]
+    intervals = [
+        call.kwargs["body"]["index"]["refresh_interval"]
+        for call in indices.put_settings.call_args_list
+    ]
+    assert intervals == ["-1", "5s"]
+    indices.refresh.assert_called_once()
+
+
+def test_ingest_voters():
+    app = create_app(TESTING=True)
+    voters = [
+        {"twProfileID": "1", "voterbase_age": 40},
+        {"voterbase_age": 50},
+        {"twProfileID": 3, "vf_source_state": "MA"},
+    ]
+    copied = []
+    cursor = MagicMock()
+    cursor.copy_expert.side_effect = lambda _, buffer: copied.extend(
+        csv.reader(io.StringIO(buffer.read()))
+    )
+    with app.app_context(), patch(
+        "panel_api.ingest.postgresql_connection"
+    ) as mock_connection:
+        conn = mock_connection.return_value.__enter__.return_value
+        conn.cursor.return_value.__enter__.return_value = cursor
+        report = ingest_voters(voters, batch_size=1)
+
+    assert report.documents == 2
+    assert cursor.copy_expert.call_count == 2
+    assert [userid for userid, _ in copied] == ["1", "3"]
+    assert json.loads(copied[1][1]) == voters[2]
+    statements = [
+        " ".join(call.args[0].split()) for call in cursor.execute.call_args_list
+    ]
+    # Each batch is staged, then replaces the voters with the same userid
+    assert all(
+        "COPY voters_staging" in call.args[0]
+        for call in cursor.copy_expert.call_args_list
+    )
+    assert (
+        sum(s.startswith("DELETE FROM voters USING voters_staging") for s in statements)
+        == 2
+    )
+    assert sum(s.startswith("INSERT INTO voters") for s in statements) == 2
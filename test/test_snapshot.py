@@ -0,0 +1,83 @@
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from click.testing import CliRunner
+
+from panel_api import create_app
+from panel_api.api_utils import decode_demographic, encode_demographic
+from panel_api.api_values import MISSING_CODE, Demographic
+from panel_api.cli import cli
+from panel_api.snapshot import VoterSnapshot
+from panel_api.source.voters import DemographicSource
+
+from .fixtures.data import voter_data  # noqa: F401
+
+
+def test_encode_demographic():
+    values = np.array(["Female", "Unknown", "Male", None, "unexpected"], dtype=object)
+    codes = encode_demographic(Demographic.GENDER, values)
+
+    assert codes.dtype == np.uint8
+    assert list(codes) == [0, 2, 1, MISSING_CODE, MISSING_CODE]
+    assert list(decode_demographic(Demographic.GENDER, codes)) == [
+        "Female",
+        "Unknown",
+        "Male",
+        None,
+        None,
+    ]
+
+
+def test_snapshot_lookup(tmp_path, voter_data):
+    voters = pd.concat([voter_data.iloc[::-1], voter_data.iloc[[0]]])
+    VoterSnapshot.from_voters(voters).save(str(tmp_path / "snapshot"))
+    voter_snapshot = VoterSnapshot.load(str(tmp_path / "snapshot"))
+
+    results = voter_snapshot.lookup(["9", "2", "2", "12", "not a number", "0"])
+
+    assert len(voter_snapshot) == len(voter_data)
+    assert isinstance(voter_snapshot.userids, np.memmap)
+    pd.testing.assert_frame_equal(
+        results.sort_values("userid").reset_index(drop=True),
+        voter_data.iloc[[0, 2, 9]][["userid", *Demographic]].reset_index(drop=True),
+    )
+
+
+def test_snapshot_source(tmp_path, voter_data):
+    VoterSnapshot.from_voters(voter_data).save(str(tmp_path))
+    app = create_app(
+        TESTING=True, VOTERS={"SOURCE": "snapshot", "SNAPSHOT_PATH": str(tmp_path)}
+    )
+    with app.app_context():
+        results = DemographicSource().get_demographics(["3", "4"])
+
+    assert list(results["userid"]) == ["3", "4"]
+    assert list(results[Demographic.STATE]) == ["MA", "MA"]
+
+
+def test_build_snapshot_command(tmp_path):
+    voters = pd.DataFrame(
+        {
+            "userid": ["2", "1"],
+            Demographic.STATE: ["AL", "GA"],
+            Demographic.AGE: [25.0, np.nan],
+            Demographic.GENDER: ["Male", "Female"],
+            Demographic.RACE: ["Caucasian", "Uncoded"],
+        }
+    )
+    with patch("panel_api.cli.stream_all_voter_demographics") as mock_stream:
+        mock_stream.return_value = voters
+        result = CliRunner().invoke(
+            cli, ["snapshot", "build", "--output", str(tmp_path / "snapshot")]
+        )
+
+    assert result.exit_code == 0, result.output
+    voter_snapshot = VoterSnapshot.load(str(tmp_path / "snapshot"))
+    assert list(voter_snapshot.userids) == [1, 2]
+    assert list(
+        decode_demographic(Demographic.AGE, voter_snapshot.codes[Demographic.AGE])
+    ) == [
+        "Unknown",
+        "under 30",
+    ]
@@ -1,11 +1,36 @@
+import json
+import logging
+import os
+import re
+import threading
 from datetime import datetime
 from unittest.mock import MagicMock, patch
 
+import numpy as np
 import pandas as pd
 import pytest
 
-from panel_api.aggregation.user_demographics import TimeSlicedUserDemographicAggregation
-from panel_api.api_values import Demographic, TimeAggregation
+from panel_api import create_app
+from panel_api.aggregation.engines import AggregationEngine, aggregation_class
+from panel_api.aggregation.enriched import EnrichedTimeSlicedUserDemographicAggregation
+from panel_api.aggregation.user_demographics import (
+    TimeSlicedUserDemographicAggregation,
+    encode_user_data,
+    time_slice_starts,
+)
+from panel_api.api_utils import categorize_ages
+from panel_api.api_values import CENSORED_COUNT, Demographic, TimeAggregation
+from panel_api.connections import postgresql_connection
+from panel_api.es_utils import CARDINALITY_RELATIVE_ERROR, elastic_enrich_tweets
+from panel_api.ingest import ingest_voters
+from panel_api.query.keyword_query import KeywordQuery
+from panel_api.source.tweets import ElasticsearchTweetSource, TweetSource
+from panel_api.source.voters import DemographicSource
+from panel_api.sql_utils import (
+    VOTER_DEMOGRAPHIC_FIELDS,
+    grouping_mask,
+    migrate_voter_demographics,
+)
 
 from .fixtures.data import tweet_data, tweet_voter_data, voter_data  # noqa: F401
 from .utils import list_equals_ignore_order, period_equals
@@ -244,3 +269,718 @@ def test_table_cross_sections(tweet_data, voter_data):
     ]
 
     assert aggregation_list_equals(expected_results, results, "ts")
+
+
+def test_aggregation_pre_aggregated_tweets(tweet_data, voter_data):
+    pre_aggregated_data = (
+        tweet_data.groupby(["created_at", "userid"])
+        .size()
+        .rename("tweet_count")
+        .reset_index()
+    )
+    for time_aggregation in TimeAggregation:
+        expected_results = TimeSlicedUserDemographicAggregation(
+            tweet_data,
+            voter_data,
+            time_aggregation=time_aggregation,
+            cross_sections=[Demographic.RACE, Demographic.GENDER],
+        ).to_list()
+        results = TimeSlicedUserDemographicAggregation(
+            pre_aggregated_data,
+            voter_data,
+            time_aggregation=time_aggregation,
+            cross_sections=[Demographic.RACE, Demographic.GENDER],
+        ).to_list()
+
+        assert aggregation_list_equals(expected_results, results, "ts")
+
+
+def test_elasticsearch_aggregation_retrieval():
+    app = create_app(
+        TESTING=True, TWEETS={"SOURCE": "elasticsearch", "RETRIEVAL": "aggregation"}
+    )
+    buckets = [
+        {"key": {"created_at": 1676592000000, "userid": 0}, "doc_count": 2},
+        {"key": {"created_at": 1676592000000, "userid": 1}, "doc_count": 1},
+        {"key": {"created_at": 1676764800000, "userid": 0}, "doc_count": 5},
+    ]
+    with app.app_context(), patch(
+        "panel_api.source.tweets.elastic_aggregate_keyword"
+    ) as mock_aggregate:
+        mock_aggregate.return_value = iter(buckets)
+        results = TweetSource().match_keyword(
+            "keyword", (None, None), time_aggregation=TimeAggregation.DAY
+        )
+
+    assert mock_aggregate.call_args.args == ("keyword", "day")
+    assert results.to_dict("records") == [
+        {"created_at": datetime(2023, 2, 17), "userid": "0", "tweet_count": 2},
+        {"created_at": datetime(2023, 2, 17), "userid": "1", "tweet_count": 1},
+        {"created_at": datetime(2023, 2, 19), "userid": "0", "tweet_count": 5},
+    ]
+
+
+def test_elasticsearch_docvalue_retrieval():
+    app = create_app(
+        TESTING=True, TWEETS={"SOURCE": "elasticsearch", "RETRIEVAL": "docvalues"}
+    )
+    pages = [
+        [
+            {"fields": {"created_at": ["1676592000000"], "user.id": [0]}},
+            {"fields": {"created_at": ["1676635200000"], "user.id": [1]}},
+        ],
+        [{"fields": {"created_at": ["1676764800000"], "user.id": [0]}}],
+    ]
+    with app.app_context(), patch(
+        "panel_api.source.tweets.elastic_query_for_keyword_fields"
+    ) as mock_query:
+        mock_query.return_value = iter(pages)
+        results = TweetSource().match_keyword("keyword", (None, None))
+
+    assert results.to_dict("records") == [
+        {"created_at": datetime(2023, 2, 17), "userid": "0"},
+        {"created_at": datetime(2023, 2, 17, 12), "userid": "1"},
+        {"created_at": datetime(2023, 2, 19), "userid": "0"},
+    ]
+
+
+def test_elasticsearch_sliced_retrieval():
+    app = create_app(
+        TESTING=True,
+        ELASTICSEARCH_SLICES=2,
+        TWEETS={"SOURCE": "elasticsearch", "RETRIEVAL": "docvalues"},
+    )
+    slice_pages = {
+        0: [[{"fields": {"created_at": ["1676592000000"], "user.id": [0]}}]],
+        1: [
+            [{"fields": {"created_at": ["1676764800000"], "user.id": [1]}}],
+            [{"fields": {"created_at": ["1676764800000"], "user.id": [2]}}],
+        ],
+    }
+    with app.app_context(), patch(
+        "panel_api.source.tweets.elastic_query_for_keyword_fields"
+    ) as mock_query:
+        mock_query.side_effect = lambda *_, slice_id, max_slices, **__: iter(
+            slice_pages[slice_id]
+        )
+        results = TweetSource().match_keyword("keyword", (None, None))
+
+    assert mock_query.call_count == 2
+    assert all(call.kwargs["max_slices"] == 2 for call in mock_query.call_args_list)
+    assert results.to_dict("records") == [
+        {"created_at": datetime(2023, 2, 17), "userid": "0"},
+        {"created_at": datetime(2023, 2, 19), "userid": "1"},
+        {"created_at": datetime(2023, 2, 19), "userid": "2"},
+    ]
+
+
+def test_elasticsearch_sliced_retrieval_threads(caplog):
+    app = create_app(
+        TESTING=True,
+        ELASTICSEARCH_SLICES=3,
+        TWEETS={"SOURCE": "elasticsearch", "RETRIEVAL": "scan", "CHUNK_SIZE": 2},
+    )
+    # Every slice waits for the others, so they must be scrolled concurrently
+    barrier = threading.Barrier(3, timeout=5)
+    threads = {}
+
+    def scroll(slice_id):
+        barrier.wait()
+        threads[slice_id] = threading.current_thread()
+        for i in range(5):
+            yield {
+                "created_at": "Fri Feb 17 00:00:00 +0000 2023",
+                "user": {"id": slice_id * 10 + i},
+            }
+
+    with app.app_context(), patch(
+        "panel_api.source.tweets.elastic_query_for_keyword"
+    ) as mock_query, caplog.at_level(logging.INFO):
+        mock_query.side_effect = lambda *_, slice_id, **__: scroll(slice_id)
+        results = TweetSource().match_keyword("keyword", (None, None))
+
+    assert len(set(threads.values())) == 3
+    assert threading.main_thread() not in threads.values()
+    assert results["userid"].tolist() == [
+        str(slice_id * 10 + i) for slice_id in range(3) for i in range(5)
+    ]
+    logged = sorted(
+        record.getMessage()
+        for record in caplog.records
+        if record.getMessage().startswith("Scrolled slice")
+    )
+    assert len(logged) == 3
+    for slice_id, message in enumerate(logged, start=1):
+        assert re.fullmatch(
+            rf"Scrolled slice {slice_id}/3 for 'keyword': 5 tweets in \d+\.\d{{3}}s",
+            message,
+        )
+
+
+def test_elasticsearch_demographic_source():
+    app = create_app(
+        TESTING=True,
+        VOTERS={"SOURCE": "elasticsearch", "BATCH_SIZE": 2, "CACHE_SIZE": 0},
+    )
+    voters = {
+        "1": {"vf_source_state": "MA", "voterbase_age": 34, "voterbase_gender": "F"},
+        "3": {"vf_source_state": "NY", "voterbase_age": 71, "voterbase_race": "X"},
+    }
+
+    def mget(body, index, _source_includes):
+        assert index == "voters"
+        assert len(body["ids"]) <= 2
+        return {
+            "docs": [
+                {"_id": i, "found": True, "_source": voters[i]}
+                if i in voters
+                else {"_id": i, "found": False}
+                for i in body["ids"]
+            ]
+        }
+
+    with app.app_context(), patch(
+        "panel_api.es_utils.elasticsearch_connection"
+    ) as mock_connection:
+        mock_connection.return_value.mget.side_effect = mget
+        results = DemographicSource().get_demographics(["1", "2", "3", "4", "5"])
+
+    assert mock_connection.return_value.mget.call_count == 3
+    assert sorted(results["userid"]) == ["1", "3"]
+    results = results.set_index("userid")
+    assert results.loc["1", Demographic.STATE] == "MA"
+    assert results.loc["3", Demographic.AGE] == "70+"
+    assert pd.isna(results.loc["1", Demographic.RACE])
+
+
+def test_encode_user_data(tweet_data, voter_data):
+    voters = pd.concat([voter_data, voter_data.iloc[[0]]]).assign(
+        **{Demographic.RACE: [*voter_data[Demographic.RACE][:-1], "Unlisted", "White"]}
+    )
+    tweets = pd.concat(
+        [tweet_data, pd.DataFrame([{"created_at": "2023-02-17", "userid": "@bad"}])]
+    )
+
+    user_post_times, user_demographics = encode_user_data(tweets, voters)
+
+    assert user_post_times["userid"].dtype == "int64"
+    assert list(user_post_times["tweet_count"]) == [1] * len(tweet_data)
+    assert user_demographics["userid"].is_unique
+    assert len(user_demographics) == len(voter_data)
+    for dem in Demographic:
+        categories = list(user_demographics[dem].cat.categories)
+        assert categories[: len(dem.values())] == dem.values()
+    assert list(user_demographics[Demographic.RACE].cat.categories)[-2:] == [
+        "Unlisted",
+        "White",
+    ]
+
+
+def test_aggregation_integer_userids(tweet_data, voter_data):
+    expected_results = TimeSlicedUserDemographicAggregation(
+        tweet_data, voter_data, time_aggregation=TimeAggregation.WEEK
+    ).to_list()
+    results = TimeSlicedUserDemographicAggregation(
+        tweet_data.astype({"userid": "int64"}),
+        voter_data.astype({"userid": "int64"}),
+        time_aggregation=TimeAggregation.WEEK,
+    ).to_list()
+
+    assert aggregation_list_equals(expected_results, results, "ts")
+
+
+def random_user_data(n_tweets: int, n_users: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    tweets = pd.DataFrame(
+        {
+            "created_at": pd.Timestamp("2022-01-01")
+            + pd.to_timedelta(rng.integers(0, 40 * 86400, n_tweets), unit="s"),
+            "userid": rng.integers(0, n_users + 20, n_tweets).astype(str),
+            "tweet_count": rng.integers(1, 4, n_tweets),
+        }
+    )
+    voters = pd.DataFrame(
+        {
+            "userid": np.arange(n_users).astype(str),
+            **{
+                dem: rng.choice([*dem.values(), None, "Unlisted"], n_users)
+                for dem in Demographic
+            },
+        }
+    )
+    return tweets, voters
+
+
+def assert_aggregations_equal(expected, actual):
+    pd.testing.assert_frame_equal(expected.counts, actual.counts, check_freq=False)
+    for dem in Demographic:
+        pd.testing.assert_index_equal(
+            expected.demographic_labels[dem], actual.demographic_labels[dem]
+        )
+        np.testing.assert_array_equal(
+            expected.demographic_arrays[dem], actual.demographic_arrays[dem]
+        )
+    for expected_labels, actual_labels in zip(
+        expected.cross_section_labels, actual.cross_section_labels, strict=True
+    ):
+        pd.testing.assert_index_equal(expected_labels, actual_labels)
+    if expected.cross_sections is not None:
+        np.testing.assert_array_equal(
+            expected.cross_sections_array, actual.cross_sections_array
+        )
+    expected_list = sorted(expected.to_list(), key=lambda period: period["ts"])
+    actual_list = sorted(actual.to_list(), key=lambda period: period["ts"])
+    assert [period["ts"] for period in expected_list] == [
+        period["ts"] for period in actual_list
+    ]
+    assert all(map(period_equals, expected_list, actual_list))
+
+
+@pytest.mark.parametrize("time_aggregation", [*TimeAggregation])
+@pytest.mark.parametrize(
+    "cross_sections",
+    [None, [Demographic.AGE], [Demographic.RACE, Demographic.STATE]],
+)
+def test_numpy_engine(tweet_data, voter_data, time_aggregation, cross_sections):
+    for tweets, voters in [
+        (tweet_data, voter_data),
+        random_user_data(5000, 300),
+        (tweet_data.iloc[:0], voter_data),
+    ]:
+        assert_aggregations_equal(
+            TimeSlicedUserDemographicAggregation(
+                tweets, voters, time_aggregation, cross_sections=cross_sections
+            ),
+            aggregation_class(AggregationEngine.NUMPY)(
+                tweets, voters, time_aggregation, cross_sections=cross_sections
+            ),
+        )
+
+
+@pytest.mark.parametrize("explicit_zeros", [False, True])
+@pytest.mark.parametrize(
+    "cross_sections", [None, [Demographic.RACE, Demographic.STATE]]
+)
+def test_to_json(explicit_zeros, cross_sections):
+    tweets, voters = random_user_data(5000, 300)
+    aggregation = TimeSlicedUserDemographicAggregation(
+        tweets, voters, TimeAggregation.WEEK, cross_sections=cross_sections
+    ).censor(5)
+
+    with create_app(TESTING=True).app_context() as context:
+        expected = json.loads(
+            context.app.json.dumps(aggregation.to_list(explicit_zeros=explicit_zeros))
+        )
+    assert json.loads(aggregation.to_json(explicit_zeros=explicit_zeros)) == expected
+
+
+def test_to_columnar():
+    tweets, voters = random_user_data(5000, 300)
+    aggregation = TimeSlicedUserDemographicAggregation(
+        tweets,
+        voters,
+        TimeAggregation.WEEK,
+        cross_sections=[Demographic.RACE, Demographic.STATE],
+    ).censor(5)
+
+    columnar = aggregation.to_columnar()
+    records = aggregation.to_list()
+    assert columnar["ts"] == [record["ts"] for record in records]
+    assert columnar["n_tweets"] == [record["n_tweets"] for record in records]
+    for dem in Demographic:
+        for counts, record in zip(columnar[dem]["counts"], records):
+            assert {
+                label: count
+                for label, count in zip(columnar[dem]["labels"], counts)
+                if label in record[dem]
+            } == record[dem]
+    race_labels, state_labels = columnar["groups"]["labels"]
+    for counts, record in zip(columnar["groups"]["counts"], records):
+        for group in record["groups"]:
+            i = race_labels.index(group[Demographic.RACE])
+            j = state_labels.index(group[Demographic.STATE])
+            assert counts[i][j] == group["count"]
+
+
+def test_to_arrow():
+    pa = pytest.importorskip("pyarrow")
+    tweets, voters = random_user_data(5000, 300)
+    aggregation = TimeSlicedUserDemographicAggregation(
+        tweets,
+        voters,
+        TimeAggregation.WEEK,
+        cross_sections=[Demographic.RACE, Demographic.STATE],
+    ).censor(5)
+
+    table = pa.ipc.open_stream(
+        aggregation.to_arrow(metadata={"query": "{}"})
+    ).read_all()
+    columnar = aggregation.to_columnar()
+    assert table.schema.metadata[b"query"] == b"{}"
+    labels = json.loads(table.schema.metadata[b"labels"])
+    assert labels["groups"] == {
+        "voterbase_race": columnar["groups"]["labels"][0],
+        "tsmart_state": columnar["groups"]["labels"][1],
+    }
+    assert table["n_tweeters"].to_pylist() == columnar["n_tweeters"]
+    for dem in Demographic:
+        assert labels[dem] == columnar[dem]["labels"]
+        assert table[str(dem)].to_pylist() == columnar[dem]["counts"]
+    assert table["groups"].to_pylist() == [
+        np.ravel(counts).tolist() for counts in columnar["groups"]["counts"]
+    ]
+
+
+def test_select_and_concat_slices():
+    tweets, voters = random_user_data(5000, 300)
+    cross_sections = [Demographic.RACE, Demographic.STATE]
+
+    # Parts over different users may have different extra labels
+    early = tweets["created_at"] < pd.Timestamp("2022-01-20")
+    parts = [
+        TimeSlicedUserDemographicAggregation(
+            tweets[early], voters, TimeAggregation.DAY, cross_sections=cross_sections
+        ),
+        TimeSlicedUserDemographicAggregation(
+            tweets[~early],
+            voters[voters[Demographic.RACE] != "Unlisted"],
+            TimeAggregation.DAY,
+            cross_sections=cross_sections,
+        ),
+    ]
+    assert "Unlisted" not in parts[1].demographic_labels[Demographic.RACE]
+
+    combined = TimeSlicedUserDemographicAggregation.concat(parts[::-1])
+    assert combined.counts.index.is_monotonic_increasing
+    assert "Unlisted" in combined.demographic_labels[Demographic.RACE]
+    assert combined.to_list() == parts[0].to_list() + parts[1].to_list()
+
+    time_slices = combined.counts.index
+    selected = combined.select_slices([time_slices[3], pd.Timestamp("2021-01-01")])
+    assert selected.to_list() == [combined.to_list()[3]]
+    assert (
+        TimeSlicedUserDemographicAggregation.concat(
+            [
+                combined.select_slices(time_slices[5:]),
+                combined.select_slices(time_slices[:5]),
+            ]
+        ).to_list()
+        == combined.to_list()
+    )
+
+
+@pytest.mark.parametrize(
+    "time_aggregation", [TimeAggregation.WEEK, TimeAggregation.MONTH]
+)
+@pytest.mark.parametrize("engine", [AggregationEngine.PANDAS, AggregationEngine.NUMPY])
+def test_rollup(time_aggregation, engine):
+    tweets, voters = random_user_data(5000, 300)
+    cross_sections = [Demographic.AGE, Demographic.GENDER]
+    daily = aggregation_class(engine)(
+        tweets,
+        voters,
+        TimeAggregation.DAY,
+        cross_sections=cross_sections,
+        keep_user_slices=True,
+    )
+    expected = TimeSlicedUserDemographicAggregation(
+        tweets, voters, time_aggregation, cross_sections=cross_sections
+    )
+
+    rolled_up = daily.rollup(time_aggregation)
+    assert rolled_up.to_list() == expected.to_list()
+    with pytest.raises(ValueError):
+        rolled_up.rollup(TimeAggregation.DAY)
+    with pytest.raises(ValueError):
+        expected.rollup(time_aggregation)
+
+
+def demographic_buckets(tweets, voters, time_aggregation, cross_sections):
+    """
+    Build the date_histogram buckets Elasticsearch would return for tweets enriched
+    with their users' demographics.
+    """
+    data = tweets.merge(voters, on="userid")
+    data["ts"] = time_slice_starts(data["created_at"], time_aggregation)
+
+    def users(rows):
+        return {"value": rows["userid"].nunique()}
+
+    def terms(rows, dems):
+        if len(dems) == 0:
+            return {"users": users(rows)}
+        return {
+            "buckets": [
+                {"key": value, **nested_terms(group, dems[1:])}
+                for value, group in rows.groupby(dems[0])
+            ]
+        }
+
+    def nested_terms(rows, dems):
+        if len(dems) == 0:
+            return {"users": users(rows)}
+        return {"cross_section": terms(rows, dems)}
+
+    return [
+        {
+            "key": int(ts.value // 10**6),
+            "doc_count": int(rows["tweet_count"].sum()),
+            "users": users(rows),
+            **{str(dem): terms(rows, [dem]) for dem in Demographic},
+            **(nested_terms(rows, cross_sections) if cross_sections else {}),
+        }
+        for ts, rows in data.groupby("ts")
+    ]
+
+
+def test_enriched_aggregation():
+    tweets, voters = random_user_data(n_tweets=2000, n_users=150)
+    cross_sections = [Demographic.GENDER, Demographic.AGE]
+    buckets = demographic_buckets(tweets, voters, TimeAggregation.WEEK, cross_sections)
+
+    expected = TimeSlicedUserDemographicAggregation(
+        tweets, voters, TimeAggregation.WEEK, cross_sections=cross_sections
+    )
+    actual = EnrichedTimeSlicedUserDemographicAggregation(
+        buckets, TimeAggregation.WEEK, cross_sections=cross_sections
+    )
+    assert_aggregations_equal(expected, actual)
+    assert actual.to_list() == expected.to_list()
+
+
+def test_enriched_aggregation_censor():
+    tweets, voters = random_user_data(n_tweets=200, n_users=2000)
+    estimates = EnrichedTimeSlicedUserDemographicAggregation(
+        demographic_buckets(tweets, voters, TimeAggregation.MONTH, None),
+        TimeAggregation.MONTH,
+        relative_error=0.002,
+    )
+    min_displayed_users = 10
+    estimates.demographic_arrays[Demographic.GENDER][0, :3] = [9, 10, 11]
+    estimates.demographic_arrays[Demographic.STATE][0, :3] = [0, 100, 10000]
+
+    estimates.censor(min_displayed_users)
+
+    # Counts whose lower error bound is below the threshold are censored too
+    assert estimates.demographic_arrays[Demographic.GENDER][0, :3].tolist() == [
+        CENSORED_COUNT,
+        CENSORED_COUNT,
+        11,
+    ]
+    assert estimates.demographic_arrays[Demographic.STATE][0, :3].tolist() == [
+        0,
+        100,
+        10000,
+    ]
+
+
+@pytest.mark.parametrize(
+    "retrieval, approximate",
+    [("scan", True), ("enriched", True), ("enriched", False)],
+)
+def test_keyword_query_approximate(retrieval, approximate):
+    tweet_data, voter_data = random_user_data(n_tweets=2000, n_users=150)
+    app = create_app(
+        TESTING=True,
+        EXECUTOR={"WORKERS": 0},
+        TWEETS={
+            "SOURCE": "attached",
+            "RETRIEVAL": retrieval,
+            "ATTACHED_DATA": tweet_data,
+        },
+        VOTERS={"SOURCE": "attached", "ATTACHED_DATA": voter_data, "CACHE_SIZE": 0},
+    )
+    buckets = demographic_buckets(tweet_data, voter_data, TimeAggregation.DAY, None)
+    query = KeywordQuery("keyword", TimeAggregation.DAY, approximate=approximate)
+
+    with app.app_context(), patch(
+        "panel_api.source.tweets.elastic_aggregate_demographics",
+        return_value=buckets,
+    ), patch.object(
+        TweetSource,
+        "aggregate_keyword",
+        lambda self, **kwargs: ElasticsearchTweetSource().aggregate_keyword(**kwargs),
+    ):
+        aggregation = query.execute()
+
+    expected = TimeSlicedUserDemographicAggregation(
+        tweet_data, voter_data, TimeAggregation.DAY
+    )
+    assert aggregation.to_list() == expected.to_list()
+    if retrieval == "enriched" and approximate:
+        assert aggregation.relative_error == CARDINALITY_RELATIVE_ERROR
+    else:
+        # Without enriched tweets, or an approximate query, distinct users are
+        # counted exactly
+        assert aggregation.relative_error is None
+
+
+def test_elastic_enrich_tweets():
+    app = create_app(TESTING=True)
+    pages = [
+        [
+            {"_index": "tweets", "_id": "a", "fields": {"user.id": [1]}},
+            {"_index": "tweets", "_id": "b", "fields": {"user.id": [2]}},
+        ],
+        [{"_index": "tweets", "_id": "c", "fields": {"user.id": [1]}}],
+    ]
+    updates = []
+
+    def streaming_bulk(_, actions, **__):
+        for action in actions:
+            updates.append(action)
+            yield True, {}
+
+    def lookup(userids):
+        return {
+            userid: {str(Demographic.STATE): "MA"}
+            for userid in userids
+            if userid == "1"
+        }
+
+    with app.app_context(), patch("panel_api.es_utils.elasticsearch_connection"), patch(
+        "panel_api.es_utils._scroll_pages"
+    ) as mock_pages, patch("panel_api.es_utils.streaming_bulk", streaming_bulk):
+        mock_pages.return_value = iter(pages)
+        counts = [*elastic_enrich_tweets(lookup)]
+
+    assert counts == [(2, 1), (1, 1)]
+    assert [update["_id"] for update in updates] == ["a", "b", "c"]
+    assert updates[0]["doc"] == {"panel_member": True, str(Demographic.STATE): "MA"}
+    assert updates[1]["doc"]["panel_member"] is False
+    assert updates[1]["doc"][str(Demographic.STATE)] is None
+
+
+def grouping_sets_rows(user_slices, voters, cross_sections):
+    """
+    Compute the rows PostgreSQL would return for `aggregate_user_slices`, with the
+    JSON voters schema (ages as codes).
+    """
+    data = user_slices.merge(voters, on="userid")
+    data[Demographic.AGE] = [
+        Demographic.AGE.values().index(age) for age in data[Demographic.AGE]
+    ]
+    grouping_sets = [[], *([dem] for dem in Demographic)]
+    if len(cross_sections) > 1:
+        grouping_sets.append(cross_sections)
+    rows = []
+    for grouped in grouping_sets:
+        groups = data.groupby(["created_at", *grouped], dropna=False)
+        for key, group in groups:
+            key = key if isinstance(key, tuple) else (key,)
+            values = dict(zip(grouped, key[1:]))
+            rows.append(
+                (
+                    key[0].to_pydatetime(),
+                    *(
+                        None if pd.isna(values.get(dem)) else values.get(dem)
+                        for dem in Demographic
+                    ),
+                    grouping_mask(grouped),
+                    len(group),
+                    int(group["tweet_count"].sum()),
+                )
+            )
+    return rows
+
+
+@pytest.mark.parametrize(
+    "cross_sections", [[], [Demographic.RACE], [Demographic.GENDER, Demographic.AGE]]
+)
+def test_postgres_engine(cross_sections):
+    tweets, voters = random_user_data(n_tweets=2000, n_users=150)
+    # Ages are always bucketed in the database
+    voters[Demographic.AGE] = voters[Demographic.AGE].where(
+        voters[Demographic.AGE].isin(Demographic.AGE.values()), "Unknown"
+    )
+    app = create_app(TESTING=True, VOTERS={"SOURCE": "database", "SCHEMA": "json"})
+    cursor = MagicMock()
+    connection = MagicMock()
+    connection.cursor.return_value.__enter__.return_value = cursor
+
+    def copy_expert(_, buffer):
+        user_slices = pd.read_csv(
+            buffer,
+            names=["created_at", "userid", "tweet_count"],
+            parse_dates=["created_at"],
+            dtype={"userid": str},
+        )
+        cursor.fetchall.return_value = grouping_sets_rows(
+            user_slices, voters, cross_sections
+        )
+
+    cursor.copy_expert.side_effect = copy_expert
+    with app.app_context(), patch(
+        "panel_api.sql_utils.postgresql_connection"
+    ) as mock_connection:
+        mock_connection.return_value.__enter__.return_value = connection
+        actual = aggregation_class(AggregationEngine.POSTGRES)(
+            tweets, None, TimeAggregation.WEEK, cross_sections=cross_sections
+        )
+
+    expected = TimeSlicedUserDemographicAggregation(
+        tweets, voters, TimeAggregation.WEEK, cross_sections=cross_sections
+    )
+    assert_aggregations_equal(expected, actual)
+    assert actual.to_list() == expected.to_list()
+    assert "GROUPING SETS" in cursor.execute.call_args_list[-1].args[0]
+
+
+@pytest.fixture
+def database_app():
+    """
+    App connected to the disposable database of TEST_DATABASE_URL, whose voters
+    tables are dropped before and after the test.
+    """
+    url = os.environ.get("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    app = create_app(TESTING=True, DATABASE_URL=url)
+
+    def drop_tables():
+        with postgresql_connection() as conn, conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS voters, voter_demographics")
+
+    with app.app_context():
+        drop_tables()
+        yield app
+        drop_tables()
+
+
+@pytest.mark.parametrize("schema", ["json", "normalized"])
+@pytest.mark.parametrize("cross_sections", [[], [Demographic.GENDER, Demographic.AGE]])
+def test_postgres_engine_database(database_app, schema, cross_sections):
+    tweets, voters = random_user_data(n_tweets=2000, n_users=150)
+    rng = np.random.default_rng(1)
+    ages = rng.choice(np.array([25, 30, 35.5, "47", " 61 ", 80, "abc", None]), 150)
+    ingest_voters(
+        {
+            "twProfileID": voter["userid"],
+            **{
+                VOTER_DEMOGRAPHIC_FIELDS[dem]: voter[dem]
+                for dem in Demographic
+                if dem != Demographic.AGE
+            },
+            VOTER_DEMOGRAPHIC_FIELDS[Demographic.AGE]: age,
+        }
+        for voter, age in zip(voters.to_dict("records"), ages)
+    )
+    with postgresql_connection() as conn, conn.cursor() as cur:
+        # Duplicate voters are only counted once
+        cur.execute("INSERT INTO voters SELECT * FROM voters WHERE userid = '0'")
+    voters[Demographic.AGE] = categorize_ages(ages)
+    if schema == "normalized":
+        migrate_voter_demographics()
+        # Values outside the API lists are not counted
+        for dem in Demographic:
+            voters[dem] = voters[dem].where(voters[dem].isin(dem.values()), None)
+    database_app.config["VOTERS"] = {**database_app.config["VOTERS"], "SCHEMA": schema}
+
+    actual = aggregation_class(AggregationEngine.POSTGRES)(
+        tweets, None, TimeAggregation.WEEK, cross_sections=cross_sections
+    )
+
+    expected = TimeSlicedUserDemographicAggregation(
+        tweets, voters, TimeAggregation.WEEK, cross_sections=cross_sections
+    )
+    assert actual.to_list() == expected.to_list()
@@ -0,0 +1,129 @@
+import re
+from contextlib import contextmanager
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+import pytest
+
+from panel_api.api_values import AGE_BUCKET_EDGES, MISSING_CODE, Demographic
+from panel_api.sql_utils import (
+    NUMERIC_PATTERN,
+    VOTER_DEMOGRAPHICS_SCHEMA,
+    LookupStrategy,
+    collect_voters,
+    lookup_voter_demographics,
+    migrate_voter_demographics,
+    stream_voter_demographics,
+)
+
+
+@pytest.fixture
+def mock_cursor():
+    cursor = MagicMock()
+    connection = MagicMock()
+    connection.cursor.return_value.__enter__.return_value = cursor
+
+    @contextmanager
+    def mock_connection():
+        yield connection
+
+    with patch("panel_api.sql_utils.postgresql_connection", mock_connection):
+        yield cursor
+
+
+def test_collect_voters_any_batches(mock_cursor):
+    mock_cursor.fetchall.side_effect = [[({"twProfileID": "0"},)], []]
+
+    voters = collect_voters(
+        ["0", "1", "0", "2", 1], strategy=LookupStrategy.ANY, batch_size=2
+    )
+
+    assert voters == [{"twProfileID": "0"}]
+    assert mock_cursor.execute.call_count == 2
+    batches = [call.args[1][0] for call in mock_cursor.execute.call_args_list]
+    assert all(len(batch) <= 2 for batch in batches)
+    assert sorted(id for batch in batches for id in batch) == ["0", "1", "2"]
+
+
+def test_collect_voters_copy(mock_cursor):
+    mock_cursor.fetchall.return_value = [({"twProfileID": "0"},)]
+
+    voters = collect_voters(["0", "1", "0"], strategy=LookupStrategy.COPY)
+
+    assert voters == [{"twProfileID": "0"}]
+    copied = mock_cursor.copy_expert.call_args.args[1].getvalue().split()
+    assert sorted(copied) == ["0", "1"]
+
+
+def test_stream_voter_demographics(mock_cursor):
+    mock_cursor.fetchmany.side_effect = [
+        [("0", "AL", "25", "Male", "Caucasian"), ("1", "GA", None, "Female", None)],
+        [("2", "PA", "31", "Male", "Caucasian")],
+        [],
+    ]
+
+    voters = stream_voter_demographics(["0", "1", "2", "3"], itersize=2)
+
+    assert voters.to_dict("list") == {
+        "userid": ["0", "1", "2"],
+        Demographic.STATE: ["AL", "GA", "PA"],
+        Demographic.AGE: [25.0, pytest.approx(float("nan"), nan_ok=True), 31.0],
+        Demographic.GENDER: ["Male", "Female", "Male"],
+        Demographic.RACE: ["Caucasian", None, "Caucasian"],
+    }
+    assert mock_cursor.itersize == 2
+
+
+def test_lookup_voter_demographics(mock_cursor):
+    states = Demographic.STATE.values()
+    mock_cursor.fetchall.side_effect = [
+        [(0, states.index("GA"), 1, 0, MISSING_CODE)],
+        [(2, MISSING_CODE, 6, 1, 0)],
+    ]
+
+    voters = lookup_voter_demographics(
+        ["0", "1", "0", "2", "x"], strategy=LookupStrategy.ANY, batch_size=2
+    )
+
+    assert voters.to_dict("list") == {
+        "userid": ["0", "2"],
+        Demographic.STATE: ["GA", None],
+        Demographic.AGE: ["30 - 40", "Unknown"],
+        Demographic.GENDER: ["Female", "Male"],
+        Demographic.RACE: [None, "Caucasian"],
+    }
+    batches = [call.args[1][0] for call in mock_cursor.execute.call_args_list]
+    assert sorted(id for batch in batches for id in batch) == [0, 1, 2]
+
+
+def test_lookup_voter_demographics_copy(mock_cursor):
+    mock_cursor.fetchall.return_value = []
+
+    voters = lookup_voter_demographics(["5", "x"], strategy=LookupStrategy.COPY)
+
+    assert len(voters) == 0
+    assert [*voters.columns] == ["userid", *Demographic]
+    assert mock_cursor.copy_expert.call_args.args[1].getvalue().split() == ["5"]
+
+
+def test_migrate_voter_demographics(mock_cursor):
+    mock_cursor.rowcount = 3
+
+    assert migrate_voter_demographics() == 3
+
+    statements = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    assert statements[0] == VOTER_DEMOGRAPHICS_SCHEMA
+    insert_params = mock_cursor.execute.call_args_list[2].args[1]
+    assert Demographic.STATE.values() in insert_params
+    assert AGE_BUCKET_EDGES in insert_params
+    assert statements[-1] == "VACUUM ANALYZE voter_demographics"
+
+
+@pytest.mark.parametrize(
+    "age", ["40", "40.5", "4.", ".5", "-3", "+7", "1e2", "2E-1", "", "abc", "4.0.1"]
+)
+def test_numeric_pattern(age):
+    # Migrated ages are numeric where categorize_ages finds them numeric
+    assert (re.match(NUMERIC_PATTERN, age) is not None) == pd.to_numeric(
+        pd.Series([age]), errors="coerce"
+    ).notna()[0]